@@ -0,0 +1,114 @@
+"""Online backups of the local SQLite store.
+
+Usage
+-----
+python backup_local_db.py [--database path/to/storage.sqlite3] backup [--dir backups] [--keep 7]
+python backup_local_db.py [--database path/to/storage.sqlite3] list [--dir backups]
+python backup_local_db.py [--database path/to/storage.sqlite3] restore backups/storage-20240101-120000.sqlite3
+
+`backup` is safe while the bot is running: it copies the database page by page on its
+own connection, so the bot keeps writing. `restore` overwrites the database and must
+only be run while the bot is stopped.
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+from local_db import BACKUP_MAX_RESTARTS, BACKUP_PAGES, BACKUP_PAUSE, backup_database, list_backups, restore_backup
+
+
+def run_backup(args: argparse.Namespace) -> int:
+    report = backup_database(
+        args.database,
+        args.dir,
+        keep=args.keep,
+        pages=args.pages,
+        pause=args.pause,
+        max_restarts=args.max_restarts,
+    )
+    print(f"Backup written to {report.path}")
+    print(
+        f"{report.size / 1024 / 1024:.1f} MiB, {report.pages} pages in {report.duration:.2f}s "
+        f"({report.throughput / 1024 / 1024:.1f} MiB/s, {report.restarts} restarts)"
+    )
+    return 0
+
+
+def run_list(args: argparse.Namespace) -> int:
+    backups = list_backups(args.dir, args.database)
+    if not backups:
+        print(f"No backups of {args.database.name} in {args.dir}")
+        return 0
+    for path in backups:
+        print(f"{path}  {path.stat().st_size:,} bytes")
+    return 0
+
+
+def run_restore(args: argparse.Namespace) -> int:
+    if not args.backup.exists():
+        print(f"Backup not found: {args.backup}", file=sys.stderr)
+        return 1
+    if not args.yes:
+        answer = input(f"Overwrite {args.database} with {args.backup}? The bot must be stopped. [y/N] ")
+        if answer.strip().lower() not in {"y", "yes"}:
+            print("Restore cancelled")
+            return 1
+    try:
+        pages = restore_backup(args.backup, args.database)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    print(f"Restored {args.database} from {args.backup} ({pages} pages)")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Back up and restore the local SQLite storage")
+    parser.add_argument(
+        "--database",
+        type=Path,
+        default=Path(__file__).with_name("storage.sqlite3"),
+        help="Database file (default: storage.sqlite3 next to this script)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    default_dir = Path(__file__).with_name("backups")
+
+    backup = subparsers.add_parser("backup", help="Copy the live database into the backup directory")
+    backup.add_argument("--dir", type=Path, default=default_dir, help="Backup directory (default: %(default)s)")
+    backup.add_argument("--keep", type=int, default=7, help="Newest backups to keep (default: %(default)s)")
+    backup.add_argument("--pages", type=int, default=BACKUP_PAGES, help="Pages copied per step (default: %(default)s)")
+    backup.add_argument(
+        "--pause",
+        type=float,
+        default=BACKUP_PAUSE,
+        help="Seconds to sleep between steps (default: %(default)s)",
+    )
+    backup.add_argument(
+        "--max-restarts",
+        type=int,
+        default=BACKUP_MAX_RESTARTS,
+        help="Restarts caused by concurrent writes before copying the rest in one step (default: %(default)s)",
+    )
+    backup.set_defaults(handler=run_backup)
+
+    listing = subparsers.add_parser("list", help="List existing backups, oldest first")
+    listing.add_argument("--dir", type=Path, default=default_dir, help="Backup directory (default: %(default)s)")
+    listing.set_defaults(handler=run_list)
+
+    restore = subparsers.add_parser("restore", help="Replace the database with a backup (stop the bot first)")
+    restore.add_argument("backup", type=Path, help="Backup file to restore")
+    restore.add_argument("--yes", action="store_true", help="Do not ask for confirmation")
+    restore.set_defaults(handler=run_restore)
+
+    args = parser.parse_args()
+    if args.command != "restore" and not args.database.exists():
+        parser.error(f"Database not found: {args.database}")
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""Benchmarks for the local SQLite store used by the bot.
+
+Usage
+-----
+python bench_storage.py [--database path/to/storage.sqlite3] durability [--writes 2000]
+python bench_storage.py [--database path/to/storage.sqlite3] codecs [--repeat 5]
+python bench_storage.py [--database path/to/storage.sqlite3] compression [--levels 0 1 3 6 9]
+
+Every benchmark runs against a temporary copy of the database, so the original file is
+never modified. Results are printed as a table.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence
+
+from local_db import CODECS, DEFAULT_COMPRESS_THRESHOLD, DURABILITY_PROFILES, LocalDatabase
+
+
+def copy_database(source: Path, target_dir: Path) -> Path:
+    """Copy the database (and its WAL, if present) into `target_dir`."""
+    target = target_dir / source.name
+    for suffix in ("", "-wal"):
+        candidate = source.with_name(source.name + suffix)
+        if candidate.exists():
+            shutil.copyfile(candidate, target.with_name(target.name + suffix))
+    return target
+
+
+def measure(operation: Callable[[int], None], count: int) -> List[float]:
+    timings: List[float] = []
+    for index in range(count):
+        started = time.perf_counter()
+        operation(index)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def percentile(timings: Sequence[float], fraction: float) -> float:
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def print_table(headers: Sequence[str], rows: Sequence[Sequence[str]]) -> None:
+    widths = [max(len(str(row[column])) for row in [headers, *rows]) for column in range(len(headers))]
+    print("  ".join(str(header).ljust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+def bench_durability(args: argparse.Namespace) -> int:
+    rows = []
+    for name in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            database = LocalDatabase(copy_database(args.database, Path(tmp)), durability=name)
+            users = database.reference("users_data").get() or {"1": {"balance": 0}}
+            user_ids = list(users)
+            rng = random.Random(0)
+
+            def single_user(index: int) -> None:
+                database.reference("users_data", rng.choice(user_ids), "balance").set(index)
+
+            def whole_root(index: int) -> None:
+                users[rng.choice(user_ids)]["balance"] = index
+                database.reference("users_data").set(users)
+
+            results: Dict[str, List[float]] = {
+                "user row": measure(single_user, args.writes),
+                "users_data root": measure(whole_root, max(1, args.writes // 20)),
+            }
+            started = time.perf_counter()
+            database.close()
+            close_time = time.perf_counter() - started
+
+        for label, timings in results.items():
+            total = sum(timings)
+            rows.append((
+                name,
+                label,
+                len(timings),
+                f"{len(timings) / total:,.0f}",
+                f"{statistics.median(timings) * 1000:.3f}",
+                f"{percentile(timings, 0.99) * 1000:.3f}",
+                f"{close_time * 1000:.1f}",
+            ))
+
+    print_table(("profile", "write", "count", "ops/s", "p50 ms", "p99 ms", "close ms"), rows)
+    return 0
+
+
+def load_roots(database_path: Path) -> Dict[str, object]:
+    """Decode every root of the database (through a temporary copy)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        database = LocalDatabase(copy_database(database_path, Path(tmp)), codec="json")
+        roots = {key: database.get(key) for key in database.root_keys()}
+        database.close()
+    return roots
+
+
+def bench_codecs(args: argparse.Namespace) -> int:
+    roots = load_roots(args.database)
+    rows = []
+    results: Dict[str, Dict[str, tuple]] = {}
+    for name in args.codecs:
+        codec = CODECS[name]
+        for root, value in roots.items():
+            try:
+                payload = codec.encode(value)
+            except (TypeError, ValueError, OverflowError) as exc:
+                rows.append((root, name, "-", "-", "-", f"unsupported, stored as json: {exc}"))
+                continue
+            encode_time = min(measure(lambda _: codec.encode(value), args.repeat))
+            decode_time = min(measure(lambda _: codec.decode(payload), args.repeat))
+            size = len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+            results.setdefault(root, {})[name] = (size, encode_time, decode_time)
+            rows.append((root, name, f"{size:,}", f"{encode_time * 1000:.3f}", f"{decode_time * 1000:.3f}", ""))
+
+    # Totals only cover roots every codec can encode, so the rows are comparable.
+    comparable = [per_codec for per_codec in results.values() if len(per_codec) == len(args.codecs)]
+    for name in args.codecs:
+        size = sum(per_codec[name][0] for per_codec in comparable)
+        encode_time = sum(per_codec[name][1] for per_codec in comparable)
+        decode_time = sum(per_codec[name][2] for per_codec in comparable)
+        rows.append((
+            "TOTAL",
+            name,
+            f"{size:,}",
+            f"{encode_time * 1000:.3f}",
+            f"{decode_time * 1000:.3f}",
+            f"{len(comparable)} comparable roots",
+        ))
+
+    print_table(("root", "codec", "bytes", "encode ms", "decode ms", "note"), rows)
+    return 0
+
+
+def stored_bytes(database_path: Path) -> int:
+    """Total size of all stored payloads, as written to disk."""
+    connection = sqlite3.connect(database_path)
+    try:
+        return sum(
+            connection.execute(f"SELECT COALESCE(SUM(length(value)), 0) FROM {table}").fetchone()[0]
+            for table in ("kv_store", "kv_children")
+        )
+    finally:
+        connection.close()
+
+
+def bench_compression(args: argparse.Namespace) -> int:
+    roots = load_roots(args.database)
+    rows = []
+    for level in args.levels:
+        threshold = args.threshold if level else 0
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "bench.sqlite3"
+            database = LocalDatabase(
+                path, durability="normal", compress_threshold=threshold, compress_level=level or 1
+            )
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                with database.transaction():
+                    for root, value in roots.items():
+                        # Dropping the root first forces every row to be rewritten.
+                        database.delete(root)
+                        database.set(root, value)
+            write_time = (time.perf_counter() - started) / args.repeat
+            database.close()
+            size = stored_bytes(path)
+
+            # A fresh instance has an empty decoded cache, so every read hits SQLite.
+            database = LocalDatabase(path, durability="normal", compress_threshold=threshold)
+            started = time.perf_counter()
+            for root in roots:
+                database.get(root)
+            read_time = time.perf_counter() - started
+            database.close()
+        rows.append((
+            f"zlib-{level}" if level else "off",
+            f"{size:,}",
+            f"{write_time * 1000:.1f}",
+            f"{read_time * 1000:.1f}",
+        ))
+    print_table(("compression", "stored bytes", "write ms", "read ms"), rows)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark local SQLite storage")
+    parser.add_argument(
+        "--database",
+        type=Path,
+        default=Path(__file__).with_name("storage.sqlite3"),
+        help="Database to copy for the benchmark (default: storage.sqlite3 next to this script)",
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    durability = subparsers.add_parser("durability", help="Write throughput of each durability profile")
+    durability.add_argument("--writes", type=int, default=2000, help="Number of single-user writes per profile")
+    durability.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=sorted(DURABILITY_PROFILES),
+        default=list(DURABILITY_PROFILES),
+        help="Profiles to compare (default: all)",
+    )
+    durability.set_defaults(handler=bench_durability)
+
+    codecs = subparsers.add_parser("codecs", help="Encode/decode time and size of every root per codec")
+    codecs.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the fastest is reported")
+    codecs.add_argument(
+        "--codecs",
+        nargs="+",
+        choices=sorted(CODECS),
+        default=list(CODECS),
+        help="Codecs to compare (default: all installed)",
+    )
+    codecs.set_defaults(handler=bench_codecs)
+
+    compression = subparsers.add_parser("compression", help="Stored bytes vs CPU time per zlib level")
+    compression.add_argument(
+        "--levels",
+        nargs="+",
+        type=int,
+        choices=range(10),
+        default=[0, 1, 3, 6, 9],
+        help="zlib levels to compare; 0 means compression off (default: 0 1 3 6 9)",
+    )
+    compression.add_argument(
+        "--threshold",
+        type=int,
+        default=DEFAULT_COMPRESS_THRESHOLD,
+        help="Compress payloads of at least this many bytes (default: %(default)s)",
+    )
+    compression.add_argument("--repeat", type=int, default=3, help="Full rewrites of the data per level")
+    compression.set_defaults(handler=bench_compression)
+
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f"Database not found: {args.database}")
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,7 +18,11 @@ from datetime import datetime, timedelta
 import re
 import inspect
 import base64
-from local_db import initialize as init_local_db, db
+from local_db import initialize as init_local_db, db, WriteBehind, RecordMigrations
+from routing import CallbackRouter, CommandRegistry, PrefixTrie, make_callback_data
+from metrics import SORT_KEYS, HandlerMetrics, format_ms
+from locks import KeyedLocks, chat_key, user_id_key
+from ratelimit import RateLimit, RateLimiter
 
 try:
     from import_firebase_dump import import_nodes as _import_nodes_from_dump, normalize_structure as _normalize_from_dump
@@ -32,7 +36,7 @@ ENV_DB_PATH = os.getenv("MORPH_DB_PATH")
 DATASTORE_PATH = Path(ENV_DB_PATH).expanduser() if ENV_DB_PATH else DEFAULT_DB_PATH
 
 db_already_exists = DATASTORE_PATH.exists()
-init_local_db(DATASTORE_PATH)
+local_database = init_local_db(DATASTORE_PATH)
 
 AUTO_SEED = os.getenv("MORPH_AUTO_SEED", "0").lower() in {"1", "true", "yes", "on"}
 
@@ -73,6 +77,33 @@ if (
         except Exception:
             logging.exception("Failed to seed local database from %s", import_json_path)
 
+# Отложенная запись: save_* только помечают данные, а запись в базу идет пачкой
+try:
+    WRITE_BEHIND_INTERVAL = float(os.getenv("MORPH_FLUSH_INTERVAL", "1.0"))
+except ValueError:
+    logging.error("MORPH_FLUSH_INTERVAL должен быть числом секунд. Использую значение по умолчанию.")
+    WRITE_BEHIND_INTERVAL = 1.0
+try:
+    WRITE_BEHIND_BATCH = int(os.getenv("MORPH_FLUSH_BATCH", "256"))
+except ValueError:
+    logging.error("MORPH_FLUSH_BATCH должен быть целым числом. Использую значение по умолчанию.")
+    WRITE_BEHIND_BATCH = 256
+write_behind = WriteBehind(interval=WRITE_BEHIND_INTERVAL, max_batch=WRITE_BEHIND_BATCH)
+
+# Онлайн-бэкапы базы: копия идет постранично в отдельном соединении и не мешает записи
+try:
+    BACKUP_INTERVAL_HOURS = float(os.getenv("MORPH_BACKUP_INTERVAL", "24"))
+except ValueError:
+    logging.error("MORPH_BACKUP_INTERVAL должен быть числом часов. Использую значение по умолчанию.")
+    BACKUP_INTERVAL_HOURS = 24.0
+try:
+    BACKUP_KEEP = int(os.getenv("MORPH_BACKUP_KEEP", "7"))
+except ValueError:
+    logging.error("MORPH_BACKUP_KEEP должен быть целым числом. Использую значение по умолчанию.")
+    BACKUP_KEEP = 7
+ENV_BACKUP_DIR = os.getenv("MORPH_BACKUP_DIR")
+BACKUP_DIR = Path(ENV_BACKUP_DIR).expanduser() if ENV_BACKUP_DIR else DATASTORE_PATH.with_name("backups")
+
 users_ref = db.reference('users_data')
 bans_ref = db.reference('ban_list')
 promos_ref = db.reference('promocodes')
@@ -193,6 +224,38 @@ bot = Bot(token=TOKEN)
 dp = Dispatcher()
 router = Router()
 
+# Текстовые команды: точные алиасы в словаре, префиксы в дереве — один поиск на сообщение
+# вместо прохода по всем фильтрам. Кандидаты проверяются в порядке регистрации.
+text_commands = CommandRegistry()
+# Кнопки: новые игры кодируют данные как "игра:действие:аргументы" (таблица по игре и
+# действию, аргументы приходят в обработчик уже разобранными), старые — строки с префиксами.
+callbacks = CallbackRouter()
+
+# Действия одного игрока выполняются по очереди (баланс меняется между await),
+# разные игроки — параллельно. Блокировка удаляется, как только её никто не ждет.
+# Регистрируется раньше метрик: внешний middleware, так что ожидание блокировки не входит
+# в задержку обработчика, а считается отдельно в user_locks.stats().
+user_locks = KeyedLocks()
+router.message.middleware(user_locks)
+router.callback_query.middleware(user_locks)
+# Метрики обработчиков: вызовы, перцентили задержки, ошибки и время в базе и в API Telegram
+handler_metrics = HandlerMetrics()
+router.message.middleware(handler_metrics)
+router.callback_query.middleware(handler_metrics)
+bot.session.middleware(handler_metrics.api_middleware)
+handler_metrics.track_storage(
+    local_database,
+    'get', 'set', 'delete', 'get_child', 'get_children', 'child_keys', 'set_child', 'set_children',
+    'delete_child', 'read_versioned', 'set_expiry', 'clear_expiry', 'pop_expired',
+    'run_read', 'run_write', 'call_in_writer', 'submit_write',
+)
+handler_metrics.track_storage(write_behind, 'mark')
+try:
+    METRICS_LOG_INTERVAL = float(os.getenv("MORPH_METRICS_INTERVAL", "15"))
+except ValueError:
+    logging.error("MORPH_METRICS_INTERVAL должен быть числом минут. Использую значение по умолчанию.")
+    METRICS_LOG_INTERVAL = 15.0
+
 _creator_ids_env = os.getenv("MORPH_CREATOR_IDS")
 CREATOR_IDS: set[int] = set(ADMIN_IDS)
 if _creator_ids_env:
@@ -313,14 +376,8 @@ def get_next_transfer_cost(level: int) -> Optional[int]:
 
 
 def ensure_transfer_profile(user_id: int) -> None:
+    # Поля лимита переводов добавляет миграция профиля внутри init_user
     init_user(user_id)
-    data = users_data[user_id]
-    if 'transfer_limit_level' not in data:
-        data['transfer_limit_level'] = 0
-    if 'transfer_daily_spent' not in data:
-        data['transfer_daily_spent'] = 0
-    if 'transfer_daily_reset' not in data:
-        data['transfer_daily_reset'] = int(time.time())
 
 
 def reset_transfer_counters_if_needed(user_id: int) -> bool:
@@ -399,11 +456,7 @@ def is_game_disabled(game_code: str) -> bool:
 
 
 def save_disabled_games() -> None:
-    try:
-        payload = {"disabled_games": sorted(disabled_games)}
-        bot_settings_ref.update(payload)
-    except Exception as exc:
-        logging.error("Не удалось сохранить список отключенных игр: %s", exc, exc_info=True)
+    write_behind.mark('bot_settings/disabled_games', lambda: sorted(disabled_games))
 
 
 def build_games_control_view() -> tuple[str, InlineKeyboardMarkup]:
@@ -467,7 +520,7 @@ def _ensure_game_allowed(game_code: str, message: types.Message) -> bool:
     return True
 
 
-@router.message(lambda message: message.text and message.text.lower().startswith('игроконтроль'))
+@text_commands.prefix('игроконтроль')
 async def admin_games_control(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -480,7 +533,8 @@ async def admin_games_control(message: types.Message):
     await message.reply(text, reply_markup=markup, parse_mode="HTML")
 
 
-@router.callback_query(lambda c: c.data.startswith('toggle_game_') or c.data == 'games_control_refresh')
+@callbacks.exact('games_control_refresh')
+@callbacks.prefix('toggle_game_')
 async def toggle_game_callback(callback: CallbackQuery):
     if callback.from_user.id not in CREATOR_IDS:
         await callback.answer("⛔ Нет доступа!", show_alert=True)
@@ -517,82 +571,53 @@ user_daily_actions: Dict[int, Dict] = {}  # {user_id: {'count': 0, 'date': '2025
 user_bonus_reminder_sent: Dict[int, str] = {}  # {user_id: '2025-12-05'}
 user_bonus_reminder_enabled: Dict[int, bool] = {}  # {user_id: True/False}
 game_feedback: Dict[int, Dict] = {}  # {user_id: {'game': 'mines', 'message_id': 123}}
-user_game_history: Dict[int, List] = {}  # {user_id: [{'game': 'название', 'bet': 1000, 'result': 'win/lose', 'amount': 2000, 'time': '2025-12-05 12:00:00'}]}
-game_history_ref = db.reference('game_history')
+# История игр хранится в append-only таблице: [{'game': 'название', 'bet': 1000, 'result': 'win/lose', 'amount': 2000, 'time': '2025-12-05 12:00:00'}]
+game_history_log = db.history('game_history')
+handler_metrics.track_storage(game_history_log, 'append', 'recent', 'delete')
+GAME_HISTORY_KEEP = 50
 pending_transfers: Dict[int, Dict] = {}  # {user_id: {'item_id': item_id, 'count': count, 'timestamp': time, 'item_name': name, 'item_emoji': emoji}}
 user_inventory: Dict[int, Dict] = {}  # {user_id: {'items': {item_id: count}, 'last_updated': 'timestamp'}}
 user_collection: Dict[int, Dict] = {}  # {user_id: {'items': [item_id, ...], 'last_updated': 'timestamp'}}
 
 # --- Функции сохранения данных в локальное хранилище ---
+# Ошибки записи логируются в write_behind.flush(), а данные остаются помеченными до следующей попытки
 def save_users():
-    try:
-        users_to_save = {str(k): v for k, v in users_data.items()}
-        users_ref.set(users_to_save)
-        logging.debug(f"Пользователи сохранены: {len(users_to_save)}")
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении users_data: {e}", exc_info=True)
+    """Перезаписывает всех пользователей; только для массовых изменений (сброс всех)"""
+    write_behind.mark('users_data', lambda: {str(k): v for k, v in users_data.items()})
+
+def save_user(user_id: int):
+    """Помечает для записи только одного пользователя (дешевле, чем save_users)"""
+    write_behind.mark(f'users_data/{user_id}', lambda: users_data.get(user_id))
 
 def save_leaderboard():
-    try:
-        leaderboard_ref.set({
-            'date': leaderboard_date,
-            'data': {str(k): v for k, v in daily_leaderboard.items()}
-        })
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении leaderboard: {e}", exc_info=True)
+    write_behind.mark('daily_leaderboard', lambda: {
+        'date': leaderboard_date,
+        'data': {str(k): v for k, v in daily_leaderboard.items()}
+    })
 
 def save_vip_subscriptions():
-    try:
-        vip_subscriptions_ref.set({str(k): v for k, v in vip_subscriptions.items()})
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении vip_subscriptions: {e}", exc_info=True)
+    write_behind.mark('vip_subscriptions', lambda: {str(k): v for k, v in vip_subscriptions.items()})
 
 def save_promocodes():
-    try:
-        promos_ref.set(promocodes)
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении promocodes: {e}", exc_info=True)
+    write_behind.mark('promocodes', lambda: promocodes)
 
 
 def save_promo_broadcasts():
-    try:
-        promo_broadcast_ref.set({str(k): v for k, v in promo_broadcasts.items()})
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении promo_broadcasts: {e}", exc_info=True)
+    write_behind.mark('promo_broadcasts', lambda: {str(k): v for k, v in promo_broadcasts.items()})
 
 
 def save_user_languages():
-    try:
-        payload = {str(k): v for k, v in user_languages.items()}
-        user_languages_ref.set(payload)
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении user_languages: {e}", exc_info=True)
+    write_behind.mark('user_languages', lambda: {str(k): v for k, v in user_languages.items()})
 
 def save_marriages():
-    try:
-        marriages_ref.set({str(k): v for k, v in marriages.items()})
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении marriages: {e}", exc_info=True)
-
-def save_game_history():
-    try:
-        game_history_ref.set({str(k): v for k, v in user_game_history.items()})
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении game_history: {e}", exc_info=True)
+    write_behind.mark('marriages', lambda: {str(k): v for k, v in marriages.items()})
 
 def save_fast_promos():
-    try:
-        FAST_PROMO_REF.set({str(k): v for k, v in active_fast_promos.items()})
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении fast_promos: {e}", exc_info=True)
+    write_behind.mark('fast_promocodes', lambda: {str(k): v for k, v in active_fast_promos.items()})
 
 
 def save_avatars():
-    try:
-        payload = {str(k): v for k, v in user_avatars.items()}
-        avatars_ref.set(payload)
-    except Exception as exc:
-        logging.error("Ошибка при сохранении user_avatars: %s", exc, exc_info=True)
+    write_behind.mark('user_avatars', lambda: {str(k): v for k, v in user_avatars.items()})
 
 # Система модерации чатов
 chat_moderators: Dict[int, Dict[int, int]] = {}  # {chat_id: {user_id: rank}}
@@ -662,23 +687,20 @@ games_text = (
         "<i>Выберите игру и начинайте играть! Удачи! 🍀</i>"
     )
 
+def _inventory_snapshot() -> dict:
+    inventory_to_save = {}
+    for user_id, user_data in user_inventory.items():
+        if 'items' not in user_data:
+            user_data['items'] = {}
+        inventory_to_save[str(user_id)] = user_data
+    return inventory_to_save
+
 def save_user_inventory():
-    """Сохраняет `user_inventory` в локальную базу."""
-    try:
-        inventory_to_save = {}
-        for user_id, user_data in user_inventory.items():
-            if 'items' not in user_data:
-                user_data['items'] = {}
-            inventory_to_save[str(user_id)] = user_data
-
-        user_inventory_ref.set(inventory_to_save)
-        logging.debug(f"Инвентарь успешно сохранен: {len(inventory_to_save)} пользователей")
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении инвентаря: {e}", exc_info=True)
-        raise
+    """Помечает `user_inventory` для записи в локальную базу."""
+    write_behind.mark('user_inventory', _inventory_snapshot)
 
 def save_user_collection():
-    user_collection_ref.set({str(k): v for k, v in user_collection.items()})
+    write_behind.mark('user_collection', lambda: {str(k): v for k, v in user_collection.items()})
 
 # Добавьте после других Firebase ссылок
 treasury_ref = db.reference('chat_treasury')
@@ -701,8 +723,8 @@ def init_chat_treasury(chat_id: int):
         save_chat_treasury()
 
 def save_chat_treasury():
-    """Сохраняет казну чата в локальное хранилище"""
-    treasury_ref.set({str(k): v for k, v in chat_treasury.items()})
+    """Помечает казну чата для записи в локальное хранилище"""
+    write_behind.mark('chat_treasury', lambda: {str(k): v for k, v in chat_treasury.items()})
 
 # --- HiLo helpers ---
 HILO_SUITS = ['❤️', '♦️', '♣️', '♠️']
@@ -806,33 +828,46 @@ except ValueError:
 
 # Удалить все импорты и функции, связанные с локальными файлами и отдельными save_* функциями (например, from firebase_config import ... и т.д.)
 
-# Словарь для отслеживания кулдаунов команд
-command_cooldowns = {}
+# Лимиты команд: token bucket на пару (игрок, команда). RateLimit(1, 2) — один вызов раз
+# в 2 секунды, RateLimit(3, 10) — три подряд, затем по одному раз в 10 секунд.
+# Заполнившиеся корзины удаляются, поэтому память зависит только от недавно активных игроков.
+DEFAULT_COMMAND_LIMIT = RateLimit(1, 2)
+COMMAND_RATE_LIMITS = {
+    "user_agreement": RateLimit(1, 5),
+    "stock_top": RateLimit(1, 10),
+}
+command_limiter = RateLimiter(DEFAULT_COMMAND_LIMIT, COMMAND_RATE_LIMITS)
 
 # Отложенные подтверждения для покупки лимита переводов
 transfer_limit_requests: Dict[int, Dict] = {}
 
-# Функция для проверки кулдауна команды
-def check_cooldown(user_id: int, command: str, cooldown_seconds: int = 2) -> bool:
-    current_time = time.time()
-    key = f"{user_id}_{command}"
-    
-    if key in command_cooldowns:
-        if current_time - command_cooldowns[key] < cooldown_seconds:
-            return False
-    
-    command_cooldowns[key] = current_time
-    return True
+# Функция для проверки кулдауна команды (лимиты команд — в COMMAND_RATE_LIMITS)
+def check_cooldown(user_id: int, command) -> bool:
+    return command_limiter.allow(user_id, command)
 
 
-def tax_command_filter(message: types.Message) -> bool:
-    if not message.text:
-        return False
-    normalized = message.text.lower().strip()
-    return normalized in {"собрать налоги", "налоги", "налоги собрать", "сбор налогов"}
+# --- Версионные миграции записей ---
+# Каждая запись хранит schema_version; недостающие шаги применяются один раз — при первом
+# обращении или фоновым проходом, — а горячий путь только сравнивает номер версии.
+user_migrations = RecordMigrations()
+city_migrations = RecordMigrations()
+avatar_migrations = RecordMigrations()
 
 
-def ensure_city_tax_timers(city: Dict) -> Tuple[float, float]:
+@user_migrations.step
+def _user_v1(user: Dict) -> None:
+    """Реферальные поля, лимиты переводов и таймер VIP-фриспина"""
+    user.setdefault('referrer_id', None)
+    user.setdefault('referrals', [])
+    user.setdefault('transfer_limit_level', 0)
+    user.setdefault('transfer_daily_spent', 0)
+    user.setdefault('transfer_daily_reset', int(time.time()))
+    user.setdefault('last_vip_freespin', 0)
+
+
+@city_migrations.step
+def _city_v1(city: Dict) -> None:
+    """Налоговые таймеры в виде timestamp вместо строки last_claim"""
     current_time = time.time()
     last_claim_ts = city.get('last_claim_ts')
     if last_claim_ts is None:
@@ -846,15 +881,24 @@ def ensure_city_tax_timers(city: Dict) -> Tuple[float, float]:
             last_claim_ts = current_time - 24 * 3600
         city['last_claim_ts'] = last_claim_ts
 
-    next_tax_ts = city.get('next_tax_time')
-    if next_tax_ts is None:
-        next_tax_ts = last_claim_ts + 24 * 3600
-        city['next_tax_time'] = next_tax_ts
+    if city.get('next_tax_time') is None:
+        city['next_tax_time'] = last_claim_ts + 24 * 3600
+
+
+@avatar_migrations.step
+def _avatar_v1(avatar):
+    """Старый формат — только file_id — превращается в словарь"""
+    if not isinstance(avatar, dict):
+        return {'file_id': avatar, 'type': 'photo'}
 
-    return float(last_claim_ts), float(next_tax_ts)
+
+def ensure_city_tax_timers(city: Dict) -> Tuple[float, float]:
+    if city.get('schema_version') != city_migrations.latest:
+        city_migrations.upgrade(city)
+    return float(city['last_claim_ts']), float(city['next_tax_time'])
 
 def load_all_data():
-    global users_data, banned_users, promocodes, roulette_bets, chat_treasury, user_cities, user_stocks, stock_prices, city_names, user_game_history, marriages, user_avatars, daily_leaderboard, leaderboard_date, chat_moderators, chat_mutes, chat_rules, chat_bans, vip_subscriptions, user_inventory, user_collection, disabled_games, promo_broadcasts, user_languages
+    global users_data, banned_users, promocodes, roulette_bets, chat_treasury, user_cities, user_stocks, stock_prices, city_names, marriages, user_avatars, daily_leaderboard, leaderboard_date, chat_moderators, chat_mutes, chat_rules, chat_bans, vip_subscriptions, user_inventory, user_collection, disabled_games, promo_broadcasts, user_languages
     
     # Загружаем все данные из локального хранилища
     users_data = users_ref.get() or {}
@@ -867,7 +911,6 @@ def load_all_data():
     user_cities = cities_ref.get() or {}
     user_stocks = stocks_ref.get() or {}
     stock_prices = stock_prices_ref.get() or {}
-    user_game_history = game_history_ref.get() or {}
     marriages = marriages_ref.get() or {}
     user_avatars = avatars_ref.get() or {}
     leaderboard_data = leaderboard_ref.get() or {}
@@ -895,30 +938,15 @@ def load_all_data():
     # Привести ключи к int
     users_data = {int(k): v for k, v in users_data.items()}
     chat_treasury = {int(k): v for k, v in chat_treasury.items()}
-    cities_updated = False
+    # Города мигрируют лениво (ensure_city_tax_timers) и фоновым проходом
     user_cities = {int(k): v for k, v in user_cities.items()}
-    for city in user_cities.values():
-        if isinstance(city, dict):
-            prev_last_ts = city.get('last_claim_ts')
-            prev_next_ts = city.get('next_tax_time')
-            ensure_city_tax_timers(city)
-            if prev_last_ts is None or prev_next_ts is None:
-                cities_updated = True
-    if cities_updated:
-        save_cities()
     user_stocks = {int(k): v for k, v in user_stocks.items()}
-    user_game_history = {int(k): v for k, v in user_game_history.items()}
     marriages = {int(k): v for k, v in marriages.items()}
-    # Обрабатываем аватары - поддерживаем старый формат (только file_id) и новый (dict)
-    processed_avatars = {}
-    for k, v in user_avatars.items():
-        if isinstance(v, dict):
-            # Новый формат - уже dict
-            processed_avatars[int(k)] = v
-        else:
-            # Старый формат - только file_id, конвертируем в новый формат
-            processed_avatars[int(k)] = {'file_id': v, 'type': 'photo'}
-    user_avatars = processed_avatars
+    # Аватары старого формата (только file_id) поднимает миграция; результат сохраняется,
+    # поэтому при следующих запусках остаётся только сравнение версий
+    user_avatars = {int(k): v for k, v in user_avatars.items()}
+    if avatar_migrations.upgrade_all(user_avatars):
+        save_avatars()
     # Модераторы: {chat_id: {user_id: rank}}
     chat_moderators = {int(k): {int(uk): uv for uk, uv in v.items()} if isinstance(v, dict) else {} for k, v in chat_moderators.items()}
     # Муты: {chat_id: {user_id: end_timestamp}}
@@ -942,6 +970,14 @@ def load_all_data():
         del vip_subscriptions[uid]
     if expired_vips:
         save_vip_subscriptions()
+
+    # Сроки мутов и VIP хранятся в индексе истечения базы: планировщик забирает только наступившие
+    with db.transaction():
+        for chat_id, mutes in chat_mutes.items():
+            for user_id, end_time in mutes.items():
+                mutes_ref.child(str(chat_id)).child(str(user_id)).set_expiry(end_time)
+        for uid, end_time in vip_subscriptions.items():
+            vip_subscriptions_ref.child(str(uid)).set_expiry(end_time)
     
     # Инвентарь: {user_id: {'items': {item_id: count}, ...}}
     user_inventory = {int(k): v for k, v in user_inventory.items()}
@@ -987,7 +1023,8 @@ def init_user(user_id: int, username: str = None, referrer_id: int = None):
             'transfer_limit_level': 0,
             'transfer_daily_spent': 0,
             'transfer_daily_reset': int(time.time()),
-            'last_vip_freespin': 0
+            'last_vip_freespin': 0,
+            'schema_version': user_migrations.latest
         }
         # Инициализируем инвентарь и коллекцию для нового пользователя
         if user_id not in user_inventory:
@@ -1004,23 +1041,17 @@ def init_user(user_id: int, username: str = None, referrer_id: int = None):
             save_user_collection()
         # Если есть реферер, добавляем бонус и записываем в его список рефералов
         if referrer_id and referrer_id in users_data:
+            if users_data[referrer_id].get('schema_version') != user_migrations.latest:
+                user_migrations.upgrade(users_data[referrer_id])
             users_data[referrer_id]['balance'] += 1000
             users_data[referrer_id]['referrals'].append(user_id)
-            save_users()
+            save_user(referrer_id)
+            save_user(user_id)
     else:
-        # Добавляем недостающие поля для существующих пользователей
-        if 'referrer_id' not in users_data[user_id]:
-            users_data[user_id]['referrer_id'] = None
-        if 'referrals' not in users_data[user_id]:
-            users_data[user_id]['referrals'] = []
-        if 'transfer_limit_level' not in users_data[user_id]:
-            users_data[user_id]['transfer_limit_level'] = 0
-        if 'transfer_daily_spent' not in users_data[user_id]:
-            users_data[user_id]['transfer_daily_spent'] = 0
-        if 'transfer_daily_reset' not in users_data[user_id]:
-            users_data[user_id]['transfer_daily_reset'] = int(time.time())
-        if 'last_vip_freespin' not in users_data[user_id]:
-            users_data[user_id]['last_vip_freespin'] = 0
+        # Недостающие поля добавляет миграция профиля, здесь только сравнение версии
+        if users_data[user_id].get('schema_version') != user_migrations.latest:
+            user_migrations.upgrade(users_data[user_id])
+            save_user(user_id)
         if username and users_data[user_id].get('username') != username:
             users_data[user_id]['username'] = username
 
@@ -1187,10 +1218,25 @@ async def cmd_start(message: types.Message):
     else:
         await message.reply(welcome_text, parse_mode="HTML")
 
-# Обработка нажатий на кнопки
-@router.message(lambda message: message.text in [
+# Единственный хендлер для всех текстовых команд из text_commands. Регистрируется после /start,
+# чтобы сохранить прежний порядок: /start обрабатывается раньше диалога создания города.
+@router.message(text_commands)
+async def dispatch_text_command(message: types.Message, command_handler):
+    await command_handler(message)
+
+@router.callback_query(callbacks)
+async def dispatch_callback(callback: CallbackQuery, callback_handler, callback_args):
+    await callback_handler(callback, *callback_args)
+
+MAIN_MENU_BUTTONS = (
     "🎄 Игры", "💎 Баланс", "🎁 Зимний бонус", "🧑\u200d🎄 Профиль", "🎁 Праздничная рефка", "❄️ Помощь"
-])
+)
+
+# Обработка нажатий на кнопки (текст кнопки сравнивается с учетом регистра)
+@text_commands.exact(
+    *(button.lower() for button in MAIN_MENU_BUTTONS),
+    when=lambda message: message.text in MAIN_MENU_BUTTONS,
+)
 async def handle_button_click(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -1202,7 +1248,7 @@ async def handle_button_click(message: types.Message):
     if message.chat.type != 'private':
         return
     
-    if not check_cooldown(user_id, f"button_{button_text}"):
+    if not check_cooldown(user_id, ("button", button_text)):
         return
     
     if button_text == "🎄 Игры":
@@ -1251,7 +1297,7 @@ async def handle_bonus_button(message: types.Message):
     users_data[user_id]['last_bonus_time'] = current_time
     users_data[user_id]['total_bonuses_received'] = users_data[user_id].get('total_bonuses_received', 0) + bonus_amount
     
-    save_users()
+    save_user(user_id)
     
     await message.reply(
         f"🎁 <b>Ежедневный бонус получен!</b>\n\n"
@@ -1262,7 +1308,7 @@ async def handle_bonus_button(message: types.Message):
         parse_mode="HTML"
     )
 
-@router.message(lambda message: message.text and message.text.lower() in ["помощь", "help"])
+@text_commands.exact("помощь", "help")
 async def cmd_help(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -1298,7 +1344,7 @@ def _format_help_section(title: str, lines: List[str]) -> str:
     return f"<blockquote>{body}</blockquote>"
 
 # Обработка callback для help
-@router.callback_query(lambda c: c.data.startswith("help_") and c.data != "help_back")
+@callbacks.prefix("help_", when=lambda c: c.data != "help_back")
 async def help_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -1538,12 +1584,12 @@ async def help_callback(callback: CallbackQuery):
     )
 
 
-@router.message(lambda message: message.text and message.text.lower() in ["пользовательское соглашение", "соглашение", "agreement"])
+@text_commands.exact("пользовательское соглашение", "соглашение", "agreement")
 async def cmd_user_agreement(message: types.Message):
     if is_banned(message.from_user.id):
         return
     user_id = message.from_user.id
-    if not check_cooldown(user_id, "user_agreement", 5):
+    if not check_cooldown(user_id, "user_agreement"):
         return
 
     agreement_lines = [
@@ -1562,7 +1608,7 @@ async def cmd_user_agreement(message: types.Message):
     await message.reply(agreement_text, parse_mode="HTML")
 
 # --- Кнопка "Назад" в помощи ---
-@router.callback_query(lambda c: c.data == "help_back")
+@callbacks.exact("help_back")
 async def help_back(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -1577,7 +1623,7 @@ async def help_back(callback: CallbackQuery):
     await callback.message.edit_text("<b>❓ Выберите раздел помощи:</b>", reply_markup=builder.as_markup(), parse_mode="HTML")
 
 # Команда для показа всех игр
-@router.message(lambda message: message.text and message.text.lower() in ["игры", "games", "все игры"])
+@text_commands.exact("игры", "games", "все игры")
 async def cmd_all_games(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -1638,23 +1684,21 @@ async def cmd_all_games(message: types.Message):
     await message.reply(games_text, parse_mode="HTML")
 
 # Команда кейсы — отключаем систему кейсов, оставляем сообщение
-@router.message(lambda message: message.text and message.text.lower() in ["кейсы", "кейс"])
+@text_commands.exact("кейсы", "кейс")
 async def cmd_cases(message: types.Message):
     if is_banned(message.from_user.id):
         return
     await message.reply("Доступных кейсов в данный момент нету")
 
 # Команды для отключения/включения ежедневного напоминания о бонусе
-@router.message(lambda message: message.text and message.text.lower() in [
-    "отключить напоминание бонуса", "выключить напоминание бонуса", "напоминание бонуса выкл"])
+@text_commands.exact("отключить напоминание бонуса", "выключить напоминание бонуса", "напоминание бонуса выкл")
 async def disable_bonus_reminder(message: types.Message):
     user_id = message.from_user.id
     init_user(user_id, message.from_user.username)
     user_bonus_reminder_enabled[user_id] = False
     await message.reply("✅ Ежедневные напоминания о бонусе отключены")
 
-@router.message(lambda message: message.text and message.text.lower() in [
-    "включить напоминание бонуса", "вкл напоминание бонуса", "напоминание бонуса вкл"])
+@text_commands.exact("включить напоминание бонуса", "вкл напоминание бонуса", "напоминание бонуса вкл")
 async def enable_bonus_reminder(message: types.Message):
     user_id = message.from_user.id
     init_user(user_id, message.from_user.username)
@@ -1662,7 +1706,7 @@ async def enable_bonus_reminder(message: types.Message):
     await message.reply("✅ Ежедневные напоминания о бонусе включены")
 
 # Команда обнулить всех игроков
-@router.message(lambda message: message.text and message.text.lower().startswith('обнулить всех'))
+@text_commands.prefix('обнулить всех')
 async def admin_reset_all(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -1686,7 +1730,7 @@ async def admin_reset_all(message: types.Message):
     )
 
 # Обработчик подтверждения обнуления всех
-@router.callback_query(lambda c: c.data in ["confirm_reset_all", "cancel_reset_all"])
+@callbacks.exact("confirm_reset_all", "cancel_reset_all")
 async def handle_reset_all_confirmation(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("⛔ Нет прав!", show_alert=True)
@@ -1761,7 +1805,7 @@ def build_sniper_keyboard() -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-@router.message(lambda message: message.text and message.text.lower().startswith("снайпер"))
+@text_commands.prefix("снайпер")
 async def cmd_sniper(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -1801,7 +1845,7 @@ async def cmd_sniper(message: types.Message):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем игру
     active_sniper_games[user_id] = {
@@ -1825,7 +1869,7 @@ async def cmd_sniper(message: types.Message):
     
     active_sniper_games[user_id]['message_id'] = msg.message_id
 
-@router.callback_query(lambda c: c.data.startswith("sniper_zone_"))
+@callbacks.prefix("sniper_zone_")
 async def sniper_zone_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -1875,7 +1919,7 @@ async def sniper_zone_callback(callback: CallbackQuery):
         add_win_to_user(user_id, win, game['bet'])
         add_game_to_history(user_id, 'Снайпер', game['bet'], 'win', win)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🎯 <b>ПОПАДАНИЕ!</b>\n\n"
@@ -1889,7 +1933,7 @@ async def sniper_zone_callback(callback: CallbackQuery):
         # Проигрыш
         add_game_to_history(user_id, 'Снайпер', game['bet'], 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"❌ <b>ПРОМАХ!</b>\n\n"
@@ -1946,7 +1990,7 @@ async def sniper_zone_callback(callback: CallbackQuery):
     await callback.answer()
 
 
-@router.callback_query(lambda c: c.data == "sniper_result")
+@callbacks.exact("sniper_result")
 async def sniper_result_callback(callback: CallbackQuery):
     await callback.answer("Игра завершена!", show_alert=True)
 
@@ -1962,12 +2006,12 @@ def build_tides_keyboard() -> InlineKeyboardMarkup:
     """Создаёт клавиатуру для выбора прилива/отлива"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="🌊 Прилив", callback_data="tides_high"),
-            InlineKeyboardButton(text="🏖️ Отлив", callback_data="tides_low")
+            InlineKeyboardButton(text="🌊 Прилив", callback_data=make_callback_data("tides", "choose", "high")),
+            InlineKeyboardButton(text="🏖️ Отлив", callback_data=make_callback_data("tides", "choose", "low"))
         ]
     ])
 
-@router.message(lambda message: message.text and message.text.lower().startswith("приливы"))
+@text_commands.prefix("приливы")
 async def cmd_tides(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -2004,7 +2048,7 @@ async def cmd_tides(message: types.Message):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем игру
     active_tides_games[user_id] = {
@@ -2031,8 +2075,8 @@ async def cmd_tides(message: types.Message):
     
     active_tides_games[user_id]['message_id'] = msg.message_id
 
-@router.callback_query(lambda c: c.data.startswith("tides_"))
-async def tides_choice_callback(callback: CallbackQuery):
+@callbacks.action("tides", "choose", str)
+async def tides_choice_callback(callback: CallbackQuery, choice: str):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
         return
@@ -2057,7 +2101,6 @@ async def tides_choice_callback(callback: CallbackQuery):
     # Помечаем, что выбор обрабатывается
     game['processing'] = True
     
-    choice = callback.data.split("_")[-1]  # high или low
     if choice not in ['high', 'low']:
         await callback.answer("❌ Неверный выбор!", show_alert=True)
         return
@@ -2116,42 +2159,44 @@ async def tides_game_loop(user_id: int, bot: Bot):
         # Простая логика: если множитель > 2.5, это "прилив", иначе "отлив"
         actual_phase = "high" if final_multiplier > 2.5 else "low"
         
-        if game['choice'] == actual_phase:
-            # Выигрыш
-            win = int(game['bet'] * final_multiplier)
+        async with user_locks.hold(user_id_key(user_id)):
+            if game['choice'] == actual_phase:
+                # Выигрыш
+                win = int(game['bet'] * final_multiplier)
             
-            users_data[user_id]['balance'] += win
-            add_win_to_user(user_id, win, game['bet'])
-            add_game_to_history(user_id, 'Приливы', game['bet'], 'win', win)
-            users_data[user_id]['games_played'] += 1
-            save_users()
+                users_data[user_id]['balance'] += win
+                add_win_to_user(user_id, win, game['bet'])
+                add_game_to_history(user_id, 'Приливы', game['bet'], 'win', win)
+                users_data[user_id]['games_played'] += 1
+                save_user(user_id)
             
-            result_text = (
-                f"🌊 <b>ВЫИГРЫШ!</b>\n\n"
-                f"🎯 Ваш выбор: {'🌊 Прилив' if game['choice'] == 'high' else '🏖️ Отлив'}\n"
-                f"🌊 Реальная фаза: {'🌊 Прилив' if actual_phase == 'high' else '🏖️ Отлив'}\n"
-                f"📈 Финальный множитель: x{final_multiplier}\n"
-                f"💰 Выигрыш: {format_amount(win)} MORPH\n\n"
-                f"🎉 Поздравляем с правильным предсказанием!"
-            )
-        else:
-            # Проигрыш
-            add_game_to_history(user_id, 'Приливы', game['bet'], 'lose', 0)
-            users_data[user_id]['games_played'] += 1
-            save_users()
+                result_text = (
+                    f"🌊 <b>ВЫИГРЫШ!</b>\n\n"
+                    f"🎯 Ваш выбор: {'🌊 Прилив' if game['choice'] == 'high' else '🏖️ Отлив'}\n"
+                    f"🌊 Реальная фаза: {'🌊 Прилив' if actual_phase == 'high' else '🏖️ Отлив'}\n"
+                    f"📈 Финальный множитель: x{final_multiplier}\n"
+                    f"💰 Выигрыш: {format_amount(win)} MORPH\n\n"
+                    f"🎉 Поздравляем с правильным предсказанием!"
+                )
+            else:
+                # Проигрыш
+                add_game_to_history(user_id, 'Приливы', game['bet'], 'lose', 0)
+                users_data[user_id]['games_played'] += 1
+                save_user(user_id)
             
-            result_text = (
-                f"🌊 <b>ПРОИГРЫШ!</b>\n\n"
-                f"🎯 Ваш выбор: {'🌊 Прилив' if game['choice'] == 'high' else '🏖️ Отлив'}\n"
-                f"🌊 Реальная фаза: {'🌊 Прилив' if actual_phase == 'high' else '🏖️ Отлив'}\n"
-                f"📈 Финальный множитель: x{final_multiplier}\n"
-                f"💸 Проигрыш: {format_amount(game['bet'])} MORPH\n\n"
-                f"🌊 В следующий раз повезёт больше!"
-            )
+                result_text = (
+                    f"🌊 <b>ПРОИГРЫШ!</b>\n\n"
+                    f"🎯 Ваш выбор: {'🌊 Прилив' if game['choice'] == 'high' else '🏖️ Отлив'}\n"
+                    f"🌊 Реальная фаза: {'🌊 Прилив' if actual_phase == 'high' else '🏖️ Отлив'}\n"
+                    f"📈 Финальный множитель: x{final_multiplier}\n"
+                    f"💸 Проигрыш: {format_amount(game['bet'])} MORPH\n\n"
+                    f"🌊 В следующий раз повезёт больше!"
+                )
         
         # Показываем результат с кнопкой для новой игры
+        tides_restart_bets[user_id] = game['bet']
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Играть снова", callback_data=f"tides_restart_{game['bet']}")]
+            [InlineKeyboardButton(text="🔄 Играть снова", callback_data=make_callback_data("tides", "restart"))]
         ])
         
         try:
@@ -2168,8 +2213,9 @@ async def tides_game_loop(user_id: int, bot: Bot):
     except Exception as exc:
         logging.error("Ошибка в цикле игры Приливы: %s", exc, exc_info=True)
         # Возвращаем ставку при ошибке
-        users_data[user_id]['balance'] += game['bet']
-        save_users()
+        async with user_locks.hold(user_id_key(user_id)):
+            users_data[user_id]['balance'] += game['bet']
+            save_user(user_id)
         
         try:
             await bot.send_message(
@@ -2187,7 +2233,7 @@ async def tides_game_loop(user_id: int, bot: Bot):
         # Удаляем игру
         active_tides_games.pop(user_id, None)
 
-@router.callback_query(lambda c: c.data.startswith("tides_restart_"))
+@callbacks.action("tides", "restart")
 async def tides_restart_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -2200,11 +2246,9 @@ async def tides_restart_callback(callback: CallbackQuery):
         await callback.answer("⏳ Вы уже играете в Приливы!", show_alert=True)
         return
     
-    # Получаем ставку из callback_data
-    try:
-        bet = int(callback.data.split("_")[-1])
-    except (ValueError, IndexError):
-        await callback.answer("❌ Ошибка ставки!", show_alert=True)
+    bet = tides_restart_bets.get(user_id)
+    if bet is None:
+        await callback.answer("❌ Игра не найдена!", show_alert=True)
         return
     
     # Проверяем баланс
@@ -2220,7 +2264,8 @@ async def tides_restart_callback(callback: CallbackQuery):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
+    tides_restart_bets.pop(user_id, None)
     
     # Создаем новую игру
     active_tides_games[user_id] = {
@@ -2254,7 +2299,7 @@ async def tides_restart_callback(callback: CallbackQuery):
         logging.error("Ошибка при запуске новой игры Приливы: %s", exc, exc_info=True)
         # Возвращаем ставку при ошибке
         users_data[user_id]['balance'] += bet
-        save_users()
+        save_user(user_id)
         active_tides_games.pop(user_id, None)
         return
     
@@ -2288,7 +2333,7 @@ def build_oracle_keyboard() -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-@router.message(lambda message: message.text and message.text.lower().startswith("оракул"))
+@text_commands.prefix("оракул")
 async def cmd_oracle(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -2331,7 +2376,7 @@ async def cmd_oracle(message: types.Message):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем игру
     active_oracle_games[user_id] = {
@@ -2355,7 +2400,7 @@ async def cmd_oracle(message: types.Message):
     
     active_oracle_games[user_id]['message_id'] = msg.message_id
 
-@router.callback_query(lambda c: c.data.startswith("oracle_symbol_"))
+@callbacks.prefix("oracle_symbol_")
 async def oracle_symbol_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -2405,7 +2450,7 @@ async def oracle_symbol_callback(callback: CallbackQuery):
         add_win_to_user(user_id, win, game['bet'])
         add_game_to_history(user_id, 'Оракул', game['bet'], 'win', win)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🔮 <b>ВЫИГРЫШ!</b>\n\n"
@@ -2420,7 +2465,7 @@ async def oracle_symbol_callback(callback: CallbackQuery):
         # Проигрыш
         add_game_to_history(user_id, 'Оракул', game['bet'], 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🔮 <b>ПРОИГРЫШ!</b>\n\n"
@@ -2477,7 +2522,7 @@ def generate_masquerade_result() -> int:
             return i
     return len(MASQUERADE_CHARACTERS) - 1
 
-@router.message(lambda message: message.text and message.text.lower().startswith("маскарад"))
+@text_commands.prefix("маскарад")
 async def cmd_masquerade(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -2517,7 +2562,7 @@ async def cmd_masquerade(message: types.Message):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем игру
     active_masquerade_games[user_id] = {
@@ -2542,7 +2587,7 @@ async def cmd_masquerade(message: types.Message):
     
     active_masquerade_games[user_id]['message_id'] = msg.message_id
 
-@router.callback_query(lambda c: c.data.startswith("masquerade_choice_"))
+@callbacks.prefix("masquerade_choice_")
 async def masquerade_choice_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -2592,7 +2637,7 @@ async def masquerade_choice_callback(callback: CallbackQuery):
         add_win_to_user(user_id, win, game['bet'])
         add_game_to_history(user_id, 'Маскарад', game['bet'], 'win', win)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🎭 <b>ВЫИГРЫШ!</b>\n\n"
@@ -2606,7 +2651,7 @@ async def masquerade_choice_callback(callback: CallbackQuery):
         # Проигрыш
         add_game_to_history(user_id, 'Маскарад', game['bet'], 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🎭 <b>ПРОИГРЫШ!</b>\n\n"
@@ -2663,7 +2708,7 @@ def generate_carnival_result() -> int:
             return i
     return len(CARNIVAL_TARGETS) - 1
 
-@router.message(lambda message: message.text and message.text.lower().startswith("карнавал"))
+@text_commands.prefix("карнавал")
 async def cmd_carnival(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -2702,7 +2747,7 @@ async def cmd_carnival(message: types.Message):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем игру
     active_carnival_games[user_id] = {
@@ -2727,7 +2772,7 @@ async def cmd_carnival(message: types.Message):
     
     active_carnival_games[user_id]['message_id'] = msg.message_id
 
-@router.callback_query(lambda c: c.data.startswith("carnival_choice_"))
+@callbacks.prefix("carnival_choice_")
 async def carnival_choice_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -2777,7 +2822,7 @@ async def carnival_choice_callback(callback: CallbackQuery):
         add_win_to_user(user_id, win, game['bet'])
         add_game_to_history(user_id, 'Карнавал', game['bet'], 'win', win)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🎪 <b>ПОПАДАНИЕ!</b>\n\n"
@@ -2791,7 +2836,7 @@ async def carnival_choice_callback(callback: CallbackQuery):
         # Промах
         add_game_to_history(user_id, 'Карнавал', game['bet'], 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_text = (
             f"🎪 <b>ПРОМАХ!</b>\n\n"
@@ -2843,7 +2888,7 @@ def get_dice_emoji(value: int) -> str:
 # Глобальная блокировка для Баккары
 baccarat_lock = asyncio.Lock()
 
-@router.message(lambda message: message.text and message.text.lower().startswith(("баккара", "бк")))
+@text_commands.prefix("баккара", "бк")
 async def cmd_baccarat(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -2895,7 +2940,7 @@ async def cmd_baccarat(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Устанавливаем флаг активной игры
         active_baccarat_games[user_id] = True
@@ -2934,7 +2979,7 @@ async def cmd_baccarat(message: types.Message):
             add_win_to_user(user_id, win_amount, bet)
             add_game_to_history(user_id, 'Баккара', bet, 'win', win_amount)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             
             result_text = (
                 f"🎲 <b>БАККАРА</b>\n\n"
@@ -2946,7 +2991,7 @@ async def cmd_baccarat(message: types.Message):
         elif banker_score > player_score:
             add_game_to_history(user_id, 'Баккара', bet, 'lose', 0)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             
             result_text = (
                 f"🎲 <b>БАККАРА</b>\n\n"
@@ -2959,7 +3004,7 @@ async def cmd_baccarat(message: types.Message):
             # Ставка уже была списана, просто не начисляем выигрыш
             add_game_to_history(user_id, 'Баккара', bet, 'tie', bet)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             
             result_text = (
                 f"🎲 <b>БАККАРА</b>\n\n"
@@ -2977,7 +3022,7 @@ async def cmd_baccarat(message: types.Message):
 
 
 # --- Кнопка "Назад" в помощи ---
-@router.callback_query(lambda c: c.data == "help_back")
+@callbacks.exact("help_back")
 async def help_back(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -2991,7 +3036,7 @@ async def help_back(callback: CallbackQuery):
     await callback.answer()
 
 # Команда обнулить всё (в ответ на сообщение)
-@router.message(lambda message: message.text and message.text.lower() == 'обнулить всё' and message.reply_to_message)
+@text_commands.exact('обнулить всё', when=lambda message: message.reply_to_message)
 async def admin_reset_user_all(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -3048,7 +3093,7 @@ async def admin_reset_user_all(message: types.Message):
     )
 
 # Обработчик подтверждения полного обнуления
-@router.callback_query(lambda c: c.data.startswith("confirm_reset_all_") or c.data.startswith("cancel_reset_all_"))
+@callbacks.prefix("confirm_reset_all_", "cancel_reset_all_")
 async def handle_reset_all_user_confirmation(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("⛔ Нет прав!", show_alert=True)
@@ -3263,7 +3308,7 @@ async def handle_reset_all_user_confirmation(callback: CallbackQuery):
             games_ended.append("🎰 Рулетка")
     
     # 6. Сохраняем изменения основного профиля
-    save_users()
+    save_user(target_user_id)
     
     # 7. Формируем отчет
     report_parts = []
@@ -3299,13 +3344,13 @@ async def handle_reset_all_user_confirmation(callback: CallbackQuery):
     await callback.answer("Игрок успешно обнулен!")
 
 # Команда ТОП БИРЖА
-@router.message(lambda message: message.text and message.text.lower() in ["топ биржа", "топ биржи", "топ акций", "топ акции", "биржевой топ"])
+@text_commands.exact("топ биржа", "топ биржи", "топ акций", "топ акции", "биржевой топ")
 async def cmd_stock_top(message: types.Message):
     if is_banned(message.from_user.id):
         return
     
     user_id = message.from_user.id
-    if not check_cooldown(user_id, "stock_top", 10):
+    if not check_cooldown(user_id, "stock_top"):
         return
     
     # Создаем список игроков с биржевыми балансами
@@ -3459,7 +3504,7 @@ async def cmd_stock_top(message: types.Message):
     await message.reply(top_text, parse_mode="HTML", reply_markup=builder.as_markup())
 
 # Обработчики кнопок для топа биржи
-@router.callback_query(lambda c: c.data in ["my_stocks_btn", "stock_market_btn", "full_stock_top_btn"])
+@callbacks.exact("my_stocks_btn", "stock_market_btn", "full_stock_top_btn")
 async def handle_stock_top_buttons(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -3566,7 +3611,7 @@ async def handle_stock_top_buttons(callback: CallbackQuery):
     await callback.answer()
 
 # Обработчик кнопки возврата
-@router.callback_query(lambda c: c.data == "back_to_stock_top")
+@callbacks.exact("back_to_stock_top")
 async def back_to_stock_top(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -3668,7 +3713,7 @@ BUILDINGS = {
 }
 
 def save_cities():
-    cities_ref.set(user_cities)
+    write_behind.mark('cities_data', lambda: {str(k): v for k, v in user_cities.items()})
 
 def calculate_city_income(city):
     """Рассчитывает общий доход города в час с защитой от переполнения"""
@@ -3700,19 +3745,11 @@ def calculate_city_value(city):
     return int(total_value)
 
 def check_city_cooldown(user_id: int, command: str) -> bool:
-    """Проверяет кулдаун на команды города"""
-    current_time = time.time()
-    key = f"{user_id}_city_{command}"
-    
-    if key in command_cooldowns:
-        if current_time - command_cooldowns[key] < 2:  # 2 секунды между вызовами
-            return False
-    
-    command_cooldowns[key] = current_time
-    return True
+    """Проверяет кулдаун на команды города (2 секунды между вызовами)"""
+    return command_limiter.allow(user_id, ("city", command))
 
 # Команда создания города
-@router.message(lambda message: message.text and message.text.lower().startswith('создать город'))
+@text_commands.prefix('создать город')
 async def start_city_creation(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -3816,7 +3853,7 @@ async def start_city_creation(message: types.Message):
         )
 
 # Обработка подтверждения создания города
-@router.callback_query(lambda c: c.data.startswith('confirm_city_'))
+@callbacks.prefix('confirm_city_')
 async def confirm_city_creation(callback: CallbackQuery):
     data = callback.data.split('_')
     user_id = int(data[2])
@@ -3853,7 +3890,7 @@ async def confirm_city_creation(callback: CallbackQuery):
         return
     
     users_data[user_id]['balance'] -= creation_cost
-    save_users()
+    save_user(user_id)
     
     now_ts = time.time()
     user_cities[user_id] = {
@@ -3867,7 +3904,8 @@ async def confirm_city_creation(callback: CallbackQuery):
         'next_tax_time': now_ts + 24 * 3600,
         'created_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
         'total_earned': 0,
-        'creation_cost': creation_cost
+        'creation_cost': creation_cost,
+        'schema_version': city_migrations.latest
     }
     city_names.add(city_name.lower())
     save_cities()
@@ -3896,7 +3934,7 @@ async def confirm_city_creation(callback: CallbackQuery):
     await callback.answer("Город успешно создан!")
 
 # Команда "мой город" - РАБОТАЕТ В ЛИЧКЕ И ЧАТАХ
-@router.message(lambda message: message.text and message.text.lower().strip() in ["мой город", "город"])
+@text_commands.exact("мой город", "город", strip=True)
 async def show_city(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -3973,7 +4011,7 @@ async def show_city(message: types.Message):
     await message.reply(quote_html(city_text), parse_mode="HTML")
 
 # Команда построить здание
-@router.message(lambda message: message.text and message.text.lower().startswith('построить'))
+@text_commands.prefix('построить')
 async def build_in_city(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4068,7 +4106,7 @@ async def build_in_city(message: types.Message):
     # Увеличиваем население
     city['population'] += random.randint(10, 50)
     
-    save_users()
+    save_user(user_id)
     save_cities()
     
     await message.reply(
@@ -4084,7 +4122,7 @@ async def build_in_city(message: types.Message):
     )
 
 # Команда сбора налогов - обновленная защита
-@router.message(tax_command_filter)
+@text_commands.exact("собрать налоги", "налоги", "налоги собрать", "сбор налогов", strip=True)
 async def collect_taxes(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4141,7 +4179,7 @@ async def collect_taxes(message: types.Message):
         city['last_claim'] = datetime.fromtimestamp(now_ts).strftime('%Y-%m-%d %H:%M:%S')
         city['next_tax_time'] = now_ts + 24 * 3600
 
-        save_users()
+        save_user(user_id)
         save_cities()
 
         period_hours = max(1, min(24, int(round(elapsed_hours))))
@@ -4162,7 +4200,7 @@ async def collect_taxes(message: types.Message):
         city.pop('collecting', None)
 
 # Команда улучшения города
-@router.message(lambda message: message.text and message.text.lower() in ["улучшить город", "улучшить"])
+@text_commands.exact("улучшить город", "улучшить")
 async def upgrade_city(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4200,7 +4238,7 @@ async def upgrade_city(message: types.Message):
     city['level'] += 1
     city['population'] += random.randint(100, 300)
     
-    save_users()
+    save_user(user_id)
     save_cities()
     
     await message.reply(
@@ -4216,7 +4254,7 @@ async def upgrade_city(message: types.Message):
     )
 
 # Команда продажи города
-@router.message(lambda message: message.text and message.text.lower() == 'продать город')
+@text_commands.exact('продать город')
 async def sell_city(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4269,7 +4307,7 @@ async def sell_city(message: types.Message):
     )
 
 # Обработка подтверждения продажи города
-@router.callback_query(lambda c: c.data.startswith('confirm_sell_city_'))
+@callbacks.prefix('confirm_sell_city_')
 async def confirm_sell_city(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[3])
     
@@ -4290,7 +4328,7 @@ async def confirm_sell_city(callback: CallbackQuery):
     city_names.remove(city_name.lower())
     del user_cities[user_id]
     
-    save_users()
+    save_user(user_id)
     save_cities()
     
     await callback.message.edit_text(
@@ -4307,7 +4345,7 @@ async def confirm_sell_city(callback: CallbackQuery):
     await callback.answer("Город успешно продан!")
 
 # Обработка отмены продажи города
-@router.callback_query(lambda c: c.data.startswith('cancel_sell_city_'))
+@callbacks.prefix('cancel_sell_city_')
 async def cancel_sell_city(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[3])
     
@@ -4324,7 +4362,7 @@ async def cancel_sell_city(callback: CallbackQuery):
     await callback.answer("Продажа отменена")
 
 # Обработка отмены создания города
-@router.callback_query(lambda c: c.data.startswith('cancel_city_'))
+@callbacks.prefix('cancel_city_')
 async def cancel_city_creation(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[2])
     
@@ -4344,7 +4382,7 @@ async def cancel_city_creation(callback: CallbackQuery):
     await callback.answer("Создание города отменена")
 
 # Обработка ввода названия города
-@router.message(lambda message: message.from_user.id in city_creation and city_creation[message.from_user.id]['step'] == 'waiting_name')
+@text_commands.state(lambda message: message.from_user.id in city_creation and city_creation[message.from_user.id]['step'] == 'waiting_name')
 async def process_city_name(message: types.Message):
     user_id = message.from_user.id
     
@@ -4543,7 +4581,8 @@ def add_to_roulette_history(chat_id: int, number: int, color_text: str, color_em
         roulette_history[chat_id] = history[-10:]
 
 # Обработчики рулетки
-@router.message(lambda message: message.text and message.text.lower().startswith(('рулетка ', 'рул ')))
+@text_commands.prefix('рулетка ', 'рул ')
+@user_locks.guard(chat_key)
 async def roulette_bet(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4650,7 +4689,7 @@ async def roulette_bet(message: types.Message):
         
         # 🔒 ЗАЩИТА ОТ ДЮПА: Списываем ставку только после всех проверок
         users_data[user_id]['balance'] -= bet
-        save_users()  # Сохраняем сразу после списания
+        save_user(user_id)  # Сохраняем сразу после списания
         
         # Добавляем ставку
         if user_id not in roulette_data['bets']:
@@ -4684,7 +4723,8 @@ async def roulette_bet(message: types.Message):
     except Exception as e:
         await message.reply(f'❌ Ошибка в ставке! Проверьте формат.')
 
-@router.message(lambda message: message.text and message.text.lower() == 'го')
+@text_commands.exact('го')
+@user_locks.guard(chat_key)
 async def roulette_go(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4764,8 +4804,7 @@ async def roulette_go(message: types.Message):
             else:
                 add_game_to_history(user_id, 'Рулетка', total_bet_amount, 'lose', 0)
                 users_data[user_id]['games_played'] += 1
-
-        save_users()
+            save_user(user_id)
 
         if winners:
             result_text += '🏆 <b>ПОБЕДИТЕЛИ:</b>\n' + '\n'.join(winners) + '\n'
@@ -4782,20 +4821,17 @@ async def roulette_go(message: types.Message):
 
     except Exception as exc:
         logging.error("Ошибка при розыгрыше рулетки: %s", exc, exc_info=True)
-        refund_total = 0
         for user_id, user_bets in roulette_data['bets'].items():
             for bet in user_bets:
                 users_data[user_id]['balance'] += bet['bet']
-                refund_total += bet['bet']
-        if refund_total:
-            save_users()
+            save_user(user_id)
         await spin_msg.edit_text('❌ <b>Рулетка остановлена. Ставки возвращены.</b>', parse_mode='HTML')
     finally:
         roulette_data['bets'] = {}
         roulette_data['spinning'] = False
         roulette_data['end_time'] = 0
 
-@router.message(lambda message: message.text and message.text.lower() == 'ставки')
+@text_commands.exact('ставки')
 async def roulette_show_bets(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4834,7 +4870,8 @@ async def roulette_show_bets(message: types.Message):
     
     await message.reply(text, parse_mode='HTML')
 
-@router.message(lambda message: message.text and message.text.lower() in ['отменить', 'отменить ставку'])
+@text_commands.exact('отменить', 'отменить ставку')
+@user_locks.guard(chat_key)
 async def cancel_roulette_bet(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4864,7 +4901,7 @@ async def cancel_roulette_bet(message: types.Message):
     del roulette_data['bets'][user_id]
     
     # 🔒 ЗАЩИТА ОТ ДЮПА: Сохраняем изменения баланса
-    save_users()
+    save_user(user_id)
     
     await message.reply(
         f'✅ <b>Все ваши ставки отменены!</b>\n'
@@ -4872,7 +4909,7 @@ async def cancel_roulette_bet(message: types.Message):
         parse_mode='HTML'
     )
 
-@router.message(lambda message: message.text and message.text.lower() in ['лог', 'log', 'история', 'history'])
+@text_commands.exact('лог', 'log', 'история', 'history')
 async def show_roulette_log(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -4912,10 +4949,10 @@ REAL_STOCKS = {
 
 # Функции сохранения
 def save_stocks():
-    stocks_ref.set({str(k): v for k, v in user_stocks.items()})
+    write_behind.mark('stocks_data', lambda: {str(k): v for k, v in user_stocks.items()})
 
 def save_stock_prices():
-    stock_prices_ref.set(stock_prices)
+    write_behind.mark('stock_prices', lambda: stock_prices)
 
 # Инициализация портфеля акций
 def init_stock_portfolio(user_id: int):
@@ -4988,7 +5025,7 @@ async def initialize_stock_prices():
         save_stock_prices()
 
 # Команда биржи
-@router.message(lambda message: message.text and message.text.lower() in ["биржа", "акции", "stocks"])
+@text_commands.exact("биржа", "акции", "stocks")
 async def show_stock_market(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5034,7 +5071,7 @@ async def show_stock_market(message: types.Message):
     await message.reply(market_text, parse_mode="HTML")
 
 # Покупка акций
-@router.message(lambda message: message.text and message.text.lower().startswith('купить '))
+@text_commands.prefix('купить ')
 async def buy_stocks(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5104,7 +5141,7 @@ async def buy_stocks(message: types.Message):
     )
 
 # Продажа акций
-@router.message(lambda message: message.text and message.text.lower().startswith('продать '))
+@text_commands.prefix('продать ')
 async def sell_stocks(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5175,7 +5212,7 @@ async def sell_stocks(message: types.Message):
     )
 
 # Пополнение биржевого баланса
-@router.message(lambda message: message.text and message.text.lower().startswith('пополнить биржу '))
+@text_commands.prefix('пополнить биржу ')
 async def deposit_stock_balance(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5207,7 +5244,7 @@ async def deposit_stock_balance(message: types.Message):
     users_data[user_id]['balance'] -= amount
     user_stocks[user_id]['balance'] += amount
     
-    save_users()
+    save_user(user_id)
     save_stocks()  # Сохраняем изменения
     
     await message.reply(
@@ -5219,7 +5256,7 @@ async def deposit_stock_balance(message: types.Message):
     )
 
 # Вывод с биржи
-@router.message(lambda message: message.text and message.text.lower().startswith('вывести с биржи '))
+@text_commands.prefix('вывести с биржи ')
 async def withdraw_stock_balance(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5253,7 +5290,7 @@ async def withdraw_stock_balance(message: types.Message):
     portfolio['balance'] -= amount
     users_data[user_id]['balance'] += amount
     
-    save_users()
+    save_user(user_id)
     save_stocks()  # Сохраняем изменения
     
     await message.reply(
@@ -5265,7 +5302,7 @@ async def withdraw_stock_balance(message: types.Message):
     )
 
 # Мой портфель
-@router.message(lambda message: message.text and message.text.lower() in ["мой портфель", "портфель"])
+@text_commands.exact("мой портфель", "портфель")
 async def show_portfolio(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -5434,19 +5471,22 @@ def _crash_total_bank(game: Dict) -> int:
     return sum(player["bet"] for player in game["players"].values())
 
 
-def _crash_refund_players(game: Dict) -> int:
+async def _crash_refund_players(game: Dict) -> int:
     refunded_total = 0
-    for user_id, player in game["players"].items():
+    for user_id, player in list(game["players"].items()):
         if player.get("refunded"):
             continue
         if player.get("cashed"):
             player['refunded'] = True
             continue
-        users_data[user_id]['balance'] += player['bet']
-        player['refunded'] = True
-        refunded_total += player['bet']
-    if refunded_total:
-        save_users()
+        # Вызывается из фоновых задач раунда: берём блокировку игрока, как его обработчики
+        async with user_locks.hold(user_id_key(user_id)):
+            if player.get("refunded") or player.get("cashed"):
+                continue
+            users_data[user_id]['balance'] += player['bet']
+            player['refunded'] = True
+            refunded_total += player['bet']
+            save_user(user_id)
     return refunded_total
 
 
@@ -5558,7 +5598,7 @@ async def _start_crash_round(chat_id: int, bot: Bot):
         reply_markup=game["keyboard"],
     ):
         logging.error("Не удалось запустить раунд Crash — возвращаем ставки")
-        refunded = _crash_refund_players(game)
+        refunded = await _crash_refund_players(game)
         active_crash_games.pop(chat_id, None)
         if refunded:
             try:
@@ -5646,7 +5686,7 @@ async def crash_loop(chat_id: int, bot: Bot):
                 break
     except Exception as exc:
         logging.error("CRASH LOOP ERROR: %s", exc, exc_info=True)
-        refunded = _crash_refund_players(game)
+        refunded = await _crash_refund_players(game)
         if refunded:
             try:
                 await bot.send_message(
@@ -5660,7 +5700,8 @@ async def crash_loop(chat_id: int, bot: Bot):
         active_crash_games.pop(chat_id, None)
 
 
-@router.message(lambda m: m.text and m.text.lower().startswith(("краш", "crash")))
+@text_commands.prefix("краш", "crash")
+@user_locks.guard(chat_key)
 async def cmd_crash(message: types.Message):
     if message.chat.type == "private":
         await message.reply("❌ Crash доступен только в группах.")
@@ -5697,7 +5738,7 @@ async def cmd_crash(message: types.Message):
                 return
 
             users_data[user_id]['balance'] -= bet
-            save_users()
+            save_user(user_id)
 
             current_game.setdefault("chat_id", chat_id)
             current_game["players"][user_id] = {
@@ -5728,7 +5769,7 @@ async def cmd_crash(message: types.Message):
 
     # 🔥 Создание новой игры и лобби
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
 
     launch_time = datetime.now() + timedelta(seconds=CRASH_BETTING_DURATION)
     keyboard = InlineKeyboardMarkup(
@@ -5766,7 +5807,8 @@ async def cmd_crash(message: types.Message):
     await message.reply(f"✅ Ты открыл Crash и поставил {format_amount(bet)} MORPH\n👥 До старта есть {CRASH_BETTING_DURATION} секунд для новых ставок!")
 
 
-@router.callback_query(lambda c: c.data == "crash_cashout")
+@callbacks.exact("crash_cashout")
+@user_locks.guard(chat_key)
 async def crash_cashout(callback: CallbackQuery):
     chat_id = callback.message.chat.id
     user_id = callback.from_user.id
@@ -5793,13 +5835,17 @@ async def crash_cashout(callback: CallbackQuery):
         await callback.answer("❌ Ты уже забрал!", show_alert=True)
         return
 
+    if player.get("refunded"):
+        await callback.answer("💥 Раунд отменён, ставка возвращена!", show_alert=True)
+        return
+
     player["cashed"] = True
     player["cashout_coef"] = round(game["coef"], 2)
     coef = player["cashout_coef"]
     win = int(player["bet"] * coef)
 
     users_data[user_id]['balance'] += win
-    save_users()
+    save_user(user_id)
 
     await _crash_safe_edit(
         callback.message.bot,
@@ -5840,7 +5886,7 @@ def plinko_roll(risk: str) -> float:
     return random.choices(multipliers, weights=weights, k=1)[0]
 
 
-@router.message(lambda m: m.text and m.text.lower().startswith(("плинко", "plinko")))
+@text_commands.prefix("плинко", "plinko")
 async def cmd_plinko(message: types.Message):
     if message.chat.type == "private":
         await message.reply("❌ Plinko доступен только в группах.")
@@ -5878,7 +5924,7 @@ async def cmd_plinko(message: types.Message):
 
     # 🔒 списываем сразу
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -5904,7 +5950,7 @@ async def cmd_plinko(message: types.Message):
     }
 
 
-@router.callback_query(lambda c: c.data == "plinko_drop")
+@callbacks.exact("plinko_drop")
 async def plinko_drop(callback: CallbackQuery):
     user_id = callback.from_user.id
     game = active_plinko_games.get(user_id)
@@ -5927,7 +5973,7 @@ async def plinko_drop(callback: CallbackQuery):
     win = int(game["bet"] * multiplier)
 
     users_data[user_id]['balance'] += win
-    save_users()
+    save_user(user_id)
 
     text = (
         f"🎯 <b>PLINKO</b>\n\n"
@@ -5967,7 +6013,8 @@ def accept_decline_keyboard():
         ]
     )
 
-@router.message(lambda m: m.text and m.text.lower().startswith(("дуэль", "duel")))
+@text_commands.prefix("дуэль", "duel")
+@user_locks.guard(chat_key)
 async def cmd_mines_duel(message: types.Message):
     if message.chat.type == "private":
         await message.reply("❌ Дуэль доступна только в группах.")
@@ -6015,7 +6062,8 @@ async def cmd_mines_duel(message: types.Message):
         "started": False
     }
 
-@router.callback_query(lambda c: c.data in ["duel_accept", "duel_decline"])
+@callbacks.exact("duel_accept", "duel_decline")
+@user_locks.guard(chat_key)
 async def duel_accept_decline(callback: CallbackQuery):
     chat_id = callback.message.chat.id
     message_id = callback.message.message_id
@@ -6053,7 +6101,8 @@ async def duel_accept_decline(callback: CallbackQuery):
 
     users_data[user_id]['balance'] -= bet
     users_data[first_player_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
+    save_user(first_player_id)
 
     duel["players"].append(user_id)
     duel["started"] = True
@@ -6068,7 +6117,8 @@ async def duel_accept_decline(callback: CallbackQuery):
         reply_markup=kb
     )
 
-@router.callback_query(lambda c: c.data.startswith("duel_cell_"))
+@callbacks.prefix("duel_cell_")
+@user_locks.guard(chat_key)
 async def duel_move(callback: CallbackQuery):
     chat_id = callback.message.chat.id
     message_id = callback.message.message_id
@@ -6093,7 +6143,7 @@ async def duel_move(callback: CallbackQuery):
         winner = duel["players"][1 - duel["turn"]]
         prize = duel["bet"] * 2
         users_data[winner]['balance'] += prize
-        save_users()
+        save_user(winner)
         await callback.message.edit_text(
             f"💥 <b>ВЗРЫВ!</b>\n\n"
             f"🏆 Победитель: {winner}\n"
@@ -6111,7 +6161,7 @@ async def duel_move(callback: CallbackQuery):
 
 
 # --- ИГРА БУНКЕР ---
-@router.message(lambda message: message.text and message.text.lower().startswith('бункер'))
+@text_commands.prefix('бункер')
 async def start_bunker_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -6156,7 +6206,7 @@ async def start_bunker_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Создаем игру
         game_id = f"bunker_{user_id}_{int(time.time())}"
@@ -6202,7 +6252,7 @@ async def start_bunker_game(message: types.Message):
             users_data[user_id]['balance'] += int(bet * 0.5)
             users_data[user_id]['total_won'] -= loss_amount
             add_game_to_history(user_id, 'Бункер', bet, 'lose', 0)
-            save_users()
+            save_user(user_id)
             result_text = f"💸 <b>ПРОИГРЫШ! -{format_amount(loss_amount)} MORPH (x0.5)</b>"
             
         elif result == "😢":
@@ -6212,7 +6262,7 @@ async def start_bunker_game(message: types.Message):
             users_data[user_id]['balance'] += int(bet * 0.8)
             users_data[user_id]['total_won'] -= loss_amount
             add_game_to_history(user_id, 'Бункер', bet, 'lose', 0)
-            save_users()
+            save_user(user_id)
             result_text = f"😢 <b>ПРОИГРЫШ! -{format_amount(loss_amount)} MORPH (x0.8)</b>"
             
         else:
@@ -6221,7 +6271,7 @@ async def start_bunker_game(message: types.Message):
             result_text = f"💀 <b>ПОЛНЫЙ ПРОИГРЫШ! -{format_amount(bet)} MORPH (x0)</b>"
         
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         # Показываем все бункера
         bunkers_display = ""
@@ -6250,7 +6300,7 @@ async def start_bunker_game(message: types.Message):
         await message.reply(f"❌ Ошибка: {str(e)}")
 
 # Альтернативные команды
-@router.message(lambda message: message.text and message.text.lower().startswith(('bunker')))
+@text_commands.prefix('bunker')
 async def bunker_alias(message: types.Message):
     # Заменяем алиас на основную команду
     new_text = 'бункер' + message.text[6:]
@@ -6296,7 +6346,8 @@ def get_x50_bets_text() -> str:
 
     return "\n".join(lines) if lines else "— ставок нет"
 
-@router.message(lambda message: message.text and message.text.lower().startswith(("х50", "x50")))
+@text_commands.prefix("х50", "x50")
+@user_locks.guard(chat_key)
 async def x50_place_bet(message: types.Message):
     # 🔒 ЗАЩИТА: проверяем, что команда отправлена в нужном чате
     if message.chat.id != X50_CHAT_ID:
@@ -6370,7 +6421,7 @@ async def x50_place_bet(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Добавляем ставку в раунд
         bet_info = {
@@ -6475,11 +6526,13 @@ async def finish_x50_round(duration: int, message_id: int):
                     })
         
         # Затем обрабатываем победителей
-        for bet in active_x50_round['bets'][winning_color]:
+        for bet in list(active_x50_round['bets'][winning_color]):
             payout = bet['amount'] * winning_data['multiplier']
-            users_data[bet['user_id']]['balance'] += payout
-            users_data[bet['user_id']]['total_won'] += payout - bet['amount']
-            users_data[bet['user_id']]['games_played'] += 1
+            async with user_locks.hold(user_id_key(bet['user_id'])):
+                users_data[bet['user_id']]['balance'] += payout
+                users_data[bet['user_id']]['total_won'] += payout - bet['amount']
+                users_data[bet['user_id']]['games_played'] += 1
+                save_user(bet['user_id'])
             
             winners.append({
                 'username': bet['username'],
@@ -6489,8 +6542,6 @@ async def finish_x50_round(duration: int, message_id: int):
             })
             total_payout += payout
         
-        save_users()
-        
         # Формируем детальный отчет о результатах
         winners_text = ""
         if winners:
@@ -6566,17 +6617,7 @@ async def reset_x50_round(*, current_task: Optional[asyncio.Task] = None, refund
         except asyncio.CancelledError:
             pass
 
-    if refund_bets:
-        refunded = 0
-        for color_bets in active_x50_round['bets'].values():
-            for bet in color_bets:
-                user_id = bet['user_id']
-                amount = bet['amount']
-                users_data[user_id]['balance'] += amount
-                refunded += amount
-        if refunded:
-            save_users()
-
+    round_bets = active_x50_round['bets']
     active_x50_round['timer_task'] = None
     active_x50_round['start_time'] = None
     active_x50_round['message_id'] = None
@@ -6585,7 +6626,17 @@ async def reset_x50_round(*, current_task: Optional[asyncio.Task] = None, refund
     active_x50_round['is_spinning'] = False
     active_x50_round['round_number'] += 1
 
-@router.message(lambda message: message.text and message.text.lower() in ["дроп", "drop", "история"])
+    # Раунд сброшен до возврата: ставки, сделанные пока ждём блокировки
+    # игроков, уходят уже в новый раунд и не теряются
+    if refund_bets:
+        for color_bets in round_bets.values():
+            for bet in color_bets:
+                user_id = bet['user_id']
+                async with user_locks.hold(user_id_key(user_id)):
+                    users_data[user_id]['balance'] += bet['amount']
+                    save_user(user_id)
+
+@text_commands.exact("дроп", "drop", "история")
 async def x50_drop_history(message: types.Message):
     """Показать историю последних выпадений"""
     # 🔒 ЗАЩИТА: проверяем, что команда отправлена в нужном чате
@@ -6646,7 +6697,7 @@ async def x50_drop_history(message: types.Message):
         parse_mode="HTML"
     )
 
-@router.message(lambda message: message.text and message.text.lower() in ["x50стат", "x50статистика"])
+@text_commands.exact("x50стат", "x50статистика")
 async def x50_stats(message: types.Message):
     """Показать статистику текущего раунда"""
     # 🔒 ЗАЩИТА: проверяем, что команда отправлена в нужном чате
@@ -6696,7 +6747,7 @@ async def x50_cleanup_scheduler():
 
 #НОВЫЕ ИГРЫ
 # --- ИГРА НВУТИ (М/Р/Б) ---
-@router.message(lambda message: message.text and message.text.lower().startswith('нвути'))
+@text_commands.prefix('нвути')
 async def start_nvuti_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -6740,7 +6791,7 @@ async def start_nvuti_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Генерируем результат с разными шансами
         chances = {
@@ -6770,7 +6821,7 @@ async def start_nvuti_game(message: types.Message):
             win_text = f"❌ ПРОИГРЫШ! -{format_amount(bet)} MORPH"
         
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         # Эмодзи для результатов
         emoji_map = {
@@ -6788,7 +6839,7 @@ async def start_nvuti_game(message: types.Message):
         await message.reply(f"❌ Ошибка: {str(e)}")
 
 # --- Альтернативные команды для игры ---
-@router.message(lambda message: message.text and message.text.lower().startswith(('nwty', 'nuti', 'нвути')))
+@text_commands.prefix('nwty', 'nuti', 'нвути')
 async def nvuti_aliases(message: types.Message):
     # Заменяем алиасы на основную команду
     if message.text.lower().startswith('nwty'):
@@ -6805,7 +6856,7 @@ async def nvuti_aliases(message: types.Message):
 active_vilin_games = {}
 vilin_cooldowns = {}
 
-@router.message(lambda message: message.text and message.text.lower().startswith('вилин'))
+@text_commands.prefix('вилин')
 async def start_vilin_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -6862,7 +6913,7 @@ async def start_vilin_game(message: types.Message):
     active_vilin_games[user_id]['message_id'] = msg.message_id
 
 # Обработка кнопки "Играть"
-@router.callback_query(lambda c: c.data.startswith('vilin_play_'))
+@callbacks.prefix('vilin_play_')
 async def vilin_play_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[2])
     
@@ -6916,14 +6967,14 @@ async def vilin_play_callback(callback: CallbackQuery):
             update_leaderboard(user_id, net_win)
         add_game_to_history(user_id, 'Вилин', balance_on_hand, 'win', win_amount)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         result_text = f"🎉 ВЫИГРЫШ! +{format_amount(win_amount)} MORPH"
         result_emoji = "💰"
     else:
         # Проигрыш
         add_game_to_history(user_id, 'Вилин', balance_on_hand, 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         result_text = f"💀 ПРОИГРЫШ! -{format_amount(balance_on_hand)} MORPH"
         result_emoji = "💀"
     
@@ -6945,7 +6996,7 @@ async def vilin_play_callback(callback: CallbackQuery):
     await callback.answer()
 
 # Обработка кнопки "Отменить"
-@router.callback_query(lambda c: c.data.startswith('vilin_cancel_'))
+@callbacks.prefix('vilin_cancel_')
 async def vilin_cancel_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[2])
     
@@ -7014,7 +7065,7 @@ FAST_PROMO_CONFIG = {
 }
 
 # Команда для установки канала
-@router.message(lambda message: message.text and message.text.lower().startswith('+фастканал'))
+@text_commands.prefix('+фастканал')
 async def set_fast_channel(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.reply('⛔ Нет прав! Только администраторы могут настраивать канал.')
@@ -7100,7 +7151,7 @@ async def set_fast_channel(message: types.Message):
         await message.reply(f'❌ Ошибка настройки канала: {str(e)}')
 
 # Команда для проверки текущего канала
-@router.message(lambda message: message.text and message.text.lower() in ["фастканал", "канал фаст"])
+@text_commands.exact("фастканал", "канал фаст")
 async def show_fast_channel(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.reply('⛔ Нет прав!')
@@ -7184,7 +7235,7 @@ async def send_fast_promo_to_channel(bot: Bot, promo: Dict) -> types.Message:
         raise Exception(f"Ошибка отправки в канал: {str(e)}")
 
 # Модифицируем команду создания фаст-промокода с проверкой канала
-@router.message(lambda message: message.text and message.text.lower().startswith('+фаст'))
+@text_commands.prefix('+фаст')
 async def create_fast_promo(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -7250,7 +7301,7 @@ async def create_fast_promo(message: types.Message):
         
         # Списываем средства
         users_data[admin_id]['balance'] -= total_cost
-        save_users()
+        save_user(admin_id)
         
         # Создаем фаст-промокод
         promo_id = str(int(time.time()))
@@ -7303,7 +7354,7 @@ async def create_fast_promo(message: types.Message):
         await message.reply(f'❌ Ошибка создания фаст-промокода: {str(e)}')
 
 # Обработчик для кнопки фаст-промокода
-@router.callback_query(lambda c: c.data.startswith('fast_activate_'))
+@callbacks.prefix('fast_activate_')
 async def activate_fast_promo(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены и не можете активировать промокоды!", show_alert=True)
@@ -7345,7 +7396,7 @@ async def activate_fast_promo(callback: CallbackQuery):
     promo['used_count'] += 1
     promo['used_by'].append(user_id)
     
-    save_users()
+    save_user(user_id)
     active_fast_promos[promo_id] = promo
     save_fast_promos()
     
@@ -7542,7 +7593,7 @@ POKER_HANDS = {
 }
 
 # Команда покера
-@router.message(lambda message: message.text and message.text.lower().startswith(('папауиимпвципкци')))
+@text_commands.prefix('папауиимпвципкци')
 async def start_poker_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -7578,7 +7629,7 @@ async def start_poker_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Создаем колоду и перемешиваем
         deck = [(value, suit) for value in POKER_VALUES for suit in POKER_SUITS]
@@ -7752,7 +7803,7 @@ def get_hand_strength(hand_name):
     return POKER_HANDS.get(hand_name, 0)
 
 # Обработчики кнопок с защитой
-@router.callback_query(lambda c: c.data.startswith('poker_'))
+@callbacks.prefix('poker_')
 async def poker_callback(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -7856,7 +7907,7 @@ async def handle_poker_fold(callback: CallbackQuery, user_id):
     result_text = "❌ Вы сбросили карты! Проигрыш."
     
     users_data[user_id]['games_played'] += 1
-    save_users()
+    save_user(user_id)
     
     await send_poker_game_state(callback, user_id, result=result_text)
     await callback.answer("❌ Карты сброшены")
@@ -7925,7 +7976,7 @@ async def evaluate_poker_hand(callback: CallbackQuery, user_id):
         result_text = f"🤝 НИЧЬЯ! {player_hand_name}"
     
     users_data[user_id]['games_played'] += 1
-    save_users()
+    save_user(user_id)
     
     await send_poker_game_state(callback, user_id, result=result_text)
 
@@ -7961,7 +8012,7 @@ async def handle_poker_newgame(callback: CallbackQuery, user_id):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Создаем новую колоду
     deck = [(value, suit) for value in POKER_VALUES for suit in POKER_SUITS]
@@ -7997,7 +8048,7 @@ async def handle_poker_cashout(callback: CallbackQuery, user_id):
     await callback.answer("💰 Выход из игры")
 
 # Команда для предложения брака (ответом на сообщение)
-@router.message(lambda message: message.text and message.text.lower() == "брак предложить")
+@text_commands.exact("брак предложить")
 async def propose_marriage(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8044,7 +8095,7 @@ async def propose_marriage(message: types.Message):
     )
 
 # Обработка принятия брака
-@router.callback_query(lambda c: c.data.startswith('marriage_accept_'))
+@callbacks.prefix('marriage_accept_')
 async def accept_marriage(callback: CallbackQuery):
     receiver_id = callback.from_user.id
     sender_id = int(callback.data.split('_')[2])
@@ -8092,7 +8143,7 @@ async def accept_marriage(callback: CallbackQuery):
     await callback.answer("💍 Брак принят!")
 
 # Обработка отклонения брака
-@router.callback_query(lambda c: c.data.startswith('marriage_reject_'))
+@callbacks.prefix('marriage_reject_')
 async def reject_marriage(callback: CallbackQuery):
     receiver_id = callback.from_user.id
     sender_id = int(callback.data.split('_')[2])
@@ -8118,7 +8169,7 @@ async def reject_marriage(callback: CallbackQuery):
     await callback.answer("❌ Брак отклонен")
 
 # Команда для просмотра информации о браке
-@router.message(lambda message: message.text and message.text.lower() == "брак")
+@text_commands.exact("брак")
 async def marriage_info(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8169,7 +8220,7 @@ async def marriage_info(message: types.Message):
             )
 
 # Команда для развода
-@router.message(lambda message: message.text and message.text.lower() == "развод")
+@text_commands.exact("развод")
 async def divorce(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8205,7 +8256,7 @@ async def divorce(message: types.Message):
     )
 
 # Команда для просмотра всех пар
-@router.message(lambda message: message.text and message.text.lower() == "пары")
+@text_commands.exact("пары")
 async def married_couples(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8280,7 +8331,8 @@ async def main():
     
     await dp.start_polling(bot)
 
-@router.message(lambda message: message.text and message.text.lower().startswith(('джекпот', 'jackpot')))
+@text_commands.prefix('джекпот', 'jackpot')
+@user_locks.guard(chat_key)
 async def jackpot_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8330,7 +8382,7 @@ async def jackpot_game(message: types.Message):
         return
 
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
 
     if message.from_user.username:
         display_name = f"@{message.from_user.username}"
@@ -8360,6 +8412,7 @@ async def jackpot_game(message: types.Message):
 
     for pid in game['players'].keys():
         users_data[pid]['games_played'] = users_data[pid].get('games_played', 0) + 1
+        save_user(pid)
 
     winner_entry = game['players'][winner_id]
     add_win_to_user(winner_id, total_bank, 0)
@@ -8391,7 +8444,7 @@ async def jackpot_game(message: types.Message):
 
 
 # Команда слотов
-@router.message(lambda message: message.text and message.text.lower().startswith('слоты'))
+@text_commands.prefix('слоты')
 async def slot_machine(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8462,7 +8515,7 @@ async def slot_machine(message: types.Message):
         else:
             users_data[user_id]['games_played'] += 1
             add_game_to_history(user_id, 'Слоты', bet, 'lose', 0)
-            save_users()
+            save_user(user_id)
             result = f"❌ <b>ПРОИГРЫШ.</b> -{format_amount(bet)} MORPH"
         
         slot_text = (
@@ -8495,7 +8548,7 @@ WHEEL_OF_FORTUNE = [
 # Веса для random.choices
 wheel_weights = [sector["weight"] for sector in WHEEL_OF_FORTUNE]
 
-@router.message(lambda message: message.text and message.text.lower().startswith(('колесо', 'wheel')))
+@text_commands.prefix('колесо', 'wheel')
 async def start_wheel_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8529,7 +8582,7 @@ async def start_wheel_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Анимация вращения
         msg = await message.reply('🎡 <b>Колесо вращается...</b>', parse_mode='HTML')
@@ -8548,10 +8601,10 @@ async def start_wheel_game(message: types.Message):
             # Проигрыш (множитель < 1)
             if win_amount > 0:
                 users_data[user_id]['balance'] += win_amount
-                save_users()
+                save_user(user_id)
             add_game_to_history(user_id, 'Колесо удачи', bet, 'lose', win_amount)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
         
         # Показываем результат
         if result["multiplier"] == 0.0:
@@ -8598,7 +8651,7 @@ TAXI_PASSENGERS = [
     {"type": "jackpot", "name": "миллионер", "multiplier": 2.5, "emoji": "🎰"},  # Было 3.0
 ]
 
-@router.message(lambda message: message.text and message.text.lower().startswith(('такси', 'taxi')))
+@text_commands.prefix('такси', 'taxi')
 async def start_taxi_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8630,7 +8683,7 @@ async def start_taxi_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Показываем поиск
         msg = await message.reply('🚕 <b>Ищем пассажира...</b>', parse_mode='HTML')
@@ -8649,10 +8702,10 @@ async def start_taxi_game(message: types.Message):
             # Проигрыш
             if win_amount > 0:
                 users_data[user_id]['balance'] += win_amount
-                save_users()
+                save_user(user_id)
             add_game_to_history(user_id, 'Такси', bet, 'lose', win_amount)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
         
         # Показываем результат
         if passenger["multiplier"] == 0.0:
@@ -8667,7 +8720,7 @@ async def start_taxi_game(message: types.Message):
     except Exception as e:
         await message.reply(f'❌ Ошибка: {str(e)}')
 
-@router.callback_query(lambda c: c.data.startswith('taxi_again_'))
+@callbacks.prefix('taxi_again_')
 async def taxi_again_callback(callback: CallbackQuery):
     data = callback.data.split('_')
     user_id = int(data[2])
@@ -8684,7 +8737,7 @@ async def taxi_again_callback(callback: CallbackQuery):
     
     # Списываем ставку
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Создаем новую игру
     active_taxi_games[user_id] = {
@@ -8696,7 +8749,7 @@ async def taxi_again_callback(callback: CallbackQuery):
     await process_taxi_ride(callback, user_id)
     await callback.answer()
 
-@router.message(lambda message: message.text and message.text.lower().startswith(('хакер')))
+@text_commands.prefix('хакер')
 async def start_crypto_hacker(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -8724,7 +8777,7 @@ async def start_crypto_hacker(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Создаём игру с новыми балансами
         active_crypto_hacker_games[user_id] = {
@@ -8865,7 +8918,7 @@ async def send_crypto_hacker_game(message_or_callback, user_id, result_level=Non
     else:
         await message_or_callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='HTML')
 
-@router.callback_query(lambda c: c.data.startswith('hacker_level_'))
+@callbacks.prefix('hacker_level_')
 async def hacker_level_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     level = int(callback.data.split('_')[2])
@@ -8906,7 +8959,7 @@ async def hacker_level_callback(callback: CallbackQuery):
     
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith('hacker_next_'))
+@callbacks.prefix('hacker_next_')
 async def hacker_next_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     
@@ -8918,7 +8971,7 @@ async def hacker_next_callback(callback: CallbackQuery):
     await send_crypto_hacker_game(callback, user_id)
     await callback.answer("🎯 Переход к выбору уровня!")
 
-@router.callback_query(lambda c: c.data.startswith('hacker_cashout_'))
+@callbacks.prefix('hacker_cashout_')
 async def hacker_cashout_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     
@@ -8947,7 +9000,7 @@ async def hacker_cashout_callback(callback: CallbackQuery):
     add_win_to_user(user_id, won_amount, game['original_bet'])
     add_game_to_history(user_id, 'Крипто-Хакер', game['original_bet'], 'win', won_amount)
     users_data[user_id]['games_played'] += 1
-    save_users()
+    save_user(user_id)
     
     history_text = ""
     for level in range(1, game['level']):
@@ -8970,12 +9023,17 @@ async def hacker_cashout_callback(callback: CallbackQuery):
     await callback.answer()
 
 # Обработчики для заблокированных и пройденных уровней
-@router.callback_query(lambda c: c.data.startswith(('hacker_past_', 'hacker_locked_')))
+@callbacks.prefix('hacker_past_', 'hacker_locked_')
 async def hacker_info_callback(callback: CallbackQuery):
     await callback.answer("❌ Этот уровень уже пройден или заблокирован!")
 
 @router.message(lambda message: message.new_chat_members)
 async def handle_new_members(message: types.Message):
+    # Казна общая для чата: награды за входы разных пригласивших выдаются по очереди
+    async with user_locks.hold(chat_key(message)):
+        await reward_new_members(message)
+
+async def reward_new_members(message: types.Message):
     chat_id = message.chat.id
     inviting_user_id = message.from_user.id
     
@@ -9030,7 +9088,7 @@ async def handle_new_members(message: types.Message):
             }
             
             # Сохраняем изменения
-            save_users()
+            save_user(inviting_user_id)
             save_chat_treasury()
             
             inviting_user_name = message.from_user.first_name
@@ -9052,7 +9110,7 @@ async def handle_new_members(message: types.Message):
             )
 
 # Показать состояние казны
-@router.message(lambda message: message.text and message.text.lower() in ["казна", "казна чата", "treasury"])
+@text_commands.exact("казна", "казна чата", "treasury")
 async def show_treasury(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9079,7 +9137,8 @@ async def show_treasury(message: types.Message):
     await message.reply(treasury_text, parse_mode="HTML")
 
 # Пополнить казну
-@router.message(lambda message: message.text and message.text.lower().startswith("казну пополнить"))
+@text_commands.prefix("казну пополнить")
+@user_locks.guard(chat_key)
 async def donate_to_treasury(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9118,7 +9177,7 @@ async def donate_to_treasury(message: types.Message):
         
         chat_treasury[chat_id]['donations'][str(user_id)] += amount
         
-        save_users()
+        save_user(user_id)
         save_chat_treasury()
         
         await message.reply(
@@ -9133,7 +9192,7 @@ async def donate_to_treasury(message: types.Message):
         await message.reply("❌ Ошибка при пополнении казны!")
 
 # Статистика казны
-@router.message(lambda message: message.text and message.text.lower() in ["казну статистика", "статистика казны"])
+@text_commands.exact("казну статистика", "статистика казны")
 async def treasury_stats(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9183,7 +9242,7 @@ async def treasury_stats(message: types.Message):
     )
 
 # Мой вклад
-@router.message(lambda message: message.text and message.text.lower() in ["мой вклад", "мой вклад в казну"])
+@text_commands.exact("мой вклад", "мой вклад в казну")
 async def my_contribution(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9206,7 +9265,7 @@ async def my_contribution(message: types.Message):
     await message.reply(contribution_text, parse_mode="HTML")
 
 # Команда инвентарь с инлайн-кнопками
-@router.message(lambda message: message.text and message.text.lower() in ["инвентарь", "инв", "inventory", "inv"])
+@text_commands.exact("инвентарь", "инв", "inventory", "inv")
 async def cmd_inventory(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9305,7 +9364,7 @@ async def show_inventory_page(message_or_query, user_id: int, sorted_items: list
         await message_or_query.answer()
 
 # Callback-обработчик для пагинации инвентаря
-@router.callback_query(lambda c: c.data and c.data.startswith("inv_page:"))
+@callbacks.prefix("inv_page:")
 async def callback_inventory_page(callback: types.CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -9351,7 +9410,7 @@ async def callback_inventory_page(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!", show_alert=True)
 
 # Callback-обработчик для просмотра предмета
-@router.callback_query(lambda c: c.data and c.data.startswith("inv_item:"))
+@callbacks.prefix("inv_item:")
 async def callback_inventory_item(callback: types.CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -9505,7 +9564,7 @@ async def callback_inventory_item(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!", show_alert=True)
 
 # Callback-обработчик для продажи предмета
-@router.callback_query(lambda c: c.data and c.data.startswith("inv_sell_qty:"))
+@callbacks.prefix("inv_sell_qty:")
 async def callback_sell_item(callback: types.CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -9558,7 +9617,7 @@ async def callback_sell_item(callback: types.CallbackQuery):
         # Продаем предмет
         total_price = sell_price * sell_count
         users_data[user_id]['balance'] += total_price
-        save_users()
+        save_user(user_id)
         
         # Удаляем предмет из инвентаря
         if sell_count >= item_count:
@@ -9595,7 +9654,7 @@ async def callback_sell_item(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка при продаже!", show_alert=True)
 
 # Callback-обработчик для передачи предметов
-@router.callback_query(lambda c: c.data and c.data.startswith("inv_transfer_qty:"))
+@callbacks.prefix("inv_transfer_qty:")
 async def callback_transfer_item(callback: types.CallbackQuery):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -9683,7 +9742,7 @@ async def callback_transfer_item(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!", show_alert=True)
 
 # Callback для отмены передачи
-@router.callback_query(lambda c: c.data and c.data.startswith("inv_transfer_cancel:"))
+@callbacks.prefix("inv_transfer_cancel:")
 async def callback_transfer_cancel(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
@@ -9726,7 +9785,7 @@ async def callback_transfer_cancel(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка!", show_alert=True)
 
 # Команда для передачи предметов
-@router.message(lambda message: message.text and message.text.lower() in ["передать", "transfer", "дать предмет"])
+@text_commands.exact("передать", "transfer", "дать предмет")
 async def cmd_transfer_item(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -9849,7 +9908,7 @@ async def cmd_transfer_item(message: types.Message):
         await message.reply("❌ Произошла ошибка при передаче предмета!")
 
 # Команда коллекция
-@router.message(lambda message: message.text and message.text.lower() in ["коллекция", "моя коллекция", "collection", "my collection"])
+@text_commands.exact("коллекция", "моя коллекция", "collection", "my collection")
 async def cmd_collection(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10102,7 +10161,7 @@ def add_item_to_inventory(user_id: int, item_id: str, count: int = 1):
         logging.exception('Не удалось сохранить инвентарь после добавления предмета')
 
 # Команда для продажи предметов (должна быть после продажи акций, но с более специфичной проверкой)
-@router.message(lambda message: message.text and message.text.lower().startswith('продать ') and len(message.text.split()) == 2)
+@text_commands.prefix('продать ', when=lambda message: len(message.text.split()) == 2)
 async def cmd_sell_item(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10158,7 +10217,7 @@ async def cmd_sell_item(message: types.Message):
     # Продаем предмет
     total_price = sell_price * item_count
     users_data[user_id]['balance'] += total_price
-    save_users()
+    save_user(user_id)
     
     # Удаляем предмет из инвентаря
     del user_inventory[user_id]['items'][found_item_id]
@@ -10176,7 +10235,8 @@ async def cmd_sell_item(message: types.Message):
 
 # Обновляем команду инвентаря для отображения названий предметов
 # Команда для изменения награды в казне (только для создателя бота)
-@router.message(lambda message: message.text and message.text.lower().startswith("казну награда"))
+@text_commands.prefix("казну награда")
+@user_locks.guard(chat_key)
 async def set_treasury_reward(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10255,7 +10315,7 @@ async def set_treasury_reward(message: types.Message):
     )
 
 # --- КОМАНДА ИГРОКИ (С ЭМОДЗИ) ---
-@router.message(lambda message: message.text and message.text.lower() in ["игроки", "players"])
+@text_commands.exact("игроки", "players")
 async def cmd_players(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10277,7 +10337,7 @@ async def cmd_players(message: types.Message):
     await message.reply(players_text, parse_mode="HTML")
 
 # --- ИГРА ХИЛО - ИДЕАЛЬНЫЙ БАЛАНС ---
-@router.message(lambda message: message.text and message.text.lower().startswith(('хило', 'хл ')))
+@text_commands.prefix('хило', 'хл ')
 async def start_hilo_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10303,14 +10363,14 @@ async def start_hilo_game(message: types.Message):
         return
 
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
 
     deck = _create_hilo_deck()
     first_card = _deal_hilo_card(deck)
     if not first_card:
         await message.reply("❌ Не удалось начать игру, попробуйте еще раз")
         users_data[user_id]['balance'] += bet
-        save_users()
+        save_user(user_id)
         return
 
     active_hilo_games[user_id] = {
@@ -10427,7 +10487,7 @@ async def process_hilo_move(callback: CallbackQuery, user_id: int, action: str):
             add_win_to_user(user_id, payout, game['base_bet'])
             add_game_to_history(user_id, 'HiLo', game['base_bet'], 'win', payout)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             del active_hilo_games[user_id]
             await callback.message.edit_text(
                 quote_html(
@@ -10483,7 +10543,7 @@ async def process_hilo_move(callback: CallbackQuery, user_id: int, action: str):
         # Поражение
         add_game_to_history(user_id, 'HiLo', game['base_bet'], 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         del active_hilo_games[user_id]
         await callback.message.edit_text(
             quote_html(
@@ -10520,7 +10580,7 @@ async def process_hilo_take(callback: CallbackQuery, user_id: int):
         add_win_to_user(user_id, payout, base_bet)
         add_game_to_history(user_id, 'HiLo', base_bet, 'win', payout)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
 
         del_active = active_hilo_games.pop(user_id, None)
 
@@ -10556,9 +10616,14 @@ async def cleanup_hilo_games():
 
     for user_id, game in expired:
         refund_amount = game['current_payout'] if game.get('can_take') else game['base_bet']
-        if user_id in users_data:
-            users_data[user_id]['balance'] += refund_amount
-            save_users()
+        async with user_locks.hold(user_id_key(user_id)):
+            # Пока ждали блокировку, игрок мог доиграть партию сам
+            if active_hilo_games.get(user_id) is not game:
+                continue
+            active_hilo_games.pop(user_id, None)
+            if user_id in users_data:
+                users_data[user_id]['balance'] += refund_amount
+                save_user(user_id)
 
         message_text = (
             "⏰ <b>Игра HiLo закрыта по таймауту</b>\n\n"
@@ -10579,8 +10644,6 @@ async def cleanup_hilo_games():
             except Exception as exc:
                 logging.debug("Не удалось обновить сообщение HiLo при таймауте: %s", exc)
 
-        active_hilo_games.pop(user_id, None)
-
 
 async def hilo_cleanup_scheduler():
     """Периодически завершает HiLo-партии, где игроки не сделали ход."""
@@ -10593,7 +10656,7 @@ async def hilo_cleanup_scheduler():
             logging.error("Ошибка в hilo_cleanup_scheduler: %s", exc, exc_info=True)
 
 
-@router.callback_query(lambda c: c.data.startswith('hilo_move_higher_'))
+@callbacks.prefix('hilo_move_higher_')
 async def hilo_move_higher_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     if callback.from_user.id != user_id:
@@ -10602,7 +10665,7 @@ async def hilo_move_higher_callback(callback: CallbackQuery):
     await process_hilo_move(callback, user_id, 'higher')
 
 
-@router.callback_query(lambda c: c.data.startswith('hilo_move_lower_'))
+@callbacks.prefix('hilo_move_lower_')
 async def hilo_move_lower_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     if callback.from_user.id != user_id:
@@ -10611,12 +10674,12 @@ async def hilo_move_lower_callback(callback: CallbackQuery):
     await process_hilo_move(callback, user_id, 'lower')
 
 
-@router.callback_query(lambda c: c.data == 'hilo_locked')
+@callbacks.exact('hilo_locked')
 async def hilo_locked_callback(callback: CallbackQuery):
     await callback.answer("❌ Это действие сейчас недоступно", show_alert=True)
 
 
-@router.callback_query(lambda c: c.data.startswith('hilo_take_'))
+@callbacks.prefix('hilo_take_')
 async def hilo_take_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     if callback.from_user.id != user_id:
@@ -10625,7 +10688,7 @@ async def hilo_take_callback(callback: CallbackQuery):
     await process_hilo_take(callback, user_id)
 
 # --- Кнопка "Назад" в помощи ---
-@router.callback_query(lambda c: c.data == "help_back")
+@callbacks.exact("help_back")
 async def help_back(callback: CallbackQuery):
     if is_banned(callback.from_user.id):
         return
@@ -10639,7 +10702,7 @@ async def help_back(callback: CallbackQuery):
     await callback.answer()
 
 # Команда баланс
-@router.message(lambda message: message.text and message.text.lower() in ["баланс", "б", "balance"])
+@text_commands.exact("баланс", "б", "balance")
 async def cmd_balance(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10654,7 +10717,7 @@ async def cmd_balance(message: types.Message):
     )
 
 
-@router.message(lambda message: message.text and message.text.lower() in ["мои игры", "мой счет игр", "игры мои"])
+@text_commands.exact("мои игры", "мой счет игр", "игры мои")
 async def cmd_my_games(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10669,7 +10732,7 @@ async def cmd_my_games(message: types.Message):
     )
 
 # --- Профиль ---
-@router.message(lambda message: message.text and message.text.lower() in ["установить аватар", "set avatar", "аватар"])
+@text_commands.exact("установить аватар", "set avatar", "аватар")
 async def cmd_set_avatar(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10683,7 +10746,7 @@ async def cmd_set_avatar(message: types.Message):
     )
 
 # Обработчик для смены аватара по команде /change_avatar
-@router.message(lambda message: message.text and message.text.lower() in ["сменить аватар", "change avatar"])
+@text_commands.exact("сменить аватар", "change avatar")
 async def cmd_change_avatar(message: types.Message):
     user_id = message.from_user.id
     
@@ -10779,7 +10842,7 @@ async def handle_avatar_media(message: types.Message):
     await message.answer(f"✅ Аватар успешно обновлен! Теперь ваш профиль будет отображаться с {media_type_text}.")
 
 # Команда для удаления аватара
-@router.message(lambda message: message.text and message.text.lower() in ["удалить аватар", "remove avatar", "сбросить аватар"])
+@text_commands.exact("удалить аватар", "remove avatar", "сбросить аватар")
 async def cmd_remove_avatar(message: types.Message):
     user_id = message.from_user.id
     
@@ -10794,7 +10857,7 @@ async def cmd_remove_avatar(message: types.Message):
     else:
         await message.answer("ℹ️ У вас нет установленного аватара.")
 
-@router.message(lambda message: message.text and message.text.lower().startswith("профиль"))
+@text_commands.prefix("профиль")
 async def cmd_profile(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -10960,7 +11023,7 @@ async def cmd_profile(message: types.Message):
             parse_mode="HTML"
         )
 
-@router.message(lambda message: message.text and message.text.lower() in ["аватары", "avatars", "помощь аватар"])
+@text_commands.exact("аватары", "avatars", "помощь аватар")
 async def cmd_avatars_help(message: types.Message):
     user_id = message.from_user.id
     vip_info = ""
@@ -10986,7 +11049,7 @@ async def cmd_avatars_help(message: types.Message):
     await message.answer(help_text, parse_mode="HTML")
 
 # --- Пополнение банка с поддержкой ВСЁ ---
-@router.message(lambda m: m.text and m.text.lower().startswith(("банк пополнить ", "банк пополнить")))
+@text_commands.prefix("банк пополнить ", "банк пополнить")
 async def bank_deposit(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11016,7 +11079,7 @@ async def bank_deposit(message: types.Message):
         
         users_data[user_id]['balance'] -= amount
         users_data[user_id]['bank'] += amount
-        save_users()
+        save_user(user_id)
 
         await message.reply(
             "🏦 <b>БАНК ПОПОЛНЕН</b>\n\n"
@@ -11030,7 +11093,7 @@ async def bank_deposit(message: types.Message):
         await message.reply("❌ Использование: банк пополнить [сумма/ВСЁ]")
 
 # --- Снятие из банка с поддержкой ВСЁ ---
-@router.message(lambda m: m.text and m.text.lower().startswith(("банк снять ", "банк снять")))
+@text_commands.prefix("банк снять ", "банк снять")
 async def bank_withdraw(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11060,7 +11123,7 @@ async def bank_withdraw(message: types.Message):
         
         users_data[user_id]['bank'] -= amount
         users_data[user_id]['balance'] += amount
-        save_users()
+        save_user(user_id)
 
         await message.reply(
             "🏦 <b>СНЯТИЕ ИЗ БАНКА</b>\n\n"
@@ -11074,7 +11137,7 @@ async def bank_withdraw(message: types.Message):
         await message.reply("❌ Использование: банк снять [сумма/ВСЁ]")
 
 # --- Команда банка ---
-@router.message(lambda message: message.text and message.text.lower() in ["банк", "bank"])
+@text_commands.exact("банк", "bank")
 async def cmd_bank(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11090,7 +11153,7 @@ async def cmd_bank(message: types.Message):
     )
 
 # --- Топ ---
-@router.message(lambda message: message.text and message.text.lower() in ["топ", "top"])
+@text_commands.exact("топ", "top")
 async def cmd_top(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11099,58 +11162,25 @@ async def cmd_top(message: types.Message):
     if not check_cooldown(user_id, "top"):
         return
     
-    print(f"DEBUG: Начало обработки команды топ для пользователя {user_id}")
+    logging.debug("Начало обработки команды топ для пользователя %s", user_id)
     try:
-        # Проверяем, что users_data загружен
-        if not isinstance(users_data, dict):
-            print(f"DEBUG: users_data не является словарём: {type(users_data)}")
-            await message.reply("❌ <b>Ошибка при загрузке данных. Попробуйте позже.</b>", parse_mode="HTML")
-            return
-        
-        # Фильтруем пользователей с корректными данными
-        print(f"DEBUG: Всего пользователей в базе: {len(users_data)}")
-        valid_users = []
-        for uid, data in users_data.items():
-            try:
-                if (isinstance(uid, int) and 
-                    isinstance(data, dict) and 
-                    'balance' in data):
-                    balance = data['balance']
-                    # Безопасное преобразование баланса
-                    if isinstance(balance, (int, float)):
-                        try:
-                            balance_float = float(balance)
-                            if balance_float >= 0:  # Только неотрицательные балансы
-                                valid_users.append((uid, data))
-                        except (ValueError, TypeError, OverflowError):
-                            continue
-            except Exception as e:
-                print(f"Ошибка при обработке пользователя {uid} в топе: {e}")
-                continue
-        
-        print(f"DEBUG: Валидных пользователей: {len(valid_users)}")
-        if not valid_users:
+        # Топ читается из индекса по балансу в базе (отстаёт от памяти не больше чем на интервал write_behind).
+        # end_at(inf) отсекает строковые значения: они сортируются после чисел и заняли бы места в топе
+        top_users = await users_ref.order_by_child('balance').start_at(0).end_at(float('inf')).limit_to_last(10).aget()
+        sorted_users = [
+            (int(uid), data) for uid, data in reversed(top_users.items())
+            if uid.isdigit() and isinstance(data, dict) and isinstance(data.get('balance'), (int, float))
+        ]
+        logging.debug("Пользователей в топе: %d", len(sorted_users))
+        if not sorted_users:
             await message.reply("📊 <b>Пока нет игроков в рейтинге!</b>", parse_mode="HTML")
             return
         
-        # Сортируем по балансу
-        try:
-            sorted_users = sorted(
-                valid_users,
-                key=lambda x: x[1]['balance'],
-                reverse=True
-            )
-            print(f"DEBUG: Отсортировано пользователей: {len(sorted_users)}")
-        except Exception as e:
-            print(f"Ошибка при сортировке пользователей: {e}")
-            await message.reply("❌ <b>Ошибка при сортировке данных. Попробуйте позже.</b>", parse_mode="HTML")
-            return
-        
         top_text = "<b>🏆 ТОП ИГРОКОВ ПО БАЛАНСУ</b>\n\n"
         builder = InlineKeyboardBuilder()
         buttons_added = 0
         
-        print(f"DEBUG: Начинаем формирование топа из {min(10, len(sorted_users))} пользователей")
+        logging.debug("Начинаем формирование топа из %d пользователей", min(10, len(sorted_users)))
         for i, (uid, user_data) in enumerate(sorted_users[:10], 1):
             try:
                 # Безопасное получение имени пользователя
@@ -11216,7 +11246,7 @@ async def cmd_top(message: types.Message):
                 # Пропускаем проблемных пользователей
                 continue
         
-        print(f"DEBUG: Сформирован текст топа, длина: {len(top_text)}, кнопок добавлено: {buttons_added}")
+        logging.debug("Сформирован текст топа, длина: %d, кнопок добавлено: %d", len(top_text), buttons_added)
         
         if len(top_text) <= len("<b>🏆 ТОП ИГРОКОВ ПО БАЛАНСУ</b>\n\n"):
             top_text += "📊 <b>Недостаточно данных для составления топа</b>"
@@ -11227,7 +11257,7 @@ async def cmd_top(message: types.Message):
                 try:
                     builder.adjust(1)  # По одной кнопке в ряд
                     reply_markup = builder.as_markup()
-                    print(f"DEBUG: Клавиатура создана успешно")
+                    logging.debug("Клавиатура топа создана успешно")
                 except Exception as e:
                     print(f"Ошибка при создании клавиатуры топа: {e}")
                     import traceback
@@ -11236,7 +11266,7 @@ async def cmd_top(message: types.Message):
             else:
                 reply_markup = None
         
-        print(f"DEBUG: Отправляем сообщение с топом")
+        logging.debug("Отправляем сообщение с топом")
         try:
             await message.reply(
                 top_text, 
@@ -11244,7 +11274,7 @@ async def cmd_top(message: types.Message):
                 disable_web_page_preview=True,
                 reply_markup=reply_markup
             )
-            print(f"DEBUG: Сообщение с топом отправлено успешно")
+            logging.debug("Сообщение с топом отправлено успешно")
         except Exception as send_error:
             print(f"Ошибка при отправке сообщения с топом: {send_error}")
             import traceback
@@ -11267,7 +11297,7 @@ async def cmd_top(message: types.Message):
         await message.reply("❌ <b>Ошибка при формировании топа. Попробуйте позже.</b>", parse_mode="HTML")
 
 # --- Реферальная ссылка ---
-@router.message(lambda message: message.text and message.text.lower() in ["моя рефка", "рефка", "реферал"])
+@text_commands.exact("моя рефка", "рефка", "реферал")
 async def cmd_referral(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11307,7 +11337,7 @@ async def cmd_referral(message: types.Message):
 
 # Команда пинг
 # Команда пинг
-@router.message(lambda message: message.text and message.text.lower() in ["пинг", "ping"])
+@text_commands.exact("пинг", "ping")
 async def cmd_ping(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11346,7 +11376,7 @@ async def cmd_ping(message: types.Message):
     await msg.edit_text(ping_text)
 
 # --- Команда 'дать' (перевод MORPH) ---
-@router.message(lambda message: message.reply_to_message and message.text and message.text.lower().startswith("дать"))
+@text_commands.prefix("дать", when=lambda message: message.reply_to_message)
 async def transfer_morph(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11420,7 +11450,8 @@ async def transfer_morph(message: types.Message):
     users_data[from_user_id]['balance'] -= amount
     users_data[to_user_id]['balance'] += amount
     sender_profile['transfer_daily_spent'] = sender_profile.get('transfer_daily_spent', 0) + amount
-    save_users()
+    save_user(from_user_id)
+    save_user(to_user_id)
 
     if parts[1].lower() in ['всё', 'все', 'all']:
         await message.reply(f'✅ Переведены ВСЕ средства: {format_amount(amount)} MORPH игроку {message.reply_to_message.from_user.first_name}', parse_mode="HTML")
@@ -11428,7 +11459,7 @@ async def transfer_morph(message: types.Message):
         await message.reply(f'✅ Переведено {format_amount(amount)} MORPH игроку {message.reply_to_message.from_user.first_name}', parse_mode="HTML")
 
 
-@router.message(lambda message: message.text and message.text.lower().startswith(('лимит', 'limit')))
+@text_commands.prefix('лимит', 'limit')
 async def transfer_limit_command(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11522,7 +11553,7 @@ async def transfer_limit_command(message: types.Message):
     )
 
 
-@router.callback_query(lambda c: c.data.startswith("limit_confirm_") or c.data.startswith("limit_cancel_"))
+@callbacks.prefix("limit_confirm_", "limit_cancel_")
 async def transfer_limit_purchase_callback(callback: CallbackQuery):
     target_id = int(callback.data.split('_')[-1])
 
@@ -11596,7 +11627,7 @@ async def transfer_limit_purchase_callback(callback: CallbackQuery):
     user_profile['transfer_limit_level'] = current_level + 1
     user_profile['transfer_daily_spent'] = 0
     user_profile['transfer_daily_reset'] = int(time.time())
-    save_users()
+    save_user(target_id)
 
     new_level = user_profile['transfer_limit_level']
     new_limit = format_transfer_limit(get_transfer_limit(new_level))
@@ -11616,7 +11647,7 @@ async def transfer_limit_purchase_callback(callback: CallbackQuery):
     await callback.answer("Покупка завершена")
 
 
-@router.message(lambda message: message.text and message.text.lower() in ["вип", "vip", "vip инфо", "вип инфо"])
+@text_commands.exact("вип", "vip", "vip инфо", "вип инфо")
 async def vip_info_command(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11657,7 +11688,7 @@ async def vip_info_command(message: types.Message):
     )
 
 
-@router.message(lambda message: message.text and message.text.lower() in ["фриспин", "vip фриспин", "freespin", "spin vip"])
+@text_commands.exact("фриспин", "vip фриспин", "freespin", "spin vip")
 async def vip_freespin_command(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11717,14 +11748,14 @@ async def vip_freespin_command(message: types.Message):
     if reward['type'] == 'morph':
         amount = reward['amount']
         users_data[user_id]['balance'] += amount
-        save_users()
+        save_user(user_id)
         result_lines.append(f"{reward['emoji']} <b>Вы выиграли:</b> {format_amount(amount)} MORPH")
     else:
         add_item_to_inventory(user_id, reward['item_id'], 1)
         result_lines.append(f"{reward['emoji']} <b>Вы получили:</b> {reward['title']}")
         result_lines.append("💡 Предмет добавлен в ваш инвентарь.")
 
-    save_users()
+    save_user(user_id)
 
     result_lines.append("")
     result_lines.append("🔒 Следующий фриспин будет доступен через 24 часа.")
@@ -11740,13 +11771,26 @@ async def vip_freespin_command(message: types.Message):
 active_mines_games = {}
 active_sniper_games: Dict[int, Dict] = {}
 active_tides_games: Dict[int, Dict] = {}
+tides_restart_bets: Dict[int, int] = {}  # {user_id: ставка для кнопки "Играть снова"}; в callback_data она может не влезть
 active_oracle_games: Dict[int, Dict] = {}
 active_masquerade_games: Dict[int, Dict] = {}
 active_carnival_games: Dict[int, Dict] = {}
 active_baccarat_games: Dict[int, Dict] = {}
 
+# Клетки, на которые уже нельзя нажать: открытые и на поле завершённой игры
+MINES_FINISHED_CELL = make_callback_data("mines", "finished")
+MINES_OPENED_CELL = make_callback_data("mines", "opened")
 
-@router.message(lambda message: message.text and message.text.lower().startswith("мины"))
+@callbacks.action("mines", "finished")
+async def mines_finished_cell(callback: CallbackQuery):
+    await callback.answer("❌ Игра уже завершена!")
+
+@callbacks.action("mines", "opened")
+async def mines_opened_cell(callback: CallbackQuery):
+    await callback.answer("❌ Клетка уже открыта!")
+
+
+@text_commands.prefix("мины")
 async def start_mines_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -11803,14 +11847,14 @@ async def start_mines_game(message: types.Message):
             for j in range(5):
                 row.append(InlineKeyboardButton(
                     text="⬜",  # Серые клетки вместо синих
-                    callback_data=f"mines_{i}_{j}_{user_id}_{bet}_{mines_count}"
+                    callback_data=make_callback_data("mines", "open", i, j, user_id)
                 ))
             builder.row(*row)
         
         # Кнопка "Забрать выигрыш"
         builder.row(InlineKeyboardButton(
             text="💰 Забрать выигрыш (1.0x)",
-            callback_data=f"mines_cashout_{user_id}_{bet}_{mines_count}"
+            callback_data=make_callback_data("mines", "cashout", user_id)
         ))
         
         # Сохраняем игру с защитой от дюпа
@@ -11831,7 +11875,7 @@ async def start_mines_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         sent_message = await message.reply(
             f"💣 <b>ИГРА МИНЫ</b>\n\n"
@@ -11900,26 +11944,13 @@ def get_mines_multiplier(opened_cells, mines_count, total_cells=25):
     return round(multiplier, 2)
 
 # Обработка нажатий на клетки в игре "Мины" с улучшенной защитой
-@router.callback_query(lambda c: c.data.startswith("mines_") and not c.data.startswith("mines_cashout_") and not c.data.startswith("mines_restart_"))
-async def mines_callback(callback: CallbackQuery):
+@callbacks.action("mines", "open", int, int, int)
+async def mines_callback(callback: CallbackQuery, x: int, y: int, target_user_id: int):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
         return
     
     try:
-        data = callback.data.split("_")
-        
-        # Проверяем, что это координаты клетки
-        if len(data) < 6 or not data[1].isdigit() or not data[2].isdigit():
-            await callback.answer("❌ Ошибка данных!")
-            return
-        
-        # Обработка нажатия на клетку
-        x, y = int(data[1]), int(data[2])
-        target_user_id = int(data[3])
-        bet = int(data[4])
-        mines_count = int(data[5])
-        
         # 🔒 ЗАЩИТА: проверяем, что нажимает владелец игры
         if callback.from_user.id != target_user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -11930,6 +11961,9 @@ async def mines_callback(callback: CallbackQuery):
             return
         
         game = active_mines_games[target_user_id]
+        # Ставка и число мин берутся из состояния игры, а не из данных кнопки
+        bet = game['bet']
+        mines_count = game['mines_count']
         
         # Проверяем, не закончилась ли уже игра
         if game.get('game_over'):
@@ -11970,19 +12004,19 @@ async def mines_callback(callback: CallbackQuery):
                 row = []
                 for j in range(5):
                     if (i, j) == (x, y):
-                        row.append(InlineKeyboardButton(text="💥", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="💥", callback_data=MINES_FINISHED_CELL))
                     elif (i, j) in game['mines_positions']:
-                        row.append(InlineKeyboardButton(text="💣", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="💣", callback_data=MINES_FINISHED_CELL))
                     elif (i, j) in game['opened_cells']:
-                        row.append(InlineKeyboardButton(text="💎", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="💎", callback_data=MINES_FINISHED_CELL))
                     else:
-                        row.append(InlineKeyboardButton(text="⬜", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="⬜", callback_data=MINES_FINISHED_CELL))
                 builder.row(*row)
             
             # Кнопка новой игры
             builder.row(InlineKeyboardButton(
                 text="🔄 Играть снова", 
-                callback_data=f"mines_restart_{target_user_id}"
+                callback_data=make_callback_data("mines", "restart", target_user_id)
             ))
             
             await callback.message.edit_text(
@@ -12002,7 +12036,7 @@ async def mines_callback(callback: CallbackQuery):
             
             add_game_to_history(target_user_id, 'Мины', bet, 'lose', 0)
             users_data[target_user_id]['games_played'] += 1
-            save_users()
+            save_user(target_user_id)
             del active_mines_games[target_user_id]
             return
         
@@ -12026,7 +12060,7 @@ async def mines_callback(callback: CallbackQuery):
             users_data[target_user_id]['balance'] += won_amount
             add_game_to_history(target_user_id, 'Мины', bet, 'win', won_amount)
             users_data[target_user_id]['games_played'] += 1
-            save_users()
+            save_user(target_user_id)
             
             # Показываем финальный результат
             builder = InlineKeyboardBuilder()
@@ -12034,14 +12068,14 @@ async def mines_callback(callback: CallbackQuery):
                 row = []
                 for j in range(5):
                     if (i, j) in game['mines_positions']:
-                        row.append(InlineKeyboardButton(text="💣", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="💣", callback_data=MINES_FINISHED_CELL))
                     else:
-                        row.append(InlineKeyboardButton(text="💎", callback_data="mines_game_over"))
+                        row.append(InlineKeyboardButton(text="💎", callback_data=MINES_FINISHED_CELL))
                 builder.row(*row)
             
             builder.row(InlineKeyboardButton(
                 text="🔄 Играть снова", 
-                callback_data=f"mines_restart_{target_user_id}"
+                callback_data=make_callback_data("mines", "restart", target_user_id)
             ))
             
             await callback.message.edit_text(
@@ -12074,19 +12108,19 @@ async def mines_callback(callback: CallbackQuery):
                 if (i, j) in game['opened_cells']:
                     row.append(InlineKeyboardButton(
                         text="💎",
-                        callback_data=f"mines_opened_{i}_{j}"
+                        callback_data=MINES_OPENED_CELL
                     ))
                 else:
                     row.append(InlineKeyboardButton(
                         text="⬜",
-                        callback_data=f"mines_{i}_{j}_{target_user_id}_{bet}_{mines_count}"
+                        callback_data=make_callback_data("mines", "open", i, j, target_user_id)
                     ))
             builder.row(*row)
         
         # Кнопка "Забрать выигрыш" с актуальной суммой
         builder.row(InlineKeyboardButton(
             text=f"💰 Забрать {format_amount(won_amount)} MORPH ({game['multiplier']:.2f}x)",
-            callback_data=f"mines_cashout_{target_user_id}_{bet}_{mines_count}"
+            callback_data=make_callback_data("mines", "cashout", target_user_id)
         ))
         
         await callback.message.edit_text(
@@ -12118,18 +12152,13 @@ async def mines_callback(callback: CallbackQuery):
                 game['move_in_progress'] = False
 
 # Обработка кнопки "Забрать выигрыш"
-@router.callback_query(lambda c: c.data.startswith("mines_cashout_"))
-async def mines_cashout(callback: CallbackQuery):
+@callbacks.action("mines", "cashout", int)
+async def mines_cashout(callback: CallbackQuery, target_user_id: int):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
         return
     
     try:
-        data = callback.data.split("_")
-        target_user_id = int(data[2])
-        bet = int(data[3])
-        mines_count = int(data[4])
-        
         # Проверяем, что нажимает владелец игры
         if callback.from_user.id != target_user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -12140,6 +12169,9 @@ async def mines_cashout(callback: CallbackQuery):
             return
         
         game = active_mines_games[target_user_id]
+        # Ставка и число мин берутся из состояния игры, а не из данных кнопки
+        bet = game['bet']
+        mines_count = game['mines_count']
         
         # Проверяем, не закончилась ли уже игра
         if game.get('game_over'):
@@ -12161,7 +12193,7 @@ async def mines_cashout(callback: CallbackQuery):
         add_win_to_user(target_user_id, won_amount, bet)
         add_game_to_history(target_user_id, 'Мины', bet, 'win', won_amount)
         users_data[target_user_id]['games_played'] += 1
-        save_users()
+        save_user(target_user_id)
         
         # Показываем финальное поле
         builder = InlineKeyboardBuilder()
@@ -12169,17 +12201,17 @@ async def mines_cashout(callback: CallbackQuery):
             row = []
             for j in range(5):
                 if (i, j) in game['mines_positions']:
-                    row.append(InlineKeyboardButton(text="💣", callback_data="mines_game_over"))
+                    row.append(InlineKeyboardButton(text="💣", callback_data=MINES_FINISHED_CELL))
                 elif (i, j) in game['opened_cells']:
-                    row.append(InlineKeyboardButton(text="💎", callback_data="mines_game_over"))
+                    row.append(InlineKeyboardButton(text="💎", callback_data=MINES_FINISHED_CELL))
                 else:
-                    row.append(InlineKeyboardButton(text="⬜", callback_data="mines_game_over"))
+                    row.append(InlineKeyboardButton(text="⬜", callback_data=MINES_FINISHED_CELL))
             builder.row(*row)
         
         # Кнопка новой игры
         builder.row(InlineKeyboardButton(
             text="🔄 Играть снова", 
-            callback_data=f"mines_restart_{target_user_id}"
+            callback_data=make_callback_data("mines", "restart", target_user_id)
         ))
         
         await callback.message.edit_text(
@@ -12208,8 +12240,8 @@ async def mines_cashout(callback: CallbackQuery):
             del active_mines_games[target_user_id]
 
 # Обработка кнопки перезапуска игры
-@router.callback_query(lambda c: c.data.startswith("mines_restart_"))
-async def mines_restart(callback: CallbackQuery):
+@callbacks.action("mines", "restart", int)
+async def mines_restart(callback: CallbackQuery, target_user_id: int):
     user_id = callback.from_user.id
     if is_banned(user_id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
@@ -12311,7 +12343,7 @@ Message.edit_text = new_edit_text
 # ======== КОМАНДА СМЕНЫ ЯЗЫКА ========
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-@router.message(lambda message: message.text and message.text.lower() in ["язык", "language", "言語"])
+@text_commands.exact("язык", "language", "言語")
 async def cmd_language(message: Message):  # Убрал types.
     user_id = message.from_user.id
     current_lang = get_user_language(user_id)
@@ -12324,7 +12356,7 @@ async def cmd_language(message: Message):  # Убрал types.
     
     await message.answer("🌐 Выберите язык / Select language / 言語を選択:", reply_markup=keyboard)
 
-@router.callback_query(lambda callback: callback.data.startswith("lang_"))
+@callbacks.prefix("lang_")
 async def process_language(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     lang_code = callback.data.split("_")[1]
@@ -12340,7 +12372,7 @@ async def process_language(callback: types.CallbackQuery):
     await callback.answer()
 
 # --- Топ по банкам (новая команда) ---
-@router.message(lambda message: message.text and message.text.lower() in ["топ банк", "топ банки", "top bank"])
+@text_commands.exact("топ банк", "топ банки", "top bank")
 async def cmd_top_bank(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -12350,43 +12382,18 @@ async def cmd_top_bank(message: types.Message):
         return
     
     try:
-        # Проверяем, что users_data загружен
-        if not isinstance(users_data, dict):
-            print(f"DEBUG: users_data не является словарём: {type(users_data)}")
-            await message.reply("❌ <b>Ошибка при загрузке данных. Попробуйте позже.</b>", parse_mode="HTML")
-            return
-        
-        # Фильтруем пользователей с корректными данными банка
-        valid_users = []
-        for uid, data in users_data.items():
-            try:
-                if (isinstance(uid, int) and 
-                    isinstance(data, dict) and 
-                    'bank' in data):
-                    bank = data['bank']
-                    # Безопасное преобразование банка
-                    if isinstance(bank, (int, float)):
-                        try:
-                            bank_float = float(bank)
-                            if bank_float > 0:  # Только с деньгами в банке
-                                valid_users.append((uid, data))
-                        except (ValueError, TypeError, OverflowError):
-                            continue
-            except Exception as e:
-                print(f"Ошибка при обработке пользователя {uid} в топе банка: {e}")
-                continue
+        # Топ читается из индекса по банку в базе (с отставанием до интервала write_behind), только числовые значения
+        top_users = await users_ref.order_by_child('bank').start_at(0).end_at(float('inf')).limit_to_last(10).aget()
+        sorted_users = [
+            (int(uid), data) for uid, data in reversed(top_users.items())
+            if uid.isdigit() and isinstance(data, dict) and isinstance(data.get('bank'), (int, float))
+            and data['bank'] > 0
+        ]
         
-        if not valid_users:
+        if not sorted_users:
             await message.reply("🏦 <b>Пока нет игроков с деньгами в банке!</b>", parse_mode="HTML")
             return
         
-        # Сортируем по сумме в банке
-        sorted_users = sorted(
-            valid_users,
-            key=lambda x: x[1]['bank'],
-            reverse=True
-        )
-        
         top_text = "<b>🏦 ТОП ИГРОКОВ ПО БАНКУ</b>\n\n"
         builder = InlineKeyboardBuilder()
         buttons_added = 0
@@ -12518,7 +12525,7 @@ async def cmd_top_bank(message: types.Message):
         await message.reply("❌ <b>Ошибка при формировании топа банков. Попробуйте позже.</b>", parse_mode="HTML")
 
 # ИГРА "КУБИК"
-@router.message(lambda message: message.text and message.text.lower().startswith("кубик"))
+@text_commands.prefix("кубик")
 async def start_dice_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -12548,7 +12555,7 @@ async def start_dice_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Отправляем анимированный кубик
         dice_msg = await message.answer_dice(emoji="🎲")
@@ -12593,7 +12600,7 @@ async def start_dice_game(message: types.Message):
             )
         
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         result_body = (
             "🎲 <b>ИГРА КУБИК</b>\n\n"
@@ -12614,7 +12621,7 @@ async def start_dice_game(message: types.Message):
 # ИГРА "ПИРАТ" - ИСПРАВЛЕННАЯ ВЕРСИЯ С ЗАЩИТОЙ ОТ ДЮПА
 active_pirate_games = {}  # Добавляем словарь для отслеживания активных игр
 
-@router.message(lambda message: message.text and message.text.lower().startswith("пират"))
+@text_commands.prefix("пират")
 async def start_pirate_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -12643,7 +12650,7 @@ async def start_pirate_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Генерируем выигрышную кнопку
         winning_button = random.randint(1, 3)
@@ -12658,9 +12665,9 @@ async def start_pirate_game(message: types.Message):
         
         # Создаем клавиатуру с тремя кнопками
         builder = InlineKeyboardBuilder()
-        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 1", callback_data=f"pirate_1_{user_id}"))
-        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 2", callback_data=f"pirate_2_{user_id}"))
-        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 3", callback_data=f"pirate_3_{user_id}"))
+        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 1", callback_data=make_callback_data("pirate", "pick", 1, user_id)))
+        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 2", callback_data=make_callback_data("pirate", "pick", 2, user_id)))
+        builder.add(InlineKeyboardButton(text="🏴‍☠️ Кнопка 3", callback_data=make_callback_data("pirate", "pick", 3, user_id)))
         
         await message.reply(
             f"🏴‍☠️ **ИГРА ПИРАТ**\n\n"
@@ -12675,19 +12682,11 @@ async def start_pirate_game(message: types.Message):
         await message.reply("❌ Неверные параметры!")
 
 # Обработка нажатий в игре "Пират" с защитой от дюпа
-@router.callback_query(lambda c: c.data.startswith("pirate_"))
-async def pirate_callback(callback: CallbackQuery):
+@callbacks.action("pirate", "pick", int, int)
+async def pirate_callback(callback: CallbackQuery, button_num: int, target_user_id: int):
     if is_banned(callback.from_user.id):
         return
     
-    data = callback.data.split("_")
-    if len(data) < 3:
-        await callback.answer("❌ Ошибка данных!")
-        return
-    
-    button_num = int(data[1])
-    target_user_id = int(data[2])
-    
     # 🔒 ЗАЩИТА: проверяем, что нажимает владелец игры
     if callback.from_user.id != target_user_id:
         await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -12725,31 +12724,31 @@ async def pirate_callback(callback: CallbackQuery):
         builder = InlineKeyboardBuilder()
         for i in range(1, 4):
             if i == winning_button:
-                builder.add(InlineKeyboardButton(text="💰 ВЫИГРЫШ", callback_data="pirate_completed"))
+                builder.add(InlineKeyboardButton(text="💰 ВЫИГРЫШ", callback_data=make_callback_data("pirate", "completed")))
             else:
-                builder.add(InlineKeyboardButton(text="💀 ПРОИГРЫШ", callback_data="pirate_completed"))
+                builder.add(InlineKeyboardButton(text="💀 ПРОИГРЫШ", callback_data=make_callback_data("pirate", "completed")))
         builder.adjust(3)
         
     else:
         # Проигрыш
         add_game_to_history(target_user_id, 'Пират', bet, 'lose', 0)
         users_data[target_user_id]['games_played'] += 1
-        save_users()
+        save_user(target_user_id)
         result_text = f"❌ **ПРОИГРЫШ!**\n💰 Проигрыш: {format_amount(bet)} MORPH"
         
         # Показываем все кнопки с результатами
         builder = InlineKeyboardBuilder()
         for i in range(1, 4):
             if i == winning_button:
-                builder.add(InlineKeyboardButton(text="💰 ВЫИГРЫШНАЯ", callback_data="pirate_completed"))
+                builder.add(InlineKeyboardButton(text="💰 ВЫИГРЫШНАЯ", callback_data=make_callback_data("pirate", "completed")))
             elif i == button_num:
-                builder.add(InlineKeyboardButton(text="💀 ВАША", callback_data="pirate_completed"))
+                builder.add(InlineKeyboardButton(text="💀 ВАША", callback_data=make_callback_data("pirate", "completed")))
             else:
-                builder.add(InlineKeyboardButton(text="💀 ПРОИГРЫШ", callback_data="pirate_completed"))
+                builder.add(InlineKeyboardButton(text="💀 ПРОИГРЫШ", callback_data=make_callback_data("pirate", "completed")))
         builder.adjust(3)
     
     users_data[target_user_id]['games_played'] += 1
-    save_users()
+    save_user(target_user_id)
     
     await callback.message.edit_text(
         f"🏴‍☠️ **ИГРА ПИРАТ**\n\n"
@@ -12761,7 +12760,7 @@ async def pirate_callback(callback: CallbackQuery):
     await callback.answer()
 
 # Обработка завершенной игры
-@router.callback_query(lambda c: c.data == "pirate_completed")
+@callbacks.action("pirate", "completed")
 async def pirate_completed_callback(callback: CallbackQuery):
     await callback.answer("🎮 Игра завершена!")
 
@@ -12771,18 +12770,20 @@ async def cleanup_pirate_games():
     current_time = time.time()
     expired_games = []
     
-    for user_id, game in active_pirate_games.items():
+    for user_id, game in list(active_pirate_games.items()):
         # Если игра висит больше 10 минут - удаляем и возвращаем ставку
         if current_time - int(game['game_id'].split('_')[-1]) > 600:  # 10 минут
-            expired_games.append(user_id)
-            # Возвращаем ставку
-            users_data[user_id]['balance'] += game['bet']
-    
-    for user_id in expired_games:
-        del active_pirate_games[user_id]
+            async with user_locks.hold(user_id_key(user_id)):
+                # Пока ждали блокировку, игрок мог доиграть партию сам
+                if active_pirate_games.get(user_id) is not game:
+                    continue
+                expired_games.append(user_id)
+                del active_pirate_games[user_id]
+                # Возвращаем ставку
+                users_data[user_id]['balance'] += game['bet']
+                save_user(user_id)
     
     if expired_games:
-        save_users()
         print(f"Очищено {len(expired_games)} зависших игр в Пирате")
 
 # Запускаем очистку каждые 5 минут
@@ -12806,7 +12807,10 @@ async def main():
 active_knb_challenges = {}
 
 # СПОРТИВНЫЕ ИГРЫ (Баскетбол, Футбол, Боулинг, Дартс)
-@router.message(lambda message: message.text and message.text.split()[0].lower() in ["баскетбол", "футбол", "боулинг", "дартс"])
+@text_commands.prefix(
+    "баскетбол", "футбол", "боулинг", "дартс",
+    when=lambda message: message.text.split()[0].lower() in ["баскетбол", "футбол", "боулинг", "дартс"],
+)
 async def start_sport_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -12829,7 +12833,7 @@ async def start_sport_game(message: types.Message):
             await message.reply(error_msg)
             return
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         sport_dice = {
             "баскетбол": {"emoji": "🏀", "win": [4, 5], "multiplier": 2.0, "name": "Баскетбол"},
             "футбол": {"emoji": "⚽", "win": [3], "multiplier": 2.0, "name": "Футбол"},
@@ -12849,7 +12853,7 @@ async def start_sport_game(message: types.Message):
             add_win_to_user(user_id, won_amount, bet)
             add_game_to_history(user_id, sport.capitalize(), bet, 'win', won_amount)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             if sport == "футбол":
                 result_text = f"⚽ Гол!\n+{won_amount - bet} MORPH"
             elif sport == "баскетбол":
@@ -12863,7 +12867,7 @@ async def start_sport_game(message: types.Message):
         else:
             add_game_to_history(user_id, sport.capitalize(), bet, 'lose', 0)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             result_text = f"[🎯] Мимо\n[❌] Вы проиграли {bet} MORPH"
         await message.reply(result_text)
     except ValueError:
@@ -12872,7 +12876,7 @@ async def start_sport_game(message: types.Message):
 # ИГРА "БАШЕНКА" - ИСПРАВЛЕННАЯ ВЕРСИЯ
 active_tower_games = {}
 
-@router.message(lambda message: message.text and message.text.lower().startswith("башенка"))
+@text_commands.prefix("башенка")
 async def start_tower_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -12912,7 +12916,7 @@ async def start_tower_game(message: types.Message):
         
         # Списываем ставку
         users_data[user_id]['balance'] -= bet
-        save_users()
+        save_user(user_id)
         
         # Инициализация игры с защитой от дюпа
         active_tower_games[user_id] = {
@@ -12972,13 +12976,13 @@ async def send_tower_level(message_or_callback, user_id, reveal=None, win=None):
         # Визуализация текущего уровня с результатом
         for i in range(5):
             if i == reveal:
-                builder.add(InlineKeyboardButton(text=result_emoji, callback_data="tower_wait"))
+                builder.add(InlineKeyboardButton(text=result_emoji, callback_data=make_callback_data("tower", "wait")))
             elif i in mines:
-                builder.add(InlineKeyboardButton(text="💣", callback_data="tower_wait"))
+                builder.add(InlineKeyboardButton(text="💣", callback_data=make_callback_data("tower", "wait")))
             else:
                 # Проверяем, была ли клетка открыта на этом уровне
                 is_opened = any(level == current_level and cell == i for level, cell in game['opened'])
-                builder.add(InlineKeyboardButton(text="🟩" if is_opened else "⬜", callback_data="tower_wait"))
+                builder.add(InlineKeyboardButton(text="🟩" if is_opened else "⬜", callback_data=make_callback_data("tower", "wait")))
         builder.adjust(5)
         
         if win:
@@ -12986,24 +12990,24 @@ async def send_tower_level(message_or_callback, user_id, reveal=None, win=None):
             if current_level < max_level:
                 builder.row(InlineKeyboardButton(
                     text=f"🔼 Уровень {current_level + 1} (+{format_amount(won_amount)})",
-                    callback_data=f"tower_next_{user_id}"
+                    callback_data=make_callback_data("tower", "next", user_id)
                 ))
             else:
                 builder.row(InlineKeyboardButton(
                     text=f"🏆 ЗАБРАТЬ {format_amount(won_amount)} MORPH",
-                    callback_data=f"tower_final_{user_id}"
+                    callback_data=make_callback_data("tower", "final", user_id)
                 ))
             
             # Кнопка забрать выигрыш всегда доступна после успешного хода
             builder.row(InlineKeyboardButton(
                 text=f"💰 Забрать {format_amount(won_amount)} MORPH",
-                callback_data=f"tower_cashout_{user_id}"
+                callback_data=make_callback_data("tower", "cashout", user_id)
             ))
         else:
             # При проигрыше показываем только информацию
             builder.row(InlineKeyboardButton(
                 text="🔄 Играть заново",
-                callback_data=f"tower_restart_{user_id}"
+                callback_data=make_callback_data("tower", "restart", user_id)
             ))
     
     else:
@@ -13012,11 +13016,11 @@ async def send_tower_level(message_or_callback, user_id, reveal=None, win=None):
             # Проверяем, была ли клетка открыта на этом уровне
             is_opened = any(level == current_level and cell == i for level, cell in game['opened'])
             if is_opened:
-                builder.add(InlineKeyboardButton(text="🟩", callback_data="tower_wait"))
+                builder.add(InlineKeyboardButton(text="🟩", callback_data=make_callback_data("tower", "wait")))
             else:
                 builder.add(InlineKeyboardButton(
                     text="⬜",
-                    callback_data=f"tower_pick_{i}_{user_id}"
+                    callback_data=make_callback_data("tower", "pick", i, user_id)
                 ))
         builder.adjust(5)
         
@@ -13024,7 +13028,7 @@ async def send_tower_level(message_or_callback, user_id, reveal=None, win=None):
         if len(game['opened']) > 0:
             builder.row(InlineKeyboardButton(
                 text=f"💰 Забрать {format_amount(won_amount)} MORPH",
-                callback_data=f"tower_cashout_{user_id}"
+                callback_data=make_callback_data("tower", "cashout", user_id)
             ))
     
     # Текст сообщения
@@ -13067,17 +13071,13 @@ async def send_tower_level(message_or_callback, user_id, reveal=None, win=None):
     else:
         await message_or_callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='HTML')
 
-@router.callback_query(lambda c: c.data.startswith("tower_pick_"))
-async def tower_pick_callback(callback: CallbackQuery):
+@callbacks.action("tower", "pick", int, int)
+async def tower_pick_callback(callback: CallbackQuery, cell: int, user_id: int):
     if is_banned(callback.from_user.id):
         await callback.answer("❌ Вы забанены!", show_alert=True)
         return
     
     try:
-        data = callback.data.split("_")
-        cell = int(data[2])
-        user_id = int(data[3])
-        
         # 🔒 ЗАЩИТА: проверяем владельца игры
         if callback.from_user.id != user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -13127,7 +13127,7 @@ async def tower_pick_callback(callback: CallbackQuery):
             game['move_in_progress'] = False
             add_game_to_history(user_id, 'Башенка', game['bet'], 'lose', 0)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             await send_tower_level(callback, user_id, reveal=cell, win=False)
             return
         
@@ -13142,11 +13142,9 @@ async def tower_pick_callback(callback: CallbackQuery):
         print(f"Ошибка в tower_pick_callback: {e}")
         await callback.answer("❌ Произошла ошибка, попробуйте снова", show_alert=True)
 
-@router.callback_query(lambda c: c.data.startswith("tower_next_"))
-async def tower_next_callback(callback: CallbackQuery):
+@callbacks.action("tower", "next", int)
+async def tower_next_callback(callback: CallbackQuery, user_id: int):
     try:
-        user_id = int(callback.data.split("_")[2])
-        
         # 🔒 ЗАЩИТА: проверяем владельца игры
         if callback.from_user.id != user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -13183,11 +13181,9 @@ async def tower_next_callback(callback: CallbackQuery):
         print(f"Ошибка в tower_next_callback: {e}")
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
-@router.callback_query(lambda c: c.data.startswith("tower_final_"))
-async def tower_final_callback(callback: CallbackQuery):
+@callbacks.action("tower", "final", int)
+async def tower_final_callback(callback: CallbackQuery, user_id: int):
     try:
-        user_id = int(callback.data.split("_")[2])
-        
         # 🔒 ЗАЩИТА: проверяем владельца игры
         if callback.from_user.id != user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -13213,7 +13209,7 @@ async def tower_final_callback(callback: CallbackQuery):
         add_win_to_user(user_id, won_amount, bet)
         add_game_to_history(user_id, 'Башенка', bet, 'win', won_amount)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         await callback.message.edit_text(
             quote_html(
@@ -13234,11 +13230,9 @@ async def tower_final_callback(callback: CallbackQuery):
         print(f"Ошибка в tower_final_callback: {e}")
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
-@router.callback_query(lambda c: c.data.startswith("tower_cashout_"))
-async def tower_cashout_callback(callback: CallbackQuery):
+@callbacks.action("tower", "cashout", int)
+async def tower_cashout_callback(callback: CallbackQuery, user_id: int):
     try:
-        user_id = int(callback.data.split("_")[2])
-        
         # 🔒 ЗАЩИТА: проверяем владельца игры
         if callback.from_user.id != user_id:
             await callback.answer("❌ Это не ваша игра!", show_alert=True)
@@ -13269,7 +13263,7 @@ async def tower_cashout_callback(callback: CallbackQuery):
         add_win_to_user(user_id, won_amount, bet)
         add_game_to_history(user_id, 'Башенка', bet, 'win', won_amount)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         
         await callback.message.edit_text(
             quote_html(
@@ -13290,11 +13284,9 @@ async def tower_cashout_callback(callback: CallbackQuery):
         print(f"Ошибка в tower_cashout_callback: {e}")
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
-@router.callback_query(lambda c: c.data.startswith("tower_restart_"))
-async def tower_restart_callback(callback: CallbackQuery):
+@callbacks.action("tower", "restart", int)
+async def tower_restart_callback(callback: CallbackQuery, user_id: int):
     try:
-        user_id = int(callback.data.split("_")[2])
-        
         if user_id in active_tower_games:
             del active_tower_games[user_id]
         
@@ -13310,7 +13302,7 @@ async def tower_restart_callback(callback: CallbackQuery):
         print(f"Ошибка в tower_restart_callback: {e}")
         await callback.answer("❌ Произошла ошибка", show_alert=True)
 
-@router.callback_query(lambda c: c.data == "tower_wait")
+@callbacks.action("tower", "wait")
 async def tower_wait_callback(callback: CallbackQuery):
     await callback.answer("⏳ Ожидайте...")
 
@@ -13320,19 +13312,21 @@ async def cleanup_tower_games():
     current_time = time.time()
     expired_games = []
     
-    for user_id, game in active_tower_games.items():
+    for user_id, game in list(active_tower_games.items()):
         # Если игра висит больше 10 минут - удаляем и возвращаем ставку
         game_timestamp = int(game['game_id'].split('_')[-1])
         if current_time - game_timestamp > 600:  # 10 минут
-            expired_games.append(user_id)
-            # Возвращаем ставку
-            users_data[user_id]['balance'] += game['bet']
-    
-    for user_id in expired_games:
-        del active_tower_games[user_id]
+            async with user_locks.hold(user_id_key(user_id)):
+                # Пока ждали блокировку, игрок мог доиграть партию сам
+                if active_tower_games.get(user_id) is not game:
+                    continue
+                expired_games.append(user_id)
+                del active_tower_games[user_id]
+                # Возвращаем ставку
+                users_data[user_id]['balance'] += game['bet']
+                save_user(user_id)
     
     if expired_games:
-        save_users()
         print(f"Очищено {len(expired_games)} зависших игр в Башенке")
 
 # Запускаем очистку каждые 5 минут
@@ -13352,7 +13346,7 @@ async def main():
     await dp.start_polling(bot)
 
 # Команда рассчитать
-@router.message(lambda message: message.text and message.text.lower().startswith('рассчитать'))
+@text_commands.prefix('рассчитать')
 async def calculate_command(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13431,7 +13425,7 @@ async def calculate_command(message: types.Message):
         await message.reply("❌ <b>Произошла ошибка при обработке команды!</b>", parse_mode="HTML")
 
 # Альтернативные команды для калькулятора
-@router.message(lambda message: message.text and message.text.lower().startswith(('посчитать', 'calc', 'калькулятор')))
+@text_commands.prefix('посчитать', 'calc', 'калькулятор')
 async def calculate_aliases(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13467,7 +13461,7 @@ async def check_channel_subscription(user_id: int, bot: Bot) -> bool:
         return False
 
 # Модифицированная команда бонуса с проверкой подписки
-@router.message(lambda m: m.text and m.text.lower() == "бонус")
+@text_commands.exact("бонус")
 async def bonus_command(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13516,7 +13510,7 @@ async def bonus_command(message: types.Message):
 
     users_data[user_id]['balance'] += final_bonus
     users_data[user_id]['last_bonus'] = now
-    save_users()
+    save_user(user_id)
 
     await message.reply(
         _format_bonus_message(base_bonus, final_bonus, users_data[user_id]['balance'], extra_percent, breakdown),
@@ -13524,7 +13518,7 @@ async def bonus_command(message: types.Message):
     )
 
 # Обработка кнопки проверки подписки для бонуса
-@router.callback_query(lambda c: c.data == "check_subscription_bonus")
+@callbacks.exact("check_subscription_bonus")
 async def check_subscription_bonus(callback: CallbackQuery):
     user_id = callback.from_user.id
     
@@ -13555,7 +13549,7 @@ async def check_subscription_bonus(callback: CallbackQuery):
 
     users_data[user_id]['balance'] += final_bonus
     users_data[user_id]['last_bonus'] = now
-    save_users()
+    save_user(user_id)
     
     await callback.message.edit_text(
         _format_bonus_message(base_bonus, final_bonus, users_data[user_id]['balance'], extra_percent, breakdown),
@@ -13620,7 +13614,7 @@ def _format_bonus_message(base_bonus: int, final_bonus: int, balance: int, extra
     return "\n".join(lines)
 
 # --- Смена ника ---
-@router.message(lambda m: m.text and m.text.lower().startswith("ник "))
+@text_commands.prefix("ник ")
 async def change_nick(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13633,7 +13627,7 @@ async def change_nick(message: types.Message):
         return
     init_user(user_id, message.from_user.username)
     users_data[user_id]['username'] = new_nick
-    save_users()
+    save_user(user_id)
     await message.reply(f" <b>Ваш ник успешно изменён на:</b> <b>{new_nick}</b>", parse_mode="HTML")
 
 # --- Админ-функции ---
@@ -13805,7 +13799,7 @@ def get_target_user(message: types.Message, skip_words: int = 1):
 # --- Команды модерации ---
 
 # Установить создателя чата (только глобальный админ) - оставляем для ручной установки
-@router.message(lambda message: message.text and (message.text.lower().startswith('setcreator') or message.text.lower().startswith('установить создателя')))
+@text_commands.prefix('setcreator', 'установить создателя')
 async def set_creator(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13845,7 +13839,7 @@ async def set_creator(message: types.Message):
     )
 
 # Назначить модератора (только создатель)
-@router.message(lambda message: message.text and (message.text.lower().startswith('setmod') or message.text.lower().startswith('назначить модератора') or message.text.lower().startswith('добавить модератора')))
+@text_commands.prefix('setmod', 'назначить модератора', 'добавить модератора')
 async def set_moderator(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -13988,7 +13982,7 @@ async def set_moderator(message: types.Message):
         )
 
 # Убрать модератора (только создатель)
-@router.message(lambda message: message.text and (message.text.lower().startswith('delmod') or message.text.lower().startswith('убрать модератора') or message.text.lower().startswith('удалить модератора')))
+@text_commands.prefix('delmod', 'убрать модератора', 'удалить модератора')
 async def del_moderator(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14046,7 +14040,7 @@ async def del_moderator(message: types.Message):
     await message.reply(f"✅ Модератор <b>@{target_username}</b> убран!", parse_mode="HTML")
 
 # Список модераторов
-@router.message(lambda message: message.text and message.text.lower() in ['modlist', 'модлист', 'список модераторов', 'модераторы', 'моды', 'админы', 'администраторы'])
+@text_commands.exact('modlist', 'модлист', 'список модераторов', 'модераторы', 'моды', 'админы', 'администраторы')
 async def mod_list(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14078,7 +14072,7 @@ async def mod_list(message: types.Message):
     await message.reply(quote_html(text), parse_mode="HTML")
 
 # Мут пользователя (ранг 1+)
-@router.message(lambda message: message.text and (message.text.lower().startswith('mute') or message.text.lower().startswith('мут') or message.text.lower().startswith('замутить')))
+@text_commands.prefix('mute', 'мут', 'замутить')
 async def mute_user(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14187,6 +14181,7 @@ async def mute_user(message: types.Message):
     
     chat_mutes[chat_id][target] = end_time
     save_mutes()
+    await mutes_ref.child(str(chat_id)).child(str(target)).aset_expiry(end_time)
     
     target_username = users_data.get(target, {}).get('username', f'User{target}')
     await message.reply(
@@ -14198,7 +14193,7 @@ async def mute_user(message: types.Message):
     )
 
 # Размут пользователя (ранг 1+)
-@router.message(lambda message: message.text and (message.text.lower().startswith('unmute') or message.text.lower().startswith('размут') or message.text.lower().startswith('размутить')))
+@text_commands.prefix('unmute', 'размут', 'размутить')
 async def unmute_user(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14270,11 +14265,7 @@ async def unmute_user(message: types.Message):
     await message.reply(f"🔊 <b>Пользователь @{target_username} размучен!</b>", parse_mode="HTML")
 
 # Бан пользователя в чате (ранг 2+)
-@router.message(lambda message: message.text and (
-    (message.text.lower().startswith('ban') and not message.text.lower().startswith('banuser')) or
-    message.text.lower().startswith('бан') or
-    message.text.lower().startswith('забанить')
-))
+@text_commands.prefix('ban', 'бан', 'забанить', when=lambda message: not message.text.lower().startswith('banuser'))
 async def ban_user_chat(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14350,11 +14341,7 @@ async def ban_user_chat(message: types.Message):
         await message.reply("❌ Пользователь уже забанен в этом чате.")
 
 # Разбан пользователя (ранг 2+)
-@router.message(lambda message: message.text and (
-    (message.text.lower().startswith('unban') and not message.text.lower().startswith('unbanuser')) or
-    message.text.lower().startswith('разбан') or
-    message.text.lower().startswith('разбанить')
-))
+@text_commands.prefix('unban', 'разбан', 'разбанить', when=lambda message: not message.text.lower().startswith('unbanuser'))
 async def unban_user_chat(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14415,7 +14402,7 @@ async def unban_user_chat(message: types.Message):
 # --- Команды для правил чата ---
 
 # Установить правила чата (только создатель/админ)
-@router.message(lambda message: message.text and message.text.lower().startswith('+правила'))
+@text_commands.prefix('+правила')
 async def set_chat_rules(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14462,7 +14449,7 @@ async def set_chat_rules(message: types.Message):
     )
 
 # Просмотр правил чата
-@router.message(lambda message: message.text and message.text.lower() in ['правила', 'rules', 'правила чата'])
+@text_commands.exact('правила', 'rules', 'правила чата')
 async def show_chat_rules(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14492,43 +14479,46 @@ async def show_chat_rules(message: types.Message):
 async def check_and_unmute_users():
     """Проверяет истекшие муты и размучивает пользователей"""
     current_time = time.time()
-    chats_to_clean = []
     has_changes = False
     
-    for chat_id, mutes in list(chat_mutes.items()):
-        users_to_remove = []
-        for user_id, end_time in list(mutes.items()):
-            if current_time > end_time:
-                users_to_remove.append(user_id)
-                has_changes = True
-                
-                # Восстанавливаем права пользователя
-                try:
-                    await bot.restrict_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id,
-                        permissions=types.ChatPermissions(
-                            can_send_messages=True,
-                            can_send_media_messages=True,
-                            can_send_polls=True,
-                            can_send_other_messages=True,
-                            can_add_web_page_previews=True,
-                            can_change_info=False,
-                            can_invite_users=False,
-                            can_pin_messages=False
-                        )
-                    )
-                except Exception as e:
-                    print(f"Ошибка при автоматическом размуте пользователя {user_id} в чате {chat_id}: {e}")
+    # Из базы приходят только муты с наступившим сроком, а не все подряд
+    for path in await mutes_ref.apop_expired(current_time):
+        try:
+            chat_id, user_id = int(path[0]), int(path[1])
+        except (IndexError, ValueError):
+            continue
+        mutes = chat_mutes.get(chat_id, {})
+        end_time = mutes.get(user_id)
+        if end_time is None:
+            continue  # Мут уже снят вручную
+        if current_time <= end_time:
+            # Мут продлили — возвращаем его срок в индекс
+            await mutes_ref.child(str(chat_id)).child(str(user_id)).aset_expiry(end_time)
+            continue
+        has_changes = True
         
-        for user_id in users_to_remove:
-            del mutes[user_id]
+        # Восстанавливаем права пользователя
+        try:
+            await bot.restrict_chat_member(
+                chat_id=chat_id,
+                user_id=user_id,
+                permissions=types.ChatPermissions(
+                    can_send_messages=True,
+                    can_send_media_messages=True,
+                    can_send_polls=True,
+                    can_send_other_messages=True,
+                    can_add_web_page_previews=True,
+                    can_change_info=False,
+                    can_invite_users=False,
+                    can_pin_messages=False
+                )
+            )
+        except Exception as e:
+            print(f"Ошибка при автоматическом размуте пользователя {user_id} в чате {chat_id}: {e}")
         
+        del mutes[user_id]
         if not mutes:
-            chats_to_clean.append(chat_id)
-    
-    for chat_id in chats_to_clean:
-        del chat_mutes[chat_id]
+            del chat_mutes[chat_id]
     
     if has_changes:
         save_mutes()
@@ -14568,7 +14558,7 @@ async def check_mute_ban_before_message(message: types.Message) -> bool:
     return False
 
 # --- Админ-команды (работают по reply, юзернейму и ID) ---
-@router.message(lambda message: message.text and message.text.lower().startswith('banuser'))
+@text_commands.prefix('banuser')
 async def ban_user(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14618,7 +14608,7 @@ async def ban_user(message: types.Message):
     else:
         await message.reply('Пользователь уже в бане.')
 
-@router.message(lambda message: message.text and message.text.lower().startswith('unbanuser'))
+@text_commands.prefix('unbanuser')
 async def unban_user(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14663,7 +14653,7 @@ async def unban_user(message: types.Message):
     else:
         await message.reply('Пользователь не был в бане.')
 
-@router.message(lambda message: message.reply_to_message and message.text and message.text.upper().startswith('ВЫДАТЬ '))
+@text_commands.prefix('выдать ', when=lambda message: message.reply_to_message)
 async def admin_give_morph(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14684,10 +14674,10 @@ async def admin_give_morph(message: types.Message):
     to_id = message.reply_to_message.from_user.id
     init_user(to_id, message.reply_to_message.from_user.username)
     users_data[to_id]['balance'] += amount
-    save_users()
+    save_user(to_id)
     await message.reply(f'💸 <b>Выдано {format_amount(amount)} MORPH игроку {to_id}</b>', parse_mode='HTML')
 
-@router.message(lambda message: message.reply_to_message and message.text and message.text.upper().startswith('ЗАБРАТЬ '))
+@text_commands.prefix('забрать ', when=lambda message: message.reply_to_message)
 async def admin_take_morph(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14708,11 +14698,11 @@ async def admin_take_morph(message: types.Message):
     to_id = message.reply_to_message.from_user.id
     init_user(to_id, message.reply_to_message.from_user.username)
     users_data[to_id]['balance'] = max(0, users_data[to_id]['balance'] - amount)
-    save_users()
+    save_user(to_id)
     await message.reply(f'💰 <b>Забрано {format_amount(amount)} MORPH у игрока {to_id}</b>', parse_mode='HTML')
 
 # Команда выдачи VIP подписки
-@router.message(lambda message: message.reply_to_message and message.text and message.text.lower().startswith('+вип'))
+@text_commands.prefix('+вип', when=lambda message: message.reply_to_message)
 async def admin_give_vip(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14733,6 +14723,7 @@ async def admin_give_vip(message: types.Message):
     
     vip_subscriptions[target_id] = end_time
     save_vip_subscriptions()
+    await vip_subscriptions_ref.child(str(target_id)).aset_expiry(end_time)
     
     end_date = datetime.fromtimestamp(end_time).strftime('%d.%m.%Y %H:%M')
     target_username = users_data.get(target_id, {}).get('username', f'User{target_id}')
@@ -14747,7 +14738,7 @@ async def admin_give_vip(message: types.Message):
 
 # Команда обнулить MORPH пользователя
 # Команда обнулить MORPH пользователя (с обнулением банка)
-@router.message(lambda message: message.text and message.text.lower().startswith('обнулить'))
+@text_commands.prefix('обнулить')
 async def admin_reset_morph(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -14799,7 +14790,7 @@ async def admin_reset_morph(message: types.Message):
     users_data[target]['balance'] = 0
     users_data[target]['bank'] = 0  # Банк тоже обнуляется
     users_data[target]['total_won'] = 0
-    save_users()
+    save_user(target)
     
     username = users_data[target].get('username', f'User{target}')
     await message.reply(
@@ -14812,7 +14803,7 @@ async def admin_reset_morph(message: types.Message):
 
 # --- ПРОМОКОДЫ ---
 # Модифицированная команда промокода с проверкой подписки
-@router.message(lambda message: message.text and message.text.lower().startswith('промо '))
+@text_commands.prefix('промо ')
 async def activate_promocode(message: types.Message):
     parts = message.text.split()
     if len(parts) != 2:
@@ -14863,7 +14854,7 @@ async def activate_promocode(message: types.Message):
     users_data[user_id]['balance'] += promo['amount']
     promo['activations'] -= 1
     promo['used'].append(user_id)
-    save_users()
+    save_user(user_id)
     save_promocodes()
     
     await message.reply(
@@ -14874,7 +14865,7 @@ async def activate_promocode(message: types.Message):
     )
 
 # Обработка кнопки проверки подписки для промокода
-@router.callback_query(lambda c: c.data.startswith('check_subscription_promo_'))
+@callbacks.prefix('check_subscription_promo_')
 async def check_subscription_promo(callback: CallbackQuery):
     code = callback.data.split('_')[3]
     user_id = callback.from_user.id
@@ -14906,7 +14897,7 @@ async def check_subscription_promo(callback: CallbackQuery):
     users_data[user_id]['balance'] += promo['amount']
     promo['activations'] -= 1
     promo['used'].append(user_id)
-    save_users()
+    save_user(user_id)
     save_promocodes()
     
     await callback.message.edit_text(
@@ -14918,7 +14909,7 @@ async def check_subscription_promo(callback: CallbackQuery):
     await callback.answer("🎁 Промокод активирован!")
 
 # Команда создания промокода
-@router.message(lambda message: message.text and message.text.lower().startswith('создать промо '))
+@text_commands.prefix('создать промо ')
 async def create_promocode(message: types.Message):
     user_id = message.from_user.id
     is_admin = user_id in ADMIN_IDS
@@ -14978,7 +14969,7 @@ async def create_promocode(message: types.Message):
             )
             return
         users_data[user_id]['balance'] -= total_cost
-        save_users()
+        save_user(user_id)
         deducted_text = (
             f"\n💳 Списано с баланса: <b>{format_amount(total_cost)} MORPH</b>\n"
             f"💰 Текущий баланс: <b>{format_amount(users_data[user_id]['balance'])} MORPH</b>"
@@ -15040,7 +15031,7 @@ def format_hand(hand, hide_first=False):
         return '🂠 ' + ' '.join([f"{v}{s}" for v, s in hand[1:]])
     return ' '.join([f"{v}{s}" for v, s in hand])
 
-@router.message(lambda message: message.text and (message.text.lower().startswith('блэкджек') or message.text.lower().startswith('бж')))
+@text_commands.prefix('блэкджек', 'бж')
 async def start_blackjack(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15061,7 +15052,7 @@ async def start_blackjack(message: types.Message):
         await message.reply(error_msg)
         return
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     # Создаём колоду и сдаём карты
     deck = [(v, s) for v in CARD_VALUES for s in CARD_SUITS]
     random.shuffle(deck)
@@ -15124,18 +15115,18 @@ async def send_blackjack_state(message_or_callback, user_id, reveal_dealer=False
             add_win_to_user(user_id, win_amount, bet)
             add_game_to_history(user_id, 'Блэкджек', bet, 'win', win_amount)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             text += f"\n\n🎉 <b>Вы выиграли!</b> +{format_amount(win_amount)} MORPH"
         elif result == 'draw':
             users_data[user_id]['balance'] += bet
             add_game_to_history(user_id, 'Блэкджек', bet, 'draw', bet)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             text += f"\n\n🤝 <b>Ничья!</b> Ставка возвращена."
         else:
             add_game_to_history(user_id, 'Блэкджек', bet, 'lose', 0)
             users_data[user_id]['games_played'] += 1
-            save_users()
+            save_user(user_id)
             text += f"\n\n❌ <b>Вы проиграли!</b>"
         
         # Помечаем игру как завершенную
@@ -15155,7 +15146,7 @@ async def send_blackjack_state(message_or_callback, user_id, reveal_dealer=False
     else:
         await message_or_callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='HTML')
 
-@router.callback_query(lambda c: c.data.startswith('blackjack_hit_'))
+@callbacks.prefix('blackjack_hit_')
 async def blackjack_hit_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     if user_id != callback.from_user.id:
@@ -15189,7 +15180,7 @@ async def blackjack_hit_callback(callback: CallbackQuery):
         await send_blackjack_state(callback, user_id)
     await callback.answer()
 
-@router.callback_query(lambda c: c.data.startswith('blackjack_stand_'))
+@callbacks.prefix('blackjack_stand_')
 async def blackjack_stand_callback(callback: CallbackQuery):
     user_id = int(callback.data.split('_')[-1])
     if user_id != callback.from_user.id:
@@ -15225,7 +15216,7 @@ async def main():
     dp.include_router(router)
     await dp.start_polling(bot)
 
-@router.message(lambda message: message.text and message.text.lower().startswith('флип'))
+@text_commands.prefix('флип')
 async def flip_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15256,7 +15247,7 @@ async def flip_game(message: types.Message):
         await message.reply('❌ Выберите: орел (О) или решка (Р)')
         return
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     result = random.choice(['орел', 'решка'])
     win = (choice == result)
     if win:
@@ -15264,15 +15255,15 @@ async def flip_game(message: types.Message):
         add_win_to_user(user_id, win_amount, bet)
         add_game_to_history(user_id, 'Флип', bet, 'win', win_amount)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         await message.reply(f'🪙 Флип: {result.capitalize()}!\n🎉 Победа! +{format_amount(win_amount)} MORPH')
     else:
         add_game_to_history(user_id, 'Флип', bet, 'lose', 0)
         users_data[user_id]['games_played'] += 1
-        save_users()
+        save_user(user_id)
         await message.reply(f'🪙 Флип: {result.capitalize()}!\n❌ Проигрыш: {format_amount(bet)} MORPH')
 
-@router.message(lambda message: message.text and (message.text.lower().startswith('блэкджек') or message.text.lower().startswith('бж')))
+@text_commands.prefix('блэкджек', 'бж')
 async def start_blackjack(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15291,7 +15282,7 @@ async def start_blackjack(message: types.Message):
         await message.reply(error_msg)
         return
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     # Создаём колоду и сдаём карты
     deck = [(v, s) for v in CARD_VALUES for s in CARD_SUITS]
     random.shuffle(deck)
@@ -15321,9 +15312,6 @@ def save_last_game(user_id: int, command: str, bet: int, params: dict = None):
 
 def add_game_to_history(user_id: int, game_name: str, bet: int, result: str, amount: int = 0):
     """Добавляет игру в историю пользователя"""
-    if user_id not in user_game_history:
-        user_game_history[user_id] = []
-    
     game_entry = {
         'game': game_name,
         'bet': bet,
@@ -15332,13 +15320,8 @@ def add_game_to_history(user_id: int, game_name: str, bet: int, result: str, amo
         'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
     
-    user_game_history[user_id].append(game_entry)
-    
-    # Оставляем только последние 50 игр (чтобы не перегружать)
-    if len(user_game_history[user_id]) > 50:
-        user_game_history[user_id] = user_game_history[user_id][-50:]
-    
-    save_game_history()
+    # Одна вставка в фоне; храним только последние GAME_HISTORY_KEEP игр (чтобы не перегружать)
+    game_history_log.append_nowait(user_id, game_entry, keep=GAME_HISTORY_KEEP)
 
 def track_user_action(user_id: int):
     """Отслеживает действия пользователя для ежедневного бонуса"""
@@ -15359,7 +15342,7 @@ def track_user_action(user_id: int):
         if user_id in users_data:
             bonus = 5000
             users_data[user_id]['balance'] += bonus
-            save_users()
+            save_user(user_id)
             
             # Отправляем уведомление (асинхронно через задачу)
             asyncio.create_task(send_activity_bonus_notification(user_id, bonus))
@@ -15378,7 +15361,7 @@ async def send_activity_bonus_notification(user_id: int, bonus: int):
         pass  # Пользователь заблокировал бота или ошибка
 
 # 🎮 1. ИГРА "ТРИ СОКРОВИЩА"
-@router.message(lambda message: message.text and message.text.lower().startswith(('БРБРПАТАПИМАЛОЛКЕК')))
+@text_commands.prefix('БРБРПАТАПИМАЛОЛКЕК')
 async def start_treasures_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15408,7 +15391,7 @@ async def start_treasures_game(message: types.Message):
         return
     
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем для команды "повторить"
     save_last_game(user_id, 'сокровища', bet)
@@ -15420,9 +15403,9 @@ async def start_treasures_game(message: types.Message):
     track_user_action(user_id)
     
     builder = InlineKeyboardBuilder()
-    builder.button(text="📦 Сундук 1", callback_data=f"treasure_{user_id}_1_{bet}")
-    builder.button(text="📦 Сундук 2", callback_data=f"treasure_{user_id}_2_{bet}")
-    builder.button(text="📦 Сундук 3", callback_data=f"treasure_{user_id}_3_{bet}")
+    builder.button(text="📦 Сундук 1", callback_data=f"treasure_{user_id}_1")
+    builder.button(text="📦 Сундук 2", callback_data=f"treasure_{user_id}_2")
+    builder.button(text="📦 Сундук 3", callback_data=f"treasure_{user_id}_3")
     builder.adjust(3)
     
     await message.reply(
@@ -15433,12 +15416,11 @@ async def start_treasures_game(message: types.Message):
         parse_mode="HTML"
     )
 
-@router.callback_query(lambda c: c.data.startswith('treasure_'))
+@callbacks.prefix('treasure_')
 async def treasure_callback(callback: CallbackQuery):
     parts = callback.data.split('_')
     user_id = int(parts[1])
     chest_num = int(parts[2])
-    bet = int(parts[3])
     
     if user_id != callback.from_user.id:
         await callback.answer('❌ Это не ваша игра!', show_alert=True)
@@ -15456,10 +15438,8 @@ async def treasure_callback(callback: CallbackQuery):
         await callback.answer('❌ Игра уже завершена!', show_alert=True)
         return
     
-    # Проверяем, что ставка совпадает
-    if game.get('bet') != bet:
-        await callback.answer('❌ Неверная ставка!', show_alert=True)
-        return
+    # Ставка берётся из состояния игры: в callback_data большая ставка не влезает
+    bet = game['bet']
     
     # Помечаем игру как завершенную перед обработкой
     game['finished'] = True
@@ -15494,7 +15474,7 @@ async def treasure_callback(callback: CallbackQuery):
         text = f'📦 <b>Сундук {chest_num}</b>\n\n🎁✨ РЕДКИЙ БОНУС! ✨🎁\n💰 +{format_amount(win_amount)} MORPH (x{multiplier})'
         add_game_to_history(user_id, 'Три Сокровища', bet, 'win', win_amount)
     
-    save_users()
+    save_user(user_id)
     
     # Добавляем кнопки обратной связи
     builder = InlineKeyboardBuilder()
@@ -15511,7 +15491,7 @@ async def treasure_callback(callback: CallbackQuery):
     await callback.answer()
 
 # 🎲 2. ИГРА "РОВНЫЙ ШАНС"
-@router.message(lambda message: message.text and message.text.lower().startswith('ошещцщцишжегор45789784383480943'))
+@text_commands.prefix('ошещцщцишжегор45789784383480943')
 async def start_even_chance(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15542,7 +15522,7 @@ async def start_even_chance(message: types.Message):
         return
     
     users_data[user_id]['balance'] -= bet
-    save_users()
+    save_user(user_id)
     
     # Сохраняем для команды "повторить"
     save_last_game(user_id, 'ровно', bet)
@@ -15580,7 +15560,7 @@ async def start_even_chance(message: types.Message):
         text = f'🎲 <b>РОВНЫЙ ШАНС</b>\n\n🎁 Удача! Победа x{multiplier}!\n💰 +{format_amount(win_amount)} MORPH'
         add_game_to_history(user_id, 'Ровный Шанс', bet, 'win', win_amount)
     
-    save_users()
+    save_user(user_id)
     
     # Добавляем кнопки обратной связи
     builder = InlineKeyboardBuilder()
@@ -15590,7 +15570,7 @@ async def start_even_chance(message: types.Message):
     await message.reply(text, reply_markup=builder.as_markup(), parse_mode="HTML")
 
 # ⚡ 3. КОМАНДА "ПОВТОРИТЬ"
-@router.message(lambda message: message.text and message.text.lower() in ['повторить', 'repeat', 'ре'])
+@text_commands.exact('повторить', 'repeat', 'ре')
 async def repeat_last_game(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15624,7 +15604,7 @@ async def repeat_last_game(message: types.Message):
         await message.reply(f'❌ Игра "{command}" пока не поддерживает повтор')
 
 # 🏆 КОМАНДА "ЛИДЕРБОРД" - Топ игроков по выигранным морфам за день
-@router.message(lambda message: message.text and message.text.lower() in ['лидерборд', 'leaderboard', 'топ дня', 'топ за день'])
+@text_commands.exact('лидерборд', 'leaderboard', 'топ дня', 'топ за день')
 async def show_leaderboard(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15715,7 +15695,7 @@ async def show_leaderboard(message: types.Message):
     await message.reply(quote_html(text), parse_mode="HTML")
 
 # 📜 КОМАНДА "ЛАСТ" - История последних игр
-@router.message(lambda message: message.text and message.text.lower() in ['ласт', 'last', 'история'])
+@text_commands.exact('ласт', 'last', 'история')
 async def show_game_history(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15723,7 +15703,9 @@ async def show_game_history(message: types.Message):
     user_id = message.from_user.id
     init_user(user_id, message.from_user.username)
     
-    if user_id not in user_game_history or len(user_game_history[user_id]) == 0:
+    # Берем последние 10 игр (от новых к старым)
+    history = await game_history_log.arecent(user_id, 10)
+    if not history:
         await message.reply(
             quote_html(
                 '📜 <b>ИСТОРИЯ ИГР</b>\n\n'
@@ -15734,10 +15716,6 @@ async def show_game_history(message: types.Message):
         )
         return
     
-    # Берем последние 10 игр
-    history = user_game_history[user_id][-10:]
-    history.reverse()  # Показываем от новых к старым
-    
     text = '📜 <b>ПОСЛЕДНИЕ 10 ИГР</b>\n\n'
     
     for i, game in enumerate(history, 1):
@@ -15776,7 +15754,7 @@ async def show_game_history(message: types.Message):
     await message.reply(quote_html(text), parse_mode="HTML")
 
 # 🎯 4. КОМАНДА "ЧТО ПОИГРАТЬ"
-@router.message(lambda message: message.text and message.text.lower() in ['что поиграть', 'что играть', 'рекомендации'])
+@text_commands.exact('что поиграть', 'что играть', 'рекомендации')
 async def game_recommendations(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15800,7 +15778,7 @@ async def game_recommendations(message: types.Message):
     await message.reply(text, parse_mode="HTML")
 
 # 👍 5. ОБРАТНАЯ СВЯЗЬ (нравится/не нравится)
-@router.callback_query(lambda c: c.data.startswith('feedback_'))
+@callbacks.prefix('feedback_')
 async def feedback_callback(callback: CallbackQuery):
     parts = callback.data.split('_')
     action = parts[1]  # like или dislike
@@ -15887,7 +15865,7 @@ async def cleanup_old_data():
         print(f"🧹 Очищено {cleaned} устаревших записей")
 
 # 🕊 8. РЕЖИМ "ТИХО"
-@router.message(lambda message: message.text and message.text.lower() in ['тихо', 'quiet', 'silent'])
+@text_commands.exact('тихо', 'quiet', 'silent')
 async def toggle_quiet_mode(message: types.Message):
     if is_banned(message.from_user.id):
         return
@@ -15964,7 +15942,7 @@ def add_win_to_user(user_id: int, win_amount: int, bet: int = 0):
     if net_win > 0:
         update_leaderboard(user_id, net_win)
     
-    save_users()
+    save_user(user_id)
 
 # Функция для обновления лидерборда
 def update_leaderboard(user_id: int, won_amount: int):
@@ -16009,8 +15987,9 @@ async def reset_leaderboard_and_reward():
         if place in rewards:
             reward = rewards[place]
             if user_id in users_data:
-                users_data[user_id]['balance'] += reward
-                save_users()
+                async with user_locks.hold(user_id_key(user_id)):
+                    users_data[user_id]['balance'] += reward
+                    save_user(user_id)
                 
                 # Отправляем уведомление
                 try:
@@ -16033,6 +16012,139 @@ async def reset_leaderboard_and_reward():
     
     print(f"✅ Лидерборд обновлен, награды выданы топ-5 игрокам")
 
+# Фоновый проход миграций: поднимает версию записей, к которым ещё не обращались
+async def migrate_records_in_background(batch_size: int = 500):
+    upgraded_users = 0
+    for index, user_id in enumerate(list(users_data)):
+        user = users_data.get(user_id)
+        if isinstance(user, dict) and user.get('schema_version') != user_migrations.latest:
+            async with user_locks.hold(user_id_key(user_id)):
+                # Пока ждали блокировку, запись мог поднять обработчик игрока
+                if user.get('schema_version') != user_migrations.latest:
+                    user_migrations.upgrade(user)
+                    save_user(user_id)
+                    upgraded_users += 1
+        if index % batch_size == batch_size - 1:
+            await asyncio.sleep(0)  # Не блокируем обработку сообщений
+    
+    upgraded_cities = 0
+    for index, user_id in enumerate(list(user_cities)):
+        city = user_cities.get(user_id)
+        if isinstance(city, dict) and city.get('schema_version') != city_migrations.latest:
+            city_migrations.upgrade(city)
+            upgraded_cities += 1
+        if index % batch_size == batch_size - 1:
+            await asyncio.sleep(0)
+    if upgraded_cities:
+        save_cities()
+    
+    if upgraded_users or upgraded_cities:
+        print(f"✅ Миграции записей: обновлено {upgraded_users} игроков, {upgraded_cities} городов")
+
+async def backup_scheduler():
+    """Периодический онлайн-бэкап базы (MORPH_BACKUP_INTERVAL=0 отключает)"""
+    if BACKUP_INTERVAL_HOURS <= 0:
+        return
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            report = await asyncio.to_thread(local_database.backup, BACKUP_DIR, BACKUP_KEEP)
+            logging.info(
+                "Бэкап базы %s: %.1f МБ за %.2f с (%.1f МБ/с, перезапусков: %d)",
+                report.path,
+                report.size / 1024 / 1024,
+                report.duration,
+                report.throughput / 1024 / 1024,
+                report.restarts,
+            )
+        except Exception:
+            logging.exception("Не удалось сделать бэкап базы в %s", BACKUP_DIR)
+
+def format_metrics_report(limit: int = 15, sort: str = "total") -> str:
+    calls, errors, seconds = handler_metrics.totals()
+    since = datetime.fromtimestamp(handler_metrics.since).strftime('%d.%m %H:%M')
+    lines = [
+        f"📊 <b>Метрики обработчиков</b> (с {since})",
+        f"Вызовов: {calls}, ошибок: {errors}, всего {seconds:.1f} с",
+        f"Сортировка: {sort}, время в мс",
+        "",
+    ]
+    rows = [f"{'обработчик':<19} {'вызовы':>6} {'ош':>3} {'p50':>5} {'p95':>5} {'p99':>5} {'база':>5} {'api':>5}"]
+    for report in handler_metrics.reports(sort)[:limit]:
+        rows.append(
+            f"{report.name[:19]:<19} {report.calls:>6} {report.errors:>3} "
+            f"{format_ms(report.p50):>5} {format_ms(report.p95):>5} {format_ms(report.p99):>5} "
+            f"{format_ms(report.storage / report.calls):>5} {format_ms(report.api / report.calls):>5}"
+        )
+    lines.append("<pre>" + "\n".join(rows) + "</pre>")
+    lines.append("«база» и «api» — среднее время на вызов")
+    locks = user_locks.stats()
+    lines.append(
+        f"\n🔒 Блокировки: {locks.acquired} захватов, {locks.contended} с ожиданием, "
+        f"ждут сейчас {locks.waiting}, ключей {locks.keys}; "
+        f"ожидание p95 {format_ms(locks.wait_p95)} мс, макс. {format_ms(locks.wait_max)} мс"
+    )
+    buckets, rejected, by_command = command_limiter.stats()
+    limits_line = f"⏱ Лимиты команд: отклонено {rejected}, активных корзин {buckets}"
+    top_rejected = sorted(by_command.items(), key=lambda item: item[1], reverse=True)[:5]
+    if top_rejected:
+        limits_line += ": " + ", ".join(
+            f"{' '.join(command) if isinstance(command, tuple) else command} — {count}"
+            for command, count in top_rejected
+        )
+    lines.append(limits_line)
+    return "\n".join(lines)
+
+@text_commands.prefix("метрики", "metrics")
+async def cmd_metrics(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.reply('⛔ Нет прав!')
+        return
+    
+    args = message.text.lower().split()[1:]
+    if args and args[0] in ("сброс", "reset"):
+        handler_metrics.reset()
+        user_locks.reset_stats()
+        command_limiter.reset_stats()
+        await message.reply("✅ Метрики обработчиков сброшены")
+        return
+    
+    limit = 15
+    sort = "total"
+    for arg in args:
+        if arg.isdigit():
+            limit = max(1, min(int(arg), 40))
+        elif arg in SORT_KEYS:
+            sort = arg
+        else:
+            await message.reply(
+                "❌ <b>Использование:</b> метрики [число] [total/calls/p95/p99/errors]\n"
+                "🔄 <b>метрики сброс</b> — начать подсчет заново",
+                parse_mode='HTML'
+            )
+            return
+    
+    await message.reply(format_metrics_report(limit, sort), parse_mode='HTML')
+
+async def metrics_logger():
+    """Периодически пишет в лог самые нагруженные обработчики (MORPH_METRICS_INTERVAL=0 отключает)"""
+    if METRICS_LOG_INTERVAL <= 0:
+        return
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL * 60)
+        calls, errors, seconds = handler_metrics.totals()
+        top = ", ".join(
+            f"{report.name} {report.calls}x p95={format_ms(report.p95)}мс"
+            for report in handler_metrics.reports()[:5]
+        )
+        locks = user_locks.stats()
+        logging.info(
+            "Обработчики: %d вызовов, %d ошибок, %.1f с; больше всего времени: %s; "
+            "блокировки: %d с ожиданием из %d, ожидание p95 %s мс, ключей %d",
+            calls, errors, seconds, top or "-",
+            locks.contended, locks.acquired, format_ms(locks.wait_p95), locks.keys,
+        )
+
 # Планировщик для очистки и напоминаний
 async def scheduler_task():
     """Фоновая задача для очистки данных и напоминаний"""
@@ -16067,9 +16179,17 @@ async def scheduler_task():
             # Проверяем истекшие муты каждую минуту
             await check_and_unmute_users()
             
-            # Проверяем истекшие VIP подписки каждую минуту
+            # Проверяем истекшие VIP подписки каждую минуту (только наступившие сроки из базы)
             current_time = time.time()
-            expired_vips = [uid for uid, end_time in list(vip_subscriptions.items()) if end_time < current_time]
+            expired_vips = []
+            for path in await vip_subscriptions_ref.apop_expired(current_time):
+                uid = int(path[0]) if path and path[0].lstrip('-').isdigit() else None
+                if uid is None or uid not in vip_subscriptions:
+                    continue
+                if vip_subscriptions[uid] < current_time:
+                    expired_vips.append(uid)
+                else:
+                    await vip_subscriptions_ref.child(str(uid)).aset_expiry(vip_subscriptions[uid])
             if expired_vips:
                 for uid in expired_vips:
                     del vip_subscriptions[uid]
@@ -16085,18 +16205,20 @@ print("Бот сделан компанией -ARGUS-")
 
 # Обработчик для всех обычных сообщений (не команд) - должен быть последним
 # Этот обработчик срабатывает только если другие хендлеры не обработали сообщение
-# Используем фильтр, который исключает все известные команды
+# Используем фильтр, который исключает все известные команды (префиксы в дереве)
+COMMAND_LIKE_PREFIXES = PrefixTrie([
+    'топ', 'top', 'правила', 'rules', 'модераторы', 'админы', 'моды',
+    'мут', 'бан', 'размут', 'разбан', 'mute', 'ban', 'unmute', 'unban',
+    'назначить модератора', 'убрать модератора', 'setmod', 'delmod',
+    '+правила', 'помощь', 'help', 'игры', 'games', 'баланс', 'б',
+    'профиль', 'банк', 'bank', 'бонус', 'моя рефка', 'рефка',
+    'лидерборд', 'leaderboard', 'топ дня', 'топ за день'
+])
+
 @router.message(
-    lambda m: m.text and 
+    lambda m: m.text and
     not m.text.startswith('/') and
-    not any(m.text.lower().startswith(cmd) for cmd in [
-        'топ', 'top', 'правила', 'rules', 'модераторы', 'админы', 'моды',
-        'мут', 'бан', 'размут', 'разбан', 'mute', 'ban', 'unmute', 'unban',
-        'назначить модератора', 'убрать модератора', 'setmod', 'delmod',
-        '+правила', 'помощь', 'help', 'игры', 'games', 'баланс', 'б',
-        'профиль', 'банк', 'bank', 'бонус', 'моя рефка', 'рефка',
-        'лидерборд', 'leaderboard', 'топ дня', 'топ за день'
-    ])
+    not COMMAND_LIKE_PREFIXES.has_prefix_of(m.text.lower())
 )
 async def handle_all_messages(message: types.Message):
     """Обрабатывает все сообщения, которые не были обработаны другими хендлерами"""
@@ -16113,8 +16235,17 @@ async def main():
     # Запускаем планировщики в фоне
     asyncio.create_task(hourly_promo_scheduler(bot))
     asyncio.create_task(scheduler_task())
+    asyncio.create_task(migrate_records_in_background())
+    asyncio.create_task(backup_scheduler())
+    asyncio.create_task(metrics_logger())
+    flusher = asyncio.create_task(write_behind.run())
     
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # run() делает финальный flush через поток записи, после уже начатых пачек
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
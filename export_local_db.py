@@ -0,0 +1,206 @@
+"""Export the local SQLite store to JSON or NDJSON.
+
+Usage
+-----
+python export_local_db.py [--database path/to/storage.sqlite3] [--output dump.json]
+python export_local_db.py --format ndjson --root users_data --root cities_data -o users.ndjson
+
+The database is opened read-only inside one read transaction, so the export is a
+consistent snapshot and can run next to the live bot without blocking its writes. Rows
+are streamed one at a time: memory use does not grow with the size of the database.
+
+The JSON output has the shape `import_firebase_dump.py` expects. History streams (e.g.
+`game_history`) are exported as `{owner: [entries]}` roots, the legacy layout the bot
+moves back into its history log on startup. NDJSON output has one line per storage row:
+`{"root": ..., "child": ..., "value": ...}`, with `child` null for roots stored whole.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+from local_db import FLAG_ZLIB, JSON_TEXT_CODECS, LocalDatabase
+
+# How a root is stored: one kv_store row, one kv_children row per child, or history_log.
+STORE, CHILDREN, HISTORY = "store", "children", "history"
+
+
+def open_readonly(database: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{database.as_posix()}?mode=ro", uri=True, isolation_level=None)
+    conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+
+def row_json(payload: Union[str, bytes], codec: str, flags: int) -> str:
+    """JSON text of a stored row; JSON payloads are passed through without decoding."""
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    if codec in JSON_TEXT_CODECS:
+        return payload.decode("utf-8") if isinstance(payload, bytes) else payload
+    return json.dumps(LocalDatabase.decode(payload, codec), ensure_ascii=False)
+
+
+def payload_columns(conn: sqlite3.Connection, table: str) -> str:
+    """Select list for (value, codec, flags); databases from before codecs store plain JSON."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    codec = "codec" if "codec" in columns else "'json'"
+    flags = "flags" if "flags" in columns else "0"
+    return f"value, {codec}, {flags}"
+
+
+def list_roots(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+    """All exportable roots as (name, layout), sorted by name."""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    roots = {row[0]: STORE for row in conn.execute("SELECT key FROM kv_store")}
+    if "kv_children" in tables:
+        for (root,) in conn.execute("SELECT DISTINCT root FROM kv_children"):
+            roots.setdefault(root, CHILDREN)
+    if "history_log" in tables:
+        for (stream,) in conn.execute("SELECT DISTINCT stream FROM history_log"):
+            roots.setdefault(stream, HISTORY)
+    return sorted(roots.items())
+
+
+def iter_rows(conn: sqlite3.Connection, root: str, layout: str) -> Iterator[Tuple[Optional[str], str]]:
+    """Yield (child, JSON text) for each row of `root`; child is None for a root stored whole."""
+    if layout == STORE:
+        columns = payload_columns(conn, "kv_store")
+        row = conn.execute(f"SELECT {columns} FROM kv_store WHERE key = ?", (root,)).fetchone()
+        yield None, row_json(*row)
+    elif layout == CHILDREN:
+        columns = payload_columns(conn, "kv_children")
+        cursor = conn.execute(
+            f"SELECT child, {columns} FROM kv_children WHERE root = ? ORDER BY rowid",
+            (root,),
+        )
+        for child, *stored in cursor:
+            yield child, row_json(*stored)
+    else:
+        cursor = conn.execute(
+            "SELECT owner, value FROM history_log WHERE stream = ? ORDER BY owner, id",
+            (root,),
+        )
+        owner: Optional[str] = None
+        entries: List[str] = []
+        for row_owner, value in cursor:
+            if row_owner != owner and entries:
+                yield owner, "[" + ", ".join(entries) + "]"
+                entries = []
+            owner = row_owner
+            entries.append(value)
+        if entries:
+            yield owner, "[" + ", ".join(entries) + "]"
+
+
+def write_json(conn: sqlite3.Connection, roots: Sequence[Tuple[str, str]], out: TextIO) -> int:
+    rows = 0
+    out.write("{")
+    for index, (root, layout) in enumerate(roots):
+        out.write(("," if index else "") + "\n" + json.dumps(root, ensure_ascii=False) + ": ")
+        if layout == STORE:
+            for _, text in iter_rows(conn, root, layout):
+                out.write(text)
+                rows += 1
+            continue
+        out.write("{")
+        for position, (child, text) in enumerate(iter_rows(conn, root, layout)):
+            out.write(("," if position else "") + "\n  " + json.dumps(child, ensure_ascii=False) + ": " + text)
+            rows += 1
+        out.write("}")
+    out.write("\n}\n")
+    return rows
+
+
+def write_ndjson(conn: sqlite3.Connection, roots: Sequence[Tuple[str, str]], out: TextIO) -> int:
+    rows = 0
+    for root, layout in roots:
+        prefix = '{"root": ' + json.dumps(root, ensure_ascii=False) + ', "child": '
+        for child, text in iter_rows(conn, root, layout):
+            out.write(prefix + json.dumps(child, ensure_ascii=False) + ', "value": ' + text + "}\n")
+            rows += 1
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Export local SQLite storage to JSON or NDJSON")
+    parser.add_argument(
+        "--database",
+        type=Path,
+        default=Path(__file__).with_name("storage.sqlite3"),
+        help="Database to export (default: storage.sqlite3 next to this script)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="Output file (default: standard output)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("json", "ndjson"),
+        default="json",
+        help="json: one object keyed by root; ndjson: one line per storage row (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--root",
+        dest="roots",
+        action="append",
+        metavar="NAME",
+        help="Export only this root; repeat for several (default: all roots)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="Leave this root out; repeat for several",
+    )
+
+    args = parser.parse_args()
+
+    if not args.database.exists():
+        parser.error(f"Database not found: {args.database}")
+
+    started = time.perf_counter()
+    conn = open_readonly(args.database)
+    try:
+        # One read transaction: every root comes from the same snapshot.
+        conn.execute("BEGIN")
+        roots = [
+            (root, layout)
+            for root, layout in list_roots(conn)
+            if (args.roots is None or root in args.roots) and root not in args.exclude
+        ]
+        missing = sorted(set(args.roots or ()) - {root for root, _ in roots})
+        if missing:
+            print(f"Roots not found: {', '.join(missing)}", file=sys.stderr)
+
+        writer = write_ndjson if args.format == "ndjson" else write_json
+        if args.output is None:
+            rows = writer(conn, roots, sys.stdout)
+            sys.stdout.flush()
+        else:
+            partial = args.output.with_name(args.output.name + ".part")
+            with partial.open("w", encoding="utf-8") as out:
+                rows = writer(conn, roots, out)
+            partial.replace(args.output)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    summary = f"Exported {rows:,} rows from {len(roots)} roots in {time.perf_counter() - started:.2f}s"
+    if args.output is not None:
+        summary += f" ({args.output.stat().st_size / 1024 / 1024:.1f} MiB to {args.output})"
+    print(summary, file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,140 +1,609 @@
-"""Utility script to migrate a Firebase Realtime Database export into the local SQLite store.
-
-Usage
------
-python import_firebase_dump.py path/to/export.json [--database path/to/storage.sqlite3]
-
-The export JSON should correspond to the Firebase structure that was previously used by the bot.
-The script writes the data into the same local_db facade used by the bot, ensuring that
-all existing helper functions consume the data with the expected shape.
-"""
-
-from __future__ import annotations
-
-import argparse
-import json
-import sys
-from pathlib import Path
-from typing import Any, Dict, Iterable
-
-from local_db import initialize as init_local_db, db
-
-# Firebase root nodes that the bot expects to find.
-KNOWN_ROOT_KEYS: tuple[str, ...] = (
-    "users_data",
-    "ban_list",
-    "promocodes",
-    "roulette_bets",
-    "chat_treasury",
-    "cities_data",
-    "stocks_data",
-    "stock_prices",
-    "game_history",
-    "marriages",
-    "user_avatars",
-    "daily_leaderboard",
-    "chat_moderators",
-    "chat_mutes",
-    "chat_rules",
-    "chat_bans",
-    "vip_subscriptions",
-    "user_inventory",
-    "user_collection",
-    "fast_promocodes",
-)
-
-
-def normalize_structure(value: Any) -> Any:
-    """Recursively ensure dictionary keys are strings for JSON compatibility."""
-    if isinstance(value, dict):
-        return {str(key): normalize_structure(sub_value) for key, sub_value in value.items()}
-    if isinstance(value, list):
-        return [normalize_structure(item) for item in value]
-    return value
-
-
-def import_nodes(data: Dict[str, Any], root_keys: Iterable[str]) -> Dict[str, str]:
-    """Import provided root nodes into the local database.
-
-    Returns a mapping of node name to a short status string for reporting.
-    """
-    status: Dict[str, str] = {}
-
-    for node in root_keys:
-        if node not in data:
-            continue
-
-        ref = db.reference(node)
-        node_value = data[node]
-
-        if node_value is None:
-            ref.delete()
-            status[node] = "deleted"
-            continue
-
-        ref.set(normalize_structure(node_value))
-        status[node] = "imported"
-
-    return status
-
-
-def main() -> int:
-    parser = argparse.ArgumentParser(description="Import Firebase export JSON into local SQLite storage")
-    parser.add_argument(
-        "export_file",
-        type=Path,
-        help="Path to Firebase export JSON (use the Export JSON feature in the Firebase console)",
-    )
-    parser.add_argument(
-        "--database",
-        type=Path,
-        default=Path(__file__).with_name("storage.sqlite3"),
-        help="Path to the SQLite file managed by local_db (default: storage.sqlite3 next to this script)",
-    )
-    parser.add_argument(
-        "--allow-unknown",
-        action="store_true",
-        help="Import any additional top-level nodes present in the JSON, not only the known ones",
-    )
-
-    args = parser.parse_args()
-
-    if not args.export_file.exists():
-        parser.error(f"Export file not found: {args.export_file}")
-
-    try:
-        payload = json.loads(args.export_file.read_text(encoding="utf-8"))
-    except json.JSONDecodeError as exc:
-        parser.error(f"Failed to decode JSON from {args.export_file}: {exc}")
-
-    if not isinstance(payload, dict):
-        parser.error("Export root must be a JSON object with the Firebase nodes as keys")
-
-    # Initialize the local database (creates the file if it does not yet exist).
-    init_local_db(args.database)
-
-    root_keys: set[str] = set(KNOWN_ROOT_KEYS)
-    if args.allow_unknown:
-        root_keys.update(payload.keys())
-
-    status = import_nodes(payload, sorted(root_keys))
-
-    if status:
-        longest = max(len(name) for name in status)
-        print("Imported nodes:")
-        for name in sorted(status):
-            print(f"  {name.ljust(longest)} -> {status[name]}")
-    else:
-        print("No matching nodes were imported from the provided export")
-
-    skipped = sorted(set(payload.keys()) - set(status.keys()))
-    if skipped:
-        print("\nSkipped nodes (not in known list; use --allow-unknown to import them):")
-        for name in skipped:
-            print(f"  {name}")
-
-    return 0
-
-
-if __name__ == "__main__":
-    sys.exit(main())
+"""Utility script to migrate a Firebase Realtime Database export into the local SQLite store.
+
+Usage
+-----
+python import_firebase_dump.py path/to/export.json [--database path/to/storage.sqlite3]
+python import_firebase_dump.py path/to/export.json --stream [--batch-size 1000]
+python import_firebase_dump.py path/to/export.json --merge [--dry-run]
+
+The export JSON should correspond to the Firebase structure that was previously used by the bot.
+The script writes the data into the same local_db facade used by the bot, ensuring that
+all existing helper functions consume the data with the expected shape.
+
+`--stream` parses the export incrementally and writes the children of split roots in
+batched transactions, so multi-GB exports import in memory bounded by the batch size.
+`--merge` streams the export the same way but writes only the records that differ from
+storage and reports how many were added, changed and removed; `--dry-run` only reports.
+"""
+
+from __future__ import annotations
+
+import argparse
+import codecs
+import json
+import sys
+import time
+from pathlib import Path
+from collections import Counter
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from local_db import LocalDatabase, LocalHistory, get_database, initialize as init_local_db, db
+
+# Firebase root nodes that the bot expects to find.
+KNOWN_ROOT_KEYS: tuple[str, ...] = (
+    "users_data",
+    "ban_list",
+    "promocodes",
+    "roulette_bets",
+    "chat_treasury",
+    "cities_data",
+    "stocks_data",
+    "stock_prices",
+    "game_history",
+    "marriages",
+    "user_avatars",
+    "daily_leaderboard",
+    "chat_moderators",
+    "chat_mutes",
+    "chat_rules",
+    "chat_bans",
+    "vip_subscriptions",
+    "user_inventory",
+    "user_collection",
+    "fast_promocodes",
+)
+
+# Roots the bot keeps in the `history_log` table ({owner: [entries]} in exports).
+HISTORY_STREAMS: frozenset[str] = frozenset({"game_history"})
+
+
+def normalize_structure(value: Any) -> Any:
+    """Recursively ensure dictionary keys are strings for JSON compatibility."""
+    if isinstance(value, dict):
+        return {str(key): normalize_structure(sub_value) for key, sub_value in value.items()}
+    if isinstance(value, list):
+        return [normalize_structure(item) for item in value]
+    return value
+
+
+def import_nodes(data: Dict[str, Any], root_keys: Iterable[str]) -> Dict[str, str]:
+    """Import provided root nodes into the local database.
+
+    Returns a mapping of node name to a short status string for reporting.
+    """
+    status: Dict[str, str] = {}
+
+    for node in root_keys:
+        if node not in data:
+            continue
+
+        ref = db.reference(node)
+        node_value = data[node]
+
+        if node_value is None:
+            ref.delete()
+            status[node] = "deleted"
+            continue
+
+        ref.set(normalize_structure(node_value))
+        status[node] = "imported"
+
+    return status
+
+
+STREAM_CHUNK_SIZE = 1 << 20
+STREAM_BATCH_SIZE = 1000
+
+
+class JsonStream:
+    """Incremental reader for a JSON document made of nested objects.
+
+    Objects are walked key by key with `begin_object`/`keys`; any other value is decoded
+    with `json.JSONDecoder.raw_decode` from a sliding buffer. Memory is bounded by the
+    largest value actually decoded, not by the size of the file.
+    """
+
+    def __init__(self, handle: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE):
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self.bytes_read = 0
+
+    def _read(self, size: int) -> bool:
+        raw = self._handle.read(size)
+        self.bytes_read += len(raw)
+        if not raw:
+            self._eof = True
+        # Drop the consumed prefix so the buffer only holds what is still to be parsed.
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(raw, final=not raw)
+        self._pos = 0
+        return bool(raw)
+
+    def _peek(self) -> str:
+        """Next non-whitespace character, or an empty string at the end of the input."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read(self._chunk_size):
+                return ""
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found or 'end of file'!r} near byte {self.bytes_read}")
+        self._pos += 1
+
+    def value(self) -> Any:
+        """Decode the next value completely."""
+        self._peek()
+        size = self._chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # A number ending exactly at the buffer edge may continue in the next chunk.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            # Grow reads with the pending value so re-decoding a huge value stays linear.
+            size = max(size, len(self._buffer) - self._pos)
+            self._read(size)
+
+    def begin_object(self) -> bool:
+        """Enter the next value if it is an object; otherwise leave it for `value()`."""
+        if self._peek() != "{":
+            return False
+        self._pos += 1
+        return True
+
+    def keys(self) -> Iterator[str]:
+        """Keys of the object entered with `begin_object`; consume each value before advancing."""
+        first = True
+        while True:
+            if self._peek() == "}":
+                self._pos += 1
+                return
+            if not first:
+                self._expect(",")
+            first = False
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Object key must be a string near byte {self.bytes_read}")
+            self._expect(":")
+            yield key
+
+    def skip(self) -> None:
+        """Consume the next value without holding more than one nested leaf in memory."""
+        if self.begin_object():
+            for _ in self.keys():
+                self.skip()
+        else:
+            self.value()
+
+
+class StreamProgress:
+    """Single-line progress report on stderr, redrawn at most every `interval` seconds."""
+
+    def __init__(self, total_bytes: int, interval: float = 0.5):
+        self._total_bytes = max(total_bytes, 1)
+        self._interval = interval
+        self._started = time.monotonic()
+        self._last_draw = 0.0
+        self.records = 0
+
+    def update(self, node: str, records: int, bytes_read: int, force: bool = False) -> None:
+        self.records += records
+        now = time.monotonic()
+        if not force and now - self._last_draw < self._interval:
+            return
+        self._last_draw = now
+        elapsed = max(now - self._started, 1e-9)
+        sys.stderr.write(
+            f"\r{node}: {self.records:,} records, "
+            f"{bytes_read / 1024 / 1024:,.1f}/{self._total_bytes / 1024 / 1024:,.1f} MiB "
+            f"({min(bytes_read / self._total_bytes, 1.0):.0%}), {self.records / elapsed:,.0f} records/s\x1b[K"
+        )
+        sys.stderr.flush()
+
+    def finish(self) -> None:
+        sys.stderr.write("\n")
+        sys.stderr.flush()
+
+
+def _stream_children(
+    database: LocalDatabase,
+    node: str,
+    stream: JsonStream,
+    batch_size: int,
+    progress: Optional[StreamProgress],
+) -> int:
+    """Replace the split root `node` with the children read from `stream`, one batch per transaction."""
+    ref = database.reference(node)
+    ref.delete()
+    imported = 0
+    batch: List[Tuple[str, Any]] = []
+
+    def write_batch() -> None:
+        database.set_children(node, dict(batch))
+        if progress is not None:
+            progress.update(node, len(batch), stream.bytes_read)
+        batch.clear()
+
+    for child in stream.keys():
+        value = stream.value()
+        if value is None:
+            continue
+        batch.append((child, value))
+        imported += 1
+        if len(batch) >= batch_size:
+            write_batch()
+    if batch:
+        write_batch()
+    return imported
+
+
+def _export_nodes(
+    export_file: Path,
+    root_keys: Optional[Set[str]],
+    skipped: List[str],
+    progress: Optional[StreamProgress],
+) -> Iterator[Tuple[str, JsonStream]]:
+    """Yield each selected top-level node with the stream positioned at its value.
+
+    The caller must consume the value before advancing. Other nodes are skipped without
+    being decoded and appended to `skipped`.
+    """
+    with export_file.open("rb") as handle:
+        stream = JsonStream(handle)
+        if not stream.begin_object():
+            raise ValueError("Export root must be a JSON object with the Firebase nodes as keys")
+        for node in stream.keys():
+            if root_keys is not None and node not in root_keys:
+                stream.skip()
+                skipped.append(node)
+                continue
+            yield node, stream
+            if progress is not None:
+                progress.update(node, 0, stream.bytes_read, force=True)
+    if progress is not None:
+        progress.finish()
+
+
+def stream_import(
+    export_file: Path,
+    root_keys: Optional[Set[str]],
+    batch_size: int = STREAM_BATCH_SIZE,
+    show_progress: bool = True,
+) -> Tuple[Dict[str, str], List[str]]:
+    """Import an export without loading it whole; returns (status per node, skipped nodes).
+
+    Children of split roots are written `batch_size` per transaction; other roots are
+    stored as one row, so they are decoded whole. `root_keys=None` imports every node.
+    A failed run can leave a split root partially imported: run the import again.
+    """
+    database = get_database()
+    status: Dict[str, str] = {}
+    skipped: List[str] = []
+    progress = StreamProgress(export_file.stat().st_size) if show_progress else None
+
+    for node, stream in _export_nodes(export_file, root_keys, skipped, progress):
+        if database.is_split(node) and stream.begin_object():
+            count = _stream_children(database, node, stream, batch_size, progress)
+            status[node] = f"imported ({count} children)"
+        else:
+            status.update(import_nodes({node: stream.value()}, [node]))
+    return status, skipped
+
+
+class MergeCounts(NamedTuple):
+    """Records of one node that a merge adds, changes and removes."""
+
+    added: int = 0
+    changed: int = 0
+    removed: int = 0
+
+    def __add__(self, other: "MergeCounts") -> "MergeCounts":  # type: ignore[override]
+        return MergeCounts(*(mine + theirs for mine, theirs in zip(self, other)))
+
+
+def diff_values(stored: Any, value: Any) -> MergeCounts:
+    """Count the records that differ between a stored node and its exported value.
+
+    Records are the keys of the two objects; anything else counts as a single record.
+    """
+    if stored is None and isinstance(value, dict):
+        stored = {}
+    if value is None and isinstance(stored, dict):
+        value = {}
+    if isinstance(stored, dict) and isinstance(value, dict):
+        return MergeCounts(
+            added=sum(1 for key in value if key not in stored),
+            changed=sum(1 for key, item in value.items() if key in stored and stored[key] != item),
+            removed=sum(1 for key in stored if key not in value),
+        )
+    if stored == value:
+        return MergeCounts()
+    if stored is None:
+        return MergeCounts(added=1)
+    if value is None:
+        return MergeCounts(removed=1)
+    return MergeCounts(changed=1)
+
+
+def _merge_children(
+    database: LocalDatabase,
+    node: str,
+    stream: JsonStream,
+    batch_size: int,
+    dry_run: bool,
+    progress: Optional[StreamProgress],
+) -> MergeCounts:
+    """Write only the children of the split root `node` that differ from the export."""
+    counts = MergeCounts()
+    seen: Set[str] = set()
+    batch: Dict[str, Any] = {}
+
+    def merge_batch() -> None:
+        nonlocal counts
+        stored = database.get_children(node, batch)
+        changes = {child: value for child, value in batch.items() if stored.get(child) != value}
+        counts += MergeCounts(
+            added=sum(1 for child in changes if child not in stored),
+            changed=sum(1 for child in changes if child in stored),
+        )
+        if changes and not dry_run:
+            database.set_children(node, changes)
+        if progress is not None:
+            progress.update(node, len(batch), stream.bytes_read)
+        batch.clear()
+
+    for child in stream.keys():
+        value = stream.value()
+        if value is None:
+            continue
+        seen.add(child)
+        batch[child] = value
+        if len(batch) >= batch_size:
+            merge_batch()
+    if batch:
+        merge_batch()
+
+    removed = [child for child in database.child_keys(node) if child not in seen]
+    if removed and not dry_run:
+        with database.transaction():
+            for child in removed:
+                database.reference(node, child).delete()
+    return counts + MergeCounts(removed=len(removed))
+
+
+def _entry_keys(entries: List[Any]) -> Counter:
+    return Counter(json.dumps(entry, sort_keys=True, ensure_ascii=False) for entry in entries)
+
+
+def _merge_history(
+    database: LocalDatabase,
+    node: str,
+    stream: JsonStream,
+    dry_run: bool,
+    progress: Optional[StreamProgress],
+) -> MergeCounts:
+    """Bring the history stream `node` in line with the export, entry by entry.
+
+    Records are history entries: an owner whose exported list differs from the log has
+    its log replaced. A legacy `{owner: [entries]}` root the bot has not moved into the
+    log yet is moved first; a dry run reads it in place instead, as the bot would see it.
+    """
+    history = LocalHistory(database, node, import_legacy=not dry_run)
+    legacy = database.get(node) if dry_run else None
+    legacy = legacy if isinstance(legacy, dict) else {}
+
+    def stored_entries(owner: str) -> List[Any]:
+        entries = legacy.get(owner)
+        return entries if isinstance(entries, list) else history.entries(owner)
+
+    counts = MergeCounts()
+    seen: Set[str] = set()
+    for owner in stream.keys():
+        entries = stream.value()
+        if not isinstance(entries, list):
+            continue
+        seen.add(owner)
+        stored = stored_entries(owner)
+        if stored == entries:
+            continue
+        exported, existing = _entry_keys(entries), _entry_keys(stored)
+        counts += MergeCounts(
+            added=sum((exported - existing).values()),
+            removed=sum((existing - exported).values()),
+        )
+        if not dry_run:
+            history.replace(owner, entries)
+        if progress is not None:
+            progress.update(node, 1, stream.bytes_read)
+
+    for owner in sorted(set(history.owners()) | set(legacy)):
+        if owner in seen:
+            continue
+        counts += MergeCounts(removed=len(stored_entries(owner)))
+        if not dry_run:
+            history.delete(owner)
+    return counts
+
+
+def merge_import(
+    export_file: Path,
+    root_keys: Optional[Set[str]],
+    batch_size: int = STREAM_BATCH_SIZE,
+    dry_run: bool = False,
+    show_progress: bool = True,
+) -> Tuple[Dict[str, MergeCounts], List[str]]:
+    """Bring storage in line with an export, writing only what differs.
+
+    Children of split roots are compared `batch_size` at a time and only added or
+    changed ones are written; stored children missing from the export are deleted.
+    History streams are compared with the `history_log` table, where the bot keeps them,
+    and written there. Other roots are compared whole and rewritten only when they
+    differ. With `dry_run` nothing is written. Returns (counts per node, skipped nodes).
+    """
+    database = get_database()
+    counts: Dict[str, MergeCounts] = {}
+    skipped: List[str] = []
+    progress = StreamProgress(export_file.stat().st_size) if show_progress else None
+
+    for node, stream in _export_nodes(export_file, root_keys, skipped, progress):
+        if node in HISTORY_STREAMS and stream.begin_object():
+            counts[node] = _merge_history(database, node, stream, dry_run, progress)
+            continue
+        if database.is_split(node) and stream.begin_object():
+            counts[node] = _merge_children(database, node, stream, batch_size, dry_run, progress)
+            continue
+        value = stream.value()
+        counts[node] = diff_values(database.reference(node).get(), value)
+        if counts[node] != MergeCounts() and not dry_run:
+            import_nodes({node: value}, [node])
+    return counts, skipped
+
+
+def report_merge(counts: Dict[str, MergeCounts], dry_run: bool) -> None:
+    print("Merge preview (nothing written):" if dry_run else "Merged nodes:")
+    rows = [(name, *counts[name]) for name in sorted(counts)]
+    total = sum(counts.values(), MergeCounts())
+    rows.append(("total", *total))
+    width = max(len(row[0]) for row in rows)
+    print(f"  {'node'.ljust(width)}  {'added':>9}  {'changed':>9}  {'removed':>9}")
+    for name, added, changed, removed in rows:
+        print(f"  {name.ljust(width)}  {added:>9,}  {changed:>9,}  {removed:>9,}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Import Firebase export JSON into local SQLite storage")
+    parser.add_argument(
+        "export_file",
+        type=Path,
+        help="Path to Firebase export JSON (use the Export JSON feature in the Firebase console)",
+    )
+    parser.add_argument(
+        "--database",
+        type=Path,
+        default=Path(__file__).with_name("storage.sqlite3"),
+        help="Path to the SQLite file managed by local_db (default: storage.sqlite3 next to this script)",
+    )
+    parser.add_argument(
+        "--allow-unknown",
+        action="store_true",
+        help="Import any additional top-level nodes present in the JSON, not only the known ones",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse the export incrementally and write split roots in batches (for very large exports)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=STREAM_BATCH_SIZE,
+        help="Children written per transaction with --stream (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Compare the export with storage and write only added, changed and removed records",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="With --merge, report the differences without writing anything",
+    )
+
+    args = parser.parse_args()
+
+    if not args.export_file.exists():
+        parser.error(f"Export file not found: {args.export_file}")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be positive")
+    if args.dry_run and not args.merge:
+        parser.error("--dry-run requires --merge")
+
+    if args.merge:
+        init_local_db(args.database)
+        try:
+            counts, skipped = merge_import(
+                args.export_file,
+                None if args.allow_unknown else set(KNOWN_ROOT_KEYS),
+                batch_size=args.batch_size,
+                dry_run=args.dry_run,
+                show_progress=sys.stderr.isatty(),
+            )
+        except (ValueError, json.JSONDecodeError) as exc:
+            print(f"\nFailed to merge {args.export_file}: {exc}", file=sys.stderr)
+            return 1
+        report_merge(counts, args.dry_run)
+        report_skipped(skipped)
+        return 0
+
+    if args.stream:
+        init_local_db(args.database)
+        try:
+            status, skipped = stream_import(
+                args.export_file,
+                None if args.allow_unknown else set(KNOWN_ROOT_KEYS),
+                batch_size=args.batch_size,
+                show_progress=sys.stderr.isatty(),
+            )
+        except (ValueError, json.JSONDecodeError) as exc:
+            print(f"\nFailed to import {args.export_file}: {exc}", file=sys.stderr)
+            return 1
+        report_status(status, skipped)
+        return 0
+
+    try:
+        payload = json.loads(args.export_file.read_text(encoding="utf-8"))
+    except json.JSONDecodeError as exc:
+        parser.error(f"Failed to decode JSON from {args.export_file}: {exc}")
+
+    if not isinstance(payload, dict):
+        parser.error("Export root must be a JSON object with the Firebase nodes as keys")
+
+    # Initialize the local database (creates the file if it does not yet exist).
+    init_local_db(args.database)
+
+    root_keys: set[str] = set(KNOWN_ROOT_KEYS)
+    if args.allow_unknown:
+        root_keys.update(payload.keys())
+
+    status = import_nodes(payload, sorted(root_keys))
+    report_status(status, sorted(set(payload.keys()) - set(status.keys())))
+    return 0
+
+
+def report_status(status: Dict[str, str], skipped: Iterable[str]) -> None:
+    if status:
+        longest = max(len(name) for name in status)
+        print("Imported nodes:")
+        for name in sorted(status):
+            print(f"  {name.ljust(longest)} -> {status[name]}")
+    else:
+        print("No matching nodes were imported from the provided export")
+    report_skipped(skipped)
+
+
+def report_skipped(skipped: Iterable[str]) -> None:
+    skipped = sorted(skipped)
+    if skipped:
+        print("\nSkipped nodes (not in known list; use --allow-unknown to import them):")
+        for name in skipped:
+            print(f"  {name}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
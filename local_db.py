@@ -1,192 +1,2231 @@
-import json
-import sqlite3
-import threading
-import time
-from pathlib import Path
-from types import SimpleNamespace
-from typing import Any, Dict, Iterable, Optional, Tuple, Union
-
-
-class LocalDatabase:
-    """Thread-safe key/value storage backed by SQLite."""
-
-    def __init__(self, database_path: Union[Path, str]):
-        self._path = Path(database_path)
-        self._path.parent.mkdir(parents=True, exist_ok=True)
-        self._lock = threading.RLock()
-        self._conn = sqlite3.connect(self._path.as_posix(), check_same_thread=False)
-        self._conn.execute("PRAGMA journal_mode=WAL;")
-        self._conn.execute("PRAGMA synchronous=FULL;")
-        self._conn.execute("PRAGMA foreign_keys=ON;")
-        self._conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS kv_store (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                updated_at INTEGER NOT NULL
-            );
-            """
-        )
-        self._conn.commit()
-
-    def reference(self, *segments: str) -> "LocalReference":
-        parts: list[str] = []
-        for segment in segments:
-            if segment is None:
-                continue
-            cleaned = segment.strip("/")
-            if not cleaned:
-                continue
-            parts.extend(filter(None, cleaned.split("/")))
-        if not parts:
-            raise ValueError("Reference path must contain at least one segment")
-        return LocalReference(self, parts)
-
-    def get(self, key: str) -> Optional[Any]:
-        with self._lock:
-            cursor = self._conn.execute("SELECT value FROM kv_store WHERE key = ?", (key,))
-            row = cursor.fetchone()
-        if row is None:
-            return None
-        return json.loads(row[0])
-
-    def set(self, key: str, value: Any) -> None:
-        payload = json.dumps(value, ensure_ascii=False)
-        timestamp = int(time.time())
-        with self._lock:
-            self._conn.execute(
-                "REPLACE INTO kv_store (key, value, updated_at) VALUES (?, ?, ?)",
-                (key, payload, timestamp),
-            )
-            self._conn.commit()
-
-    def delete(self, key: str) -> None:
-        with self._lock:
-            self._conn.execute("DELETE FROM kv_store WHERE key = ?", (key,))
-            self._conn.commit()
-
-    def close(self) -> None:
-        with self._lock:
-            self._conn.close()
-
-
-class LocalReference:
-    """Firebase-like reference built on top of LocalDatabase."""
-
-    def __init__(self, db: LocalDatabase, segments: Iterable[str]):
-        self._db = db
-        normalized: list[str] = []
-        for segment in segments:
-            if segment is None:
-                continue
-            cleaned = segment.strip("/")
-            if not cleaned:
-                continue
-            normalized.extend(filter(None, cleaned.split("/")))
-        self._segments: Tuple[str, ...] = tuple(normalized)
-        if not self._segments:
-            raise ValueError("Reference path cannot be empty")
-
-    def child(self, segment: str) -> "LocalReference":
-        if not segment or not segment.strip("/"):
-            raise ValueError("Child segment cannot be empty")
-        return LocalReference(self._db, self._segments + (segment,))
-
-    def get(self, default: Any = None) -> Any:
-        root_key = self._segments[0]
-        data = self._db.get(root_key)
-        if data is None:
-            return default
-
-        node = data
-        for segment in self._segments[1:]:
-            if not isinstance(node, dict) or segment not in node:
-                return default
-            node = node[segment]
-        return node
-
-    def set(self, value: Any) -> None:
-        root_key = self._segments[0]
-        if len(self._segments) == 1:
-            self._db.set(root_key, value)
-            return
-
-        data = self._db.get(root_key)
-        if not isinstance(data, dict):
-            data = {}
-
-        node = data
-        for segment in self._segments[1:-1]:
-            child = node.get(segment)
-            if not isinstance(child, dict):
-                child = {}
-            node[segment] = child
-            node = child
-
-        node[self._segments[-1]] = value
-        self._db.set(root_key, data)
-
-    def update(self, value: Dict[str, Any]) -> None:
-        if not isinstance(value, dict):
-            raise ValueError("Value for update must be a dictionary")
-        current = self.get({})
-        if not isinstance(current, dict):
-            current = {}
-        current.update(value)
-        self.set(current)
-
-    def delete(self) -> None:
-        root_key = self._segments[0]
-        if len(self._segments) == 1:
-            self._db.delete(root_key)
-            return
-
-        data = self._db.get(root_key)
-        if not isinstance(data, dict):
-            return
-
-        node_stack = [data]
-        node = data
-        for segment in self._segments[1:-1]:
-            child = node.get(segment)
-            if not isinstance(child, dict):
-                return
-            node = child
-            node_stack.append(node)
-
-        if self._segments[-1] in node:
-            del node[self._segments[-1]]
-            self._db.set(root_key, node_stack[0])
-
-
-_DEFAULT_DB_PATH = Path(__file__).with_name("storage.sqlite3")
-_db_lock = threading.RLock()
-_db_instance: Optional[LocalDatabase] = None
-
-
-def initialize(database_path: Optional[Union[Path, str]] = None) -> LocalDatabase:
-    global _db_instance
-    with _db_lock:
-        path = Path(database_path) if database_path else _DEFAULT_DB_PATH
-        _db_instance = LocalDatabase(path)
-        return _db_instance
-
-
-def get_database() -> LocalDatabase:
-    global _db_instance
-    with _db_lock:
-        if _db_instance is None:
-            _db_instance = LocalDatabase(_DEFAULT_DB_PATH)
-        return _db_instance
-
-
-def reference(*segments: str) -> LocalReference:
-    return get_database().reference(*segments)
-
-
-class _Facade(SimpleNamespace):
-    def reference(self, *segments: str) -> LocalReference:
-        return reference(*segments)
-
-
-db = _Facade()
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import logging
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speed-up
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional speed-up
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Root nodes whose direct children are stored as individual rows in `kv_children`
+# instead of one JSON blob in `kv_store`. Writing `users_data/<id>` then only touches
+# that user's row. Per-player logs such as `game_history` live in `history_log`
+# (see `LocalHistory`) instead: a database that still stores one as child rows has
+# them folded back into a blob on open, which `LocalHistory` then imports once.
+DEFAULT_SPLIT_ROOTS: Tuple[str, ...] = (
+    "users_data",
+    "user_inventory",
+    "user_collection",
+    "chat_treasury",
+    "cities_data",
+    "stocks_data",
+    "promocodes",
+)
+
+# Child fields of split roots that get a secondary index for ordered queries.
+DEFAULT_INDEXES: Dict[str, Tuple[str, ...]] = {
+    "users_data": ("balance", "bank"),
+}
+
+
+class Codec(NamedTuple):
+    """Serialization format for stored values; its name is recorded in each row."""
+
+    name: str
+    encode: Callable[[Any], Union[str, bytes]]
+    decode: Callable[[Union[str, bytes]], Any]
+
+
+def _json_encode(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _stringify_keys(value: Any) -> Any:
+    if type(value) is dict:
+        return {str(key): _stringify_keys(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_stringify_keys(item) for item in value]
+    return value
+
+
+def _has_non_finite(value: Any) -> bool:
+    if isinstance(value, float):
+        return not math.isfinite(value)
+    if isinstance(value, dict):
+        return any(_has_non_finite(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_has_non_finite(item) for item in value)
+    return False
+
+
+def _orjson_encode(value: Any) -> bytes:
+    # OPT_NON_STR_KEYS turns int keys into strings, exactly like the stdlib encoder.
+    payload = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+    # orjson writes NaN and Infinity as null; raising lets encode() fall back to
+    # stdlib JSON, which keeps them. Only payloads with a null need the scan.
+    if b"null" in payload and _has_non_finite(value):
+        raise ValueError("orjson cannot store non-finite floats")
+    return payload
+
+
+CODECS: Dict[str, Codec] = {"json": Codec("json", _json_encode, json.loads)}
+if orjson is not None:
+    CODECS["orjson"] = Codec("orjson", _orjson_encode, orjson.loads)
+if msgpack is not None:
+    # Keys are stringified first so values read back the same as from JSON.
+    CODECS["msgpack"] = Codec(
+        "msgpack",
+        lambda value: msgpack.packb(_stringify_keys(value), use_bin_type=True),
+        lambda payload: msgpack.unpackb(payload, raw=False),
+    )
+
+# Codecs whose payload is JSON text, which exporters can copy without decoding.
+JSON_TEXT_CODECS = frozenset({"json", "orjson"})
+
+# Preferred codecs when none is configured; the first one installed wins.
+_CODEC_PREFERENCE: Tuple[str, ...] = ("orjson", "json")
+
+
+# Bit flags stored with each row describing how the payload was post-processed.
+FLAG_ZLIB = 1
+
+# Payloads at least this large (in bytes) are zlib-compressed; 0 disables compression.
+DEFAULT_COMPRESS_THRESHOLD = 4 * 1024
+DEFAULT_COMPRESS_LEVEL = 3
+
+
+def resolve_codec(codec: Optional[str]) -> Codec:
+    """Look up a codec by name; None reads MORPH_DB_CODEC or picks the fastest installed."""
+    name = (codec or os.getenv("MORPH_DB_CODEC") or "").strip().lower()
+    if not name:
+        return next(CODECS[candidate] for candidate in _CODEC_PREFERENCE if candidate in CODECS)
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Codec {name!r} is not available; installed: {', '.join(CODECS)}") from None
+
+
+class DurabilityProfile(NamedTuple):
+    """How hard LocalDatabase works to keep committed writes across crashes.
+
+    synchronous: SQLite `PRAGMA synchronous` level used with the WAL journal.
+    group_commit_interval: seconds a write transaction is kept open so that later
+        writes share its commit; 0 commits every write immediately.
+    wal_autocheckpoint: WAL size in pages that triggers an inline checkpoint; 0 disables it.
+    checkpoint_interval: seconds between passive checkpoints run by a background
+        thread, or None to rely on `wal_autocheckpoint` alone.
+    """
+
+    synchronous: str
+    group_commit_interval: float
+    wal_autocheckpoint: int
+    checkpoint_interval: Optional[float]
+
+
+# Loss guarantees, from safest to fastest:
+#   full   - every committed write survives both a process crash and a power loss.
+#   normal - a process crash loses nothing; a power loss or OS crash can roll back the
+#            writes committed since the last WAL checkpoint (the file never corrupts).
+#   group  - writes are committed in batches every second, so a process crash can lose
+#            up to ~1 s of writes and a power loss up to the last 30 s checkpoint.
+DURABILITY_PROFILES: Dict[str, DurabilityProfile] = {
+    "full": DurabilityProfile("FULL", 0.0, 1000, None),
+    "normal": DurabilityProfile("NORMAL", 0.0, 1000, None),
+    "group": DurabilityProfile("NORMAL", 1.0, 0, 30.0),
+}
+DEFAULT_DURABILITY = "full"
+
+
+def resolve_durability(durability: Union[str, DurabilityProfile, None]) -> DurabilityProfile:
+    """Look up a profile by name; None reads MORPH_DB_DURABILITY (default "full")."""
+    if isinstance(durability, DurabilityProfile):
+        return durability
+    name = (durability or os.getenv("MORPH_DB_DURABILITY") or DEFAULT_DURABILITY).strip().lower()
+    try:
+        return DURABILITY_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown durability profile {name!r}; expected one of {', '.join(DURABILITY_PROFILES)}"
+        ) from None
+
+
+# Attempts `LocalReference.transaction` makes before giving up, as in Firebase.
+TRANSACTION_MAX_ATTEMPTS = 25
+
+
+class TransactionAbortedError(RuntimeError):
+    """Raised when an optimistic transaction keeps conflicting with concurrent writes."""
+
+
+class ChangeEvent(NamedTuple):
+    """A committed change to a storage row, passed to `LocalReference.listen` callbacks.
+
+    `path` is the row that changed ("/root" or "/root/child" for split roots); listeners
+    read the new value themselves. `sequence` is the row's entry in the durable change
+    log, or None when the log is disabled.
+    """
+
+    path: str
+    sequence: Optional[int]
+
+
+class ListenerRegistration:
+    """Handle returned by `LocalReference.listen`; `close()` stops delivery."""
+
+    def __init__(self, db: "LocalDatabase", listener_id: int):
+        self._db = db
+        self._listener_id = listener_id
+
+    def close(self) -> None:
+        self._db._remove_listener(self._listener_id)
+
+
+class BackupReport(NamedTuple):
+    """Result of `backup_database`: where the copy went and how long it took."""
+
+    path: Path
+    size: int
+    pages: int
+    duration: float
+    restarts: int
+
+    @property
+    def throughput(self) -> float:
+        """Copied bytes per second."""
+        return self.size / self.duration if self.duration > 0 else float("inf")
+
+
+class _BackupRestarted(Exception):
+    """Raised from the backup progress callback to stop a paged backup that keeps restarting."""
+
+
+_MISSING = object()
+
+
+def _clone(value: Any) -> Any:
+    """Copy decoded JSON data; much cheaper than `copy.deepcopy` for dict/list trees."""
+    if type(value) is dict:
+        return {key: _clone(item) for key, item in value.items()}
+    if type(value) is list:
+        return [_clone(item) for item in value]
+    return value
+
+
+class _DecodedCache:
+    """LRU cache of decoded values keyed by path tuple, bounded by encoded payload size.
+
+    Entries are grouped by root so a write can drop everything under it. Each root has a
+    generation counter: a value read before an invalidation is not stored afterwards.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, ...], Tuple[Any, int]]" = OrderedDict()
+        self._by_root: Dict[str, set] = {}
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, root: str) -> int:
+        return self._generations.get(root, 0)
+
+    def get(self, key: Tuple[str, ...]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple[str, ...], value: Any, size: int, generation: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return
+            self._discard(key)
+            self._entries[key] = (value, size)
+            self._by_root.setdefault(key[0], set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def _discard(self, key: Tuple[str, ...]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        keys = self._by_root.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_root[key[0]]
+
+    def invalidate(self, root: str, child: Optional[str] = None) -> None:
+        """Drop `root/child` and the assembled root, or everything under `root`."""
+        with self._lock:
+            self._generations[root] = self._generations.get(root, 0) + 1
+            if child is None:
+                for key in list(self._by_root.get(root, ())):
+                    self._discard(key)
+            else:
+                self._discard((root,))
+                self._discard((root, child))
+
+    def clear(self) -> None:
+        with self._lock:
+            for root in list(self._generations) + list(self._by_root):
+                self._generations[root] = self._generations.get(root, 0) + 1
+            self._entries.clear()
+            self._by_root.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class _ReaderPool:
+    """Bounded pool of read-only connections; in WAL mode they read while the writer commits."""
+
+    def __init__(self, path: Path, size: int):
+        self._path = path
+        self._size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path.as_posix(), check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection inside a read transaction, so all its queries see one snapshot."""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = self._connect() if len(self._connections) < self._size else None
+                if conn is not None:
+                    self._connections.append(conn)
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+        finally:
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class _WriterThread:
+    """Single background thread executing storage jobs in submission order."""
+
+    def __init__(self, max_queue: int):
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=max_queue)
+        # Jobs from `submit_nowait` that found the queue full, oldest first.
+        self._overflow: "deque[tuple]" = deque()
+        self._overflow_lock = threading.Lock()
+        self._overflow_thread: Optional[threading.Thread] = None
+        self._thread = threading.Thread(target=self._run, name="local-db-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def is_current(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, fn: Callable[..., Any], *args: Any, block: bool = True) -> concurrent.futures.Future:
+        """Queue `fn(*args)`; raises `queue.Full` when `block` is false and the queue is full."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((future, fn, args), block=block)
+        return future
+
+    def submit_nowait(self, fn: Callable[..., Any], *args: Any) -> concurrent.futures.Future:
+        """Queue `fn(*args)` without ever waiting for a free slot.
+
+        Jobs that find the queue full are handed to a helper thread, which queues them as
+        room frees up; later jobs line up behind them, so submission order is kept.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        item = (future, fn, args)
+        with self._overflow_lock:
+            if not self._overflow:
+                try:
+                    self._queue.put_nowait(item)
+                    return future
+                except queue.Full:
+                    pass
+            self._overflow.append(item)
+            if self._overflow_thread is None:
+                self._overflow_thread = threading.Thread(
+                    target=self._drain_overflow, name="local-db-overflow", daemon=True
+                )
+                self._overflow_thread.start()
+        return future
+
+    def _drain_overflow(self) -> None:
+        while True:
+            with self._overflow_lock:
+                if not self._overflow:
+                    self._overflow_thread = None
+                    return
+                item = self._overflow[0]
+            # Stays at the head until queued, so new jobs keep lining up behind it.
+            self._queue.put(item)
+            with self._overflow_lock:
+                self._overflow.popleft()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def close(self) -> None:
+        with self._overflow_lock:
+            overflow = self._overflow_thread
+        if overflow is not None:
+            overflow.join()
+        self._queue.put(None)
+        self._thread.join()
+
+
+class LocalDatabase:
+    """Thread-safe key/value storage backed by SQLite."""
+
+    def __init__(
+        self,
+        database_path: Union[Path, str],
+        split_roots: Optional[Iterable[str]] = DEFAULT_SPLIT_ROOTS,
+        writer_queue_size: int = 1024,
+        durability: Union[str, DurabilityProfile, None] = None,
+        cache_bytes: int = 32 * 1024 * 1024,
+        codec: Optional[str] = None,
+        compress_threshold: Optional[int] = None,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+        reader_pool_size: int = 4,
+        indexes: Optional[Dict[str, Iterable[str]]] = DEFAULT_INDEXES,
+        changelog_size: int = 0,
+    ):
+        self._path = Path(database_path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._split_roots = frozenset(split_roots or ())
+        self._profile = resolve_durability(durability)
+        self._codec = resolve_codec(codec)
+        self._indexes: Dict[str, Tuple[str, ...]] = {}
+        for root, fields in (indexes or {}).items():
+            if root not in self._split_roots:
+                logger.warning("Index on %s ignored: only split roots can be indexed", root)
+                continue
+            self._indexes[root] = tuple("/".join(filter(None, field.split("/"))) for field in fields)
+        if compress_threshold is None:
+            compress_threshold = int(os.getenv("MORPH_DB_COMPRESS_THRESHOLD", DEFAULT_COMPRESS_THRESHOLD))
+        self._compress_threshold = compress_threshold
+        self._compress_level = compress_level
+        # Rows that could not be re-encoded with the preferred codec (e.g. ints orjson rejects).
+        self._recode_skipped: set = set()
+        self._lock = threading.RLock()
+        # Decoded values by path; reads return copies, so callers may mutate them freely.
+        self._cache = _DecodedCache(cache_bytes)
+        # Roots written since the last SQLite COMMIT; their cache entries are dropped again
+        # once the commit lands, since pooled readers could have cached the old value.
+        self._uncommitted: set = set()
+        # Rows changed by the open transaction, then committed changes awaiting delivery.
+        self._changes: List[Tuple[Tuple[str, ...], Optional[int]]] = []
+        self._undelivered: List[Tuple[Tuple[str, ...], Optional[int]]] = []
+        self._listeners: Dict[int, Tuple[Tuple[str, ...], Callable[[ChangeEvent], None]]] = {}
+        self._listener_ids = 0
+        self._delivery_lock = threading.RLock()
+        self._delivering: Optional[int] = None
+        # Newest entries kept in `kv_changelog`; 0 disables the durable log.
+        self._changelog_size = changelog_size
+        self._tx_depth = 0
+        self._tx_owner: Optional[int] = None
+        self._group_open = False
+        self._group_deadline = 0.0
+        self._writer_queue_size = writer_queue_size
+        self._writer: Optional[_WriterThread] = None
+        # Root -> writes queued on the writer thread that readers of that root must wait for.
+        self._pending_writes: Dict[str, set] = {}
+        self._pending_lock = threading.Lock()
+        # Autocommit mode: transactions are opened explicitly by `_write`/`transaction`.
+        self._conn = sqlite3.connect(self._path.as_posix(), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute(f"PRAGMA synchronous={self._profile.synchronous};")
+        self._conn.execute(f"PRAGMA wal_autocheckpoint={int(self._profile.wal_autocheckpoint)};")
+        self._conn.execute("PRAGMA foreign_keys=ON;")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_store (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at INTEGER NOT NULL,
+                codec TEXT NOT NULL DEFAULT 'json',
+                flags INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_children (
+                root TEXT NOT NULL,
+                child TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at INTEGER NOT NULL,
+                codec TEXT NOT NULL DEFAULT 'json',
+                flags INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (root, child)
+            );
+            """
+        )
+        for table in ("kv_store", "kv_children"):
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if "codec" not in columns:
+                # Rows written before codecs existed are stdlib JSON text.
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN codec TEXT NOT NULL DEFAULT 'json'")
+            if "flags" not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN flags INTEGER NOT NULL DEFAULT 0")
+            if "version" not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS history_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                stream TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                time TEXT NOT NULL,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS history_log_owner_time ON history_log (stream, owner, time);"
+        )
+        # Secondary indexes: one row per child and indexed field, holding the field's
+        # scalar value (NULL when missing), so ordered queries never decode whole roots.
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_child_index (
+                root TEXT NOT NULL,
+                field TEXT NOT NULL,
+                child TEXT NOT NULL,
+                value,
+                PRIMARY KEY (root, field, child)
+            ) WITHOUT ROWID;
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS kv_child_index_order ON kv_child_index (root, field, value, child);"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_expiry (
+                path TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            );
+            """
+        )
+        # Covers pop_expired: due rows in expiry order, with the path filter answered from the index.
+        self._conn.execute("DROP INDEX IF EXISTS kv_expiry_due;")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_expiry_due_path ON kv_expiry (expires_at, path);")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_changelog (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT NOT NULL,
+                changed_at INTEGER NOT NULL
+            );
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_indexes (
+                root TEXT NOT NULL,
+                field TEXT NOT NULL,
+                PRIMARY KEY (root, field)
+            );
+            """
+        )
+        # Row versions come from one database-wide counter, so a row that is deleted and
+        # recreated never reuses a version an optimistic transaction may have seen.
+        self._last_version = max(
+            self._conn.execute(f"SELECT COALESCE(MAX(version), 0) FROM {table}").fetchone()[0]
+            for table in ("kv_store", "kv_children")
+        )
+        self._sync_layout()
+        self._sync_indexes()
+        self._readers = _ReaderPool(self._path, reader_pool_size) if reader_pool_size > 0 else None
+        self._stop_maintenance = threading.Event()
+        self._maintenance: Optional[threading.Thread] = None
+        if self._profile.group_commit_interval > 0:
+            atexit.register(self.commit_pending)
+        if self._profile.group_commit_interval > 0 or self._profile.checkpoint_interval:
+            self._maintenance = threading.Thread(
+                target=self._run_maintenance, name="local-db-maintenance", daemon=True
+            )
+            self._maintenance.start()
+
+    @property
+    def durability(self) -> DurabilityProfile:
+        return self._profile
+
+    @property
+    def codec(self) -> Codec:
+        return self._codec
+
+    def encode(self, value: Any) -> Tuple[Union[str, bytes], str]:
+        """Serialize `value` with the preferred codec, falling back to stdlib JSON."""
+        try:
+            return self._codec.encode(value), self._codec.name
+        # RuntimeError: a dict changed size while the codec walked it; retry once in JSON.
+        except (TypeError, ValueError, OverflowError, RuntimeError):
+            if self._codec.name == "json":
+                raise
+            return _json_encode(value), "json"
+
+    @staticmethod
+    def decode(payload: Union[str, bytes], codec: str) -> Any:
+        try:
+            decoder = CODECS[codec].decode
+        except KeyError:
+            raise ValueError(f"Stored value uses codec {codec!r}, which is not installed") from None
+        return decoder(payload)
+
+    def _pack(self, value: Any) -> Tuple[Union[str, bytes], str, int]:
+        """Encode `value` for storage, compressing payloads above the threshold."""
+        payload, codec = self.encode(value)
+        if self._compress_threshold and len(payload) >= self._compress_threshold:
+            raw = payload.encode("utf-8") if isinstance(payload, str) else payload
+            return zlib.compress(raw, self._compress_level), codec, FLAG_ZLIB
+        return payload, codec, 0
+
+    def _unpack(self, payload: Union[str, bytes], codec: str, flags: int) -> Tuple[Any, int]:
+        """Decode a stored row; also returns the uncompressed payload size."""
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return self.decode(payload, codec), len(payload)
+
+    def _is_stale(self, payload: Union[str, bytes], codec: str, flags: int) -> bool:
+        """Whether a row would be stored differently today (other codec or compression)."""
+        if codec != self._codec.name:
+            return True
+        compressed = bool(flags & FLAG_ZLIB)
+        if not self._compress_threshold:
+            return compressed
+        return not compressed and len(payload) >= self._compress_threshold
+
+    def _schedule_recode(self, keys: List[Tuple[str, ...]]) -> None:
+        """Lazily rewrite rows read in an older codec or compression, off the read path.
+
+        Recoding is only an optimisation: it is skipped on the writer thread itself (which
+        must never wait for its own queue) and dropped when the queue is full.
+        """
+        keys = [key for key in keys if key not in self._recode_skipped]
+        if not keys:
+            return
+        writer = self._get_writer()
+        if writer.is_current:
+            return
+        try:
+            future = writer.submit(self._recode, keys, block=False)
+        except queue.Full:
+            return
+        future.add_done_callback(_log_failed_write)
+
+    def _recode(self, keys: List[Tuple[str, ...]]) -> None:
+        with self._write():
+            for key in keys:
+                if len(key) == 1:
+                    select = ("SELECT value, codec, flags FROM kv_store WHERE key = ?", key)
+                    update = "UPDATE kv_store SET value = ?, codec = ?, flags = ? WHERE key = ? AND value = ?"
+                else:
+                    select = ("SELECT value, codec, flags FROM kv_children WHERE root = ? AND child = ?", key)
+                    update = (
+                        "UPDATE kv_children SET value = ?, codec = ?, flags = ? "
+                        "WHERE root = ? AND child = ? AND value = ?"
+                    )
+                row = self._conn.execute(*select).fetchone()
+                if row is None or not self._is_stale(*row):
+                    continue
+                packed = self._pack(self._unpack(*row)[0])
+                if packed[1:] == row[1:]:
+                    self._recode_skipped.add(key)
+                    continue
+                # The decoded value is unchanged, so cached entries stay valid.
+                self._conn.execute(update, (*packed, *key, row[0]))
+
+    def _sync_layout(self) -> None:
+        """Move every root into the layout requested by `split_roots`.
+
+        Dictionary blobs of split roots are exploded into child rows, and child rows of
+        roots that are no longer split are folded back into a single blob.
+        """
+        with self._write():
+            blob_keys = [row[0] for row in self._conn.execute("SELECT key FROM kv_store")]
+            child_roots = [row[0] for row in self._conn.execute("SELECT DISTINCT root FROM kv_children")]
+            for root in blob_keys:
+                if root not in self._split_roots:
+                    continue
+                row = self._conn.execute(
+                    "SELECT value, codec, flags FROM kv_store WHERE key = ?", (root,)
+                ).fetchone()
+                value = self._unpack(*row)[0]
+                if isinstance(value, dict):
+                    self._write_children(root, value)
+                    self._conn.execute("DELETE FROM kv_store WHERE key = ?", (root,))
+            for root in child_roots:
+                if root in self._split_roots:
+                    continue
+                value = self._read_children(root)
+                payload, codec, flags = self._pack(value)
+                self._conn.execute("DELETE FROM kv_children WHERE root = ?", (root,))
+                self._conn.execute("DELETE FROM kv_child_index WHERE root = ?", (root,))
+                self._conn.execute(
+                    "REPLACE INTO kv_store (key, value, updated_at, codec, flags, version) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (root, payload, int(time.time()), codec, flags, self._next_version()),
+                )
+
+    def _sync_indexes(self) -> None:
+        """Build indexes declared since the last run and drop those no longer declared."""
+        declared = {(root, field) for root, fields in self._indexes.items() for field in fields}
+        with self._write():
+            built = set(self._conn.execute("SELECT root, field FROM kv_indexes"))
+            for root, field in built - declared:
+                self._conn.execute("DELETE FROM kv_child_index WHERE root = ? AND field = ?", (root, field))
+                self._conn.execute("DELETE FROM kv_indexes WHERE root = ? AND field = ?", (root, field))
+            for root, field in declared - built:
+                self._write_index(root, self._read_children(root).items(), (field,))
+                self._conn.execute("INSERT INTO kv_indexes (root, field) VALUES (?, ?)", (root, field))
+
+    def _write_index(
+        self, root: str, children: Iterable[Tuple[str, Any]], fields: Optional[Tuple[str, ...]] = None
+    ) -> None:
+        fields = self._indexes.get(root, ()) if fields is None else fields
+        if not fields:
+            return
+        paths = [(field, tuple(field.split("/"))) for field in fields]
+        self._conn.executemany(
+            """
+            INSERT INTO kv_child_index (root, field, child, value) VALUES (?, ?, ?, ?)
+            ON CONFLICT (root, field, child) DO UPDATE SET value = excluded.value
+            WHERE kv_child_index.value IS NOT excluded.value
+            """,
+            [
+                (root, field, str(child), _index_value(_lookup(value, path, None)))
+                for child, value in children
+                for field, path in paths
+            ],
+        )
+
+    def has_index(self, root: str, field: str) -> bool:
+        return "/".join(filter(None, field.split("/"))) in self._indexes.get(root, ())
+
+    def query_index(
+        self,
+        root: str,
+        field: str,
+        start: Any = _MISSING,
+        end: Any = _MISSING,
+        limit: Optional[int] = None,
+        last: bool = False,
+    ) -> List[Tuple[str, Any]]:
+        """Children of `root` ordered by an indexed `field`, as (child, value) pairs.
+
+        `start`/`end` bound the field value inclusively; `limit` keeps the first entries,
+        or the last ones when `last` is true. The result is always in ascending order.
+        """
+        clauses = ["i.root = ?", "i.field = ?"]
+        params: List[Any] = [root, "/".join(filter(None, field.split("/")))]
+        if start is not _MISSING:
+            clauses.append("i.value >= ?")
+            params.append(_index_value(start))
+        if end is not _MISSING:
+            clauses.append("i.value <= ?")
+            params.append(_index_value(end))
+        order = "DESC" if last else "ASC"
+        sql = f"""
+            SELECT i.child, c.value, c.codec, c.flags
+            FROM kv_child_index AS i JOIN kv_children AS c ON c.root = i.root AND c.child = i.child
+            WHERE {" AND ".join(clauses)}
+            ORDER BY i.value {order}, i.child {order}
+        """
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        if last:
+            rows.reverse()
+        return [(child, self._unpack(*stored)[0]) for child, *stored in rows]
+
+    def _next_version(self) -> int:
+        # Only called by writers, which hold `_lock`.
+        self._last_version += 1
+        return self._last_version
+
+    @contextmanager
+    def _write(self) -> Iterator[None]:
+        """Run the enclosed statements atomically, joining an open transaction if any.
+
+        Only this thread's own transaction can be joined (it already holds `_lock`);
+        otherwise a new one is opened, which waits for the lock itself. `_lock` must not be
+        held around `transaction()`, or its listener delivery would run under it.
+        """
+        if self._tx_owner == threading.get_ident():
+            yield
+            return
+        with self.transaction():
+            yield
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """Connection for a read: the writer's while it holds uncommitted data, else a pooled one.
+
+        The thread inside a transaction, and everyone while a group commit is open, must
+        read through the writer to see its writes. Other reads go to the pool and are not
+        blocked by the writer lock.
+        """
+        if self._readers is None or self._group_open or self._tx_owner == threading.get_ident():
+            with self._lock:
+                yield self._conn
+            return
+        with self._readers.connection() as conn:
+            yield conn
+
+    def _record_change(self, root: str, child: Optional[str] = None) -> None:
+        """Note a row written by the open transaction: drop it from the cache and log it."""
+        self._cache.invalidate(root, child)
+        self._uncommitted.add(root)
+        path = (root,) if child is None else (root, child)
+        sequence = None
+        if self._changelog_size > 0:
+            cursor = self._conn.execute(
+                "INSERT INTO kv_changelog (path, changed_at) VALUES (?, ?)",
+                ("/" + "/".join(path), int(time.time())),
+            )
+            sequence = cursor.lastrowid
+            if sequence % 256 == 0:
+                self._conn.execute("DELETE FROM kv_changelog WHERE seq <= ?", (sequence - self._changelog_size,))
+        self._changes.append((path, sequence))
+
+    def _cacheable(self, root: str) -> bool:
+        # Outside group commit, values written by an open transaction stay out of the
+        # cache, where other threads would otherwise see them before the commit.
+        return self._profile.group_commit_interval > 0 or root not in self._uncommitted
+
+    def _committed(self) -> None:
+        for root in self._uncommitted:
+            self._cache.invalidate(root)
+        self._uncommitted.clear()
+        self._undelivered.extend(self._changes)
+        self._changes.clear()
+
+    def _deliver(self) -> None:
+        """Call listeners for committed changes.
+
+        Callers invoke this once they have left every `with self._lock` block (the
+        outermost `transaction()`, `commit_pending()`), so a listener may wait for writes
+        made by other threads. One thread delivers at a time; a thread that commits while
+        another is delivering leaves its changes queued for that thread instead of
+        waiting, since the delivering listener may itself be waiting for that commit.
+        """
+        if self._delivering == threading.get_ident():
+            # A listener wrote something; the loop below delivers it after the current event.
+            return
+        while self._undelivered:
+            if not self._delivery_lock.acquire(blocking=False):
+                return
+            self._delivering = threading.get_ident()
+            try:
+                while self._undelivered:
+                    path, sequence = self._undelivered.pop(0)
+                    event = ChangeEvent("/" + "/".join(path), sequence)
+                    for prefix, callback in list(self._listeners.values()):
+                        if prefix[: len(path)] != path[: len(prefix)]:
+                            continue
+                        try:
+                            callback(event)
+                        except Exception:
+                            logger.exception("Change listener failed for %s", event.path)
+            finally:
+                self._delivering = None
+                self._delivery_lock.release()
+            # Changes queued by a thread that found the lock taken just before the release
+            # are picked up by the next pass.
+
+    def add_listener(
+        self, segments: Tuple[str, ...], callback: Callable[[ChangeEvent], None]
+    ) -> ListenerRegistration:
+        """Call `callback` after each commit that changes a row at, above or below `segments`."""
+        with self._delivery_lock:
+            self._listener_ids += 1
+            self._listeners[self._listener_ids] = (tuple(segments), callback)
+            return ListenerRegistration(self, self._listener_ids)
+
+    def _remove_listener(self, listener_id: int) -> None:
+        with self._delivery_lock:
+            self._listeners.pop(listener_id, None)
+
+    def changes_since(self, sequence: int, limit: int = 1000) -> List[Tuple[int, str]]:
+        """Entries of the durable change log after `sequence`, oldest first, as (seq, path)."""
+        with self._reader() as conn:
+            return conn.execute(
+                "SELECT seq, path FROM kv_changelog WHERE seq > ? ORDER BY seq LIMIT ?",
+                (sequence, limit),
+            ).fetchall()
+
+    @contextmanager
+    def transaction(self) -> Iterator["LocalDatabase"]:
+        """Group every write made inside the block into one SQLite transaction.
+
+        All sets, updates and deletes, through this database or any of its references,
+        are committed together with a single sync when the outermost block exits, or
+        rolled back if it raises. Nested blocks become savepoints, so a failing inner
+        block can be caught without discarding the outer one. Writes from other threads wait
+        for the transaction to finish; their reads see the last committed state.
+        """
+        with self._lock:
+            depth = self._tx_depth
+            savepoint = f"sp_{depth}"
+            group = self._profile.group_commit_interval > 0
+            if group and not self._group_open:
+                # Group commit: the surrounding SQLite transaction stays open until the
+                # interval elapses; each block only owns a savepoint inside it.
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._group_open = True
+                self._group_deadline = time.monotonic() + self._profile.group_commit_interval
+            outermost = not depth and not group
+            self._conn.execute("BEGIN IMMEDIATE" if outermost else f"SAVEPOINT {savepoint}")
+            changes_mark = len(self._changes)
+            self._tx_depth += 1
+            self._tx_owner = threading.get_ident()
+            try:
+                yield self
+            except BaseException:
+                self._tx_depth -= 1
+                if not self._tx_depth:
+                    self._tx_owner = None
+                # Values read inside the block may have been rolled back.
+                self._cache.clear()
+                del self._changes[changes_mark:]
+                if outermost:
+                    self._conn.execute("ROLLBACK")
+                    self._uncommitted.clear()
+                else:
+                    self._conn.execute(f"ROLLBACK TO {savepoint}")
+                    self._conn.execute(f"RELEASE {savepoint}")
+                raise
+            self._tx_depth -= 1
+            if not self._tx_depth:
+                self._tx_owner = None
+            if outermost:
+                self._conn.execute("COMMIT")
+                self._committed()
+            else:
+                self._conn.execute(f"RELEASE {savepoint}")
+            if group and not depth and time.monotonic() >= self._group_deadline:
+                self._commit_group()
+        if self._tx_owner != threading.get_ident():
+            self._deliver()
+
+    def commit_pending(self) -> None:
+        """Commit the open group-commit transaction, if any, making its writes durable."""
+        with self._lock:
+            self._commit_group()
+        self._deliver()
+
+    def _commit_group(self) -> None:
+        if self._group_open and not self._tx_depth:
+            self._conn.execute("COMMIT")
+            self._group_open = False
+            self._committed()
+
+    def checkpoint(self, mode: str = "PASSIVE") -> Tuple[int, int, int]:
+        """Run a WAL checkpoint on a separate connection so the writer is not blocked.
+
+        Returns SQLite's (busy, wal_pages, checkpointed_pages) triple.
+        """
+        conn = sqlite3.connect(self._path.as_posix(), timeout=30)
+        try:
+            return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode});").fetchone())
+        finally:
+            conn.close()
+
+    def backup(self, directory: Union[str, Path], keep: Optional[int] = 7, **options: Any) -> BackupReport:
+        """Online backup of this database into `directory`; see `backup_database`."""
+        return backup_database(self._path, directory, keep=keep, **options)
+
+    def _run_maintenance(self) -> None:
+        group_interval = self._profile.group_commit_interval
+        checkpoint_interval = self._profile.checkpoint_interval
+        tick = min(value for value in (group_interval, checkpoint_interval) if value)
+        next_checkpoint = time.monotonic() + (checkpoint_interval or 0)
+        while not self._stop_maintenance.wait(tick):
+            try:
+                now = time.monotonic()
+                if self._group_open and now >= self._group_deadline:
+                    self.commit_pending()
+                if checkpoint_interval and now >= next_checkpoint:
+                    next_checkpoint = now + checkpoint_interval
+                    self.checkpoint()
+            except Exception:
+                logger.exception("Storage maintenance failed")
+
+    def is_split(self, root: str) -> bool:
+        return root in self._split_roots
+
+    def reference(self, *segments: str) -> "LocalReference":
+        parts: list[str] = []
+        for segment in segments:
+            if segment is None:
+                continue
+            cleaned = segment.strip("/")
+            if not cleaned:
+                continue
+            parts.extend(filter(None, cleaned.split("/")))
+        return LocalReference(self, parts)
+
+    def root_keys(self) -> List[str]:
+        """Names of all stored roots, whatever their layout."""
+        with self._reader() as conn:
+            rows = conn.execute("SELECT key FROM kv_store UNION SELECT DISTINCT root FROM kv_children").fetchall()
+        return sorted(row[0] for row in rows)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit/miss/eviction counters and current size of the decoded-value cache."""
+        return self._cache.stats()
+
+    def get(self, key: str) -> Optional[Any]:
+        cached = self._cache.get((key,))
+        if cached is not _MISSING:
+            return _clone(cached)
+        with self._reader() as conn:
+            generation = self._cache.generation(key)
+            cursor = conn.execute("SELECT value, codec, flags FROM kv_store WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            if row is None and key in self._split_roots:
+                rows = conn.execute(
+                    "SELECT child, value, codec, flags FROM kv_children WHERE root = ? ORDER BY rowid",
+                    (key,),
+                ).fetchall()
+        if row is not None:
+            value, size = self._unpack(*row)
+            if self._is_stale(*row):
+                self._schedule_recode([(key,)])
+        elif key in self._split_roots and rows:
+            value, size = {}, 0
+            for child, *stored in rows:
+                value[child], child_size = self._unpack(*stored)
+                size += child_size
+            self._schedule_recode([(key, row[0]) for row in rows if self._is_stale(*row[1:])])
+        else:
+            value, size = None, 0
+        if self._cacheable(key):
+            self._cache.put((key,), value, size, generation)
+        return _clone(value)
+
+    def set(self, key: str, value: Any) -> None:
+        if key in self._split_roots and isinstance(value, dict):
+            with self._write():
+                self._conn.execute("DELETE FROM kv_store WHERE key = ?", (key,))
+                self._write_children(key, value)
+                self._record_change(key)
+            return
+
+        payload, codec, flags = self._pack(value)
+        timestamp = int(time.time())
+        with self._write():
+            self._conn.execute(
+                "REPLACE INTO kv_store (key, value, updated_at, codec, flags, version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload, timestamp, codec, flags, self._next_version()),
+            )
+            if key in self._split_roots:
+                self._conn.execute("DELETE FROM kv_children WHERE root = ?", (key,))
+                self._conn.execute("DELETE FROM kv_child_index WHERE root = ?", (key,))
+            self._record_change(key)
+
+    def delete(self, key: str) -> None:
+        with self._write():
+            self._conn.execute("DELETE FROM kv_store WHERE key = ?", (key,))
+            self._conn.execute("DELETE FROM kv_children WHERE root = ?", (key,))
+            self._conn.execute("DELETE FROM kv_child_index WHERE root = ?", (key,))
+            self._record_change(key)
+
+    def get_child(self, root: str, child: str) -> Optional[Any]:
+        cached = self._cache.get((root, child))
+        if cached is not _MISSING:
+            return _clone(cached)
+        with self._reader() as conn:
+            generation = self._cache.generation(root)
+            cursor = conn.execute(
+                "SELECT value, codec, flags FROM kv_children WHERE root = ? AND child = ?",
+                (root, child),
+            )
+            row = cursor.fetchone()
+        value, size = (None, 0) if row is None else self._unpack(*row)
+        if row is not None and self._is_stale(*row):
+            self._schedule_recode([(root, child)])
+        if self._cacheable(root):
+            self._cache.put((root, child), value, size, generation)
+        return _clone(value)
+
+    def get_children(self, root: str, children: Iterable[str]) -> Dict[str, Any]:
+        """Stored values of the given children of a split root; missing children are left out."""
+        wanted = [str(child) for child in children]
+        found: Dict[str, Any] = {}
+        with self._reader() as conn:
+            for start in range(0, len(wanted), 500):
+                chunk = wanted[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = conn.execute(
+                    f"SELECT child, value, codec, flags FROM kv_children WHERE root = ? AND child IN ({placeholders})",
+                    (root, *chunk),
+                )
+                for child, *stored in cursor:
+                    found[child] = self._unpack(*stored)[0]
+        return found
+
+    def child_keys(self, root: str) -> List[str]:
+        """Keys of all stored children of a split root, without decoding their values."""
+        with self._reader() as conn:
+            return [row[0] for row in conn.execute("SELECT child FROM kv_children WHERE root = ?", (root,))]
+
+    def set_child(self, root: str, child: str, value: Any) -> None:
+        payload, codec, flags = self._pack(value)
+        timestamp = int(time.time())
+        with self._write():
+            # A non-dictionary blob stored for the root is replaced, as with nested sets.
+            self._conn.execute("DELETE FROM kv_store WHERE key = ?", (root,))
+            self._conn.execute(
+                """
+                INSERT INTO kv_children (root, child, value, updated_at, codec, flags, version)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (root, child) DO UPDATE
+                SET value = excluded.value, updated_at = excluded.updated_at,
+                    codec = excluded.codec, flags = excluded.flags, version = excluded.version
+                """,
+                (root, child, payload, timestamp, codec, flags, self._next_version()),
+            )
+            self._write_index(root, [(child, value)])
+            self._record_change(root, child)
+
+    def set_children(self, root: str, children: Dict[Any, Any]) -> None:
+        """Insert or replace several children of a split root at once; other children stay."""
+        timestamp = int(time.time())
+        with self._write():
+            version = self._next_version()
+            rows = [
+                (root, str(child), *self._pack(value), timestamp, version)
+                for child, value in children.items()
+            ]
+            self._conn.execute("DELETE FROM kv_store WHERE key = ?", (root,))
+            self._conn.executemany(
+                """
+                INSERT INTO kv_children (root, child, value, codec, flags, updated_at, version)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (root, child) DO UPDATE
+                SET value = excluded.value, updated_at = excluded.updated_at,
+                    codec = excluded.codec, flags = excluded.flags, version = excluded.version
+                """,
+                rows,
+            )
+            self._write_index(root, children.items())
+            self._record_change(root)
+
+    def delete_child(self, root: str, child: str) -> None:
+        with self._write():
+            self._conn.execute("DELETE FROM kv_children WHERE root = ? AND child = ?", (root, child))
+            self._conn.execute("DELETE FROM kv_child_index WHERE root = ? AND child = ?", (root, child))
+            self._record_change(root, child)
+
+    def set_expiry(self, segments: Tuple[str, ...], expires_at: Optional[float]) -> None:
+        """Record when the value at `segments` expires (a Unix time), or forget it with None."""
+        path = "/".join(segments)
+        with self._write():
+            if expires_at is None:
+                self._conn.execute("DELETE FROM kv_expiry WHERE path = ?", (path,))
+            else:
+                self._conn.execute(
+                    "REPLACE INTO kv_expiry (path, expires_at) VALUES (?, ?)", (path, float(expires_at))
+                )
+
+    def clear_expiry(self, segments: Tuple[str, ...]) -> None:
+        """Forget expiry times at and below `segments`."""
+        path = "/".join(segments)
+        with self._write():
+            if not path:
+                self._conn.execute("DELETE FROM kv_expiry")
+                return
+            # "0" sorts right after "/", so the range covers exactly the paths below.
+            self._conn.execute(
+                "DELETE FROM kv_expiry WHERE path = ? OR (path >= ? AND path < ?)",
+                (path, path + "/", path + "0"),
+            )
+
+    def pop_expired(
+        self, segments: Tuple[str, ...] = (), now: Optional[float] = None, limit: Optional[int] = None
+    ) -> List[Tuple[str, ...]]:
+        """Remove and return the paths at or below `segments` whose expiry time has passed.
+
+        Only due entries are visited (through the `(expires_at, path)` index), soonest
+        first, and at most `limit` of them. The stored values are left alone: the caller
+        decides what expiring means.
+        """
+        now = time.time() if now is None else now
+        prefix = "/".join(segments)
+        sql = "SELECT path FROM kv_expiry WHERE expires_at <= ?"
+        params: List[Any] = [now]
+        if prefix:
+            # Same range as clear_expiry: the path itself and everything below it.
+            sql += " AND (path = ? OR (path >= ? AND path < ?))"
+            params += [prefix, prefix + "/", prefix + "0"]
+        sql += " ORDER BY expires_at LIMIT ?"
+        params.append(-1 if limit is None else limit)
+        with self._write():
+            due = [row[0] for row in self._conn.execute(sql, params).fetchall()]
+            self._conn.executemany("DELETE FROM kv_expiry WHERE path = ?", [(path,) for path in due])
+        return [tuple(path.split("/")) for path in due]
+
+    def read_versioned(self, root: str, child: Optional[str] = None) -> Tuple[Any, Optional[int]]:
+        """Read one storage row, bypassing the cache, with its version (None if absent)."""
+        with self._reader() as conn:
+            if child is None:
+                row = conn.execute(
+                    "SELECT value, codec, flags, version FROM kv_store WHERE key = ?", (root,)
+                ).fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT value, codec, flags, version FROM kv_children WHERE root = ? AND child = ?",
+                    (root, child),
+                ).fetchone()
+        if row is None:
+            return None, None
+        return self._unpack(*row[:3])[0], row[3]
+
+    def row_version(self, root: str, child: Optional[str] = None) -> Optional[int]:
+        """Current version of a storage row, or None if it does not exist."""
+        with self._reader() as conn:
+            if child is None:
+                row = conn.execute("SELECT version FROM kv_store WHERE key = ?", (root,)).fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT version FROM kv_children WHERE root = ? AND child = ?", (root, child)
+                ).fetchone()
+        return None if row is None else row[0]
+
+    def _read_children(self, root: str) -> Dict[str, Any]:
+        cursor = self._conn.execute(
+            "SELECT child, value, codec, flags FROM kv_children WHERE root = ? ORDER BY rowid",
+            (root,),
+        )
+        return {child: self._unpack(*stored)[0] for child, *stored in cursor}
+
+    def _write_children(self, root: str, value: Dict[Any, Any]) -> None:
+        """Replace all children of `root`, rewriting only rows whose payload changed."""
+        timestamp = int(time.time())
+        version = self._next_version()
+        rows = [
+            (root, str(child), *self._pack(child_value), timestamp, version)
+            for child, child_value in value.items()
+        ]
+        existing = {row[0] for row in self._conn.execute("SELECT child FROM kv_children WHERE root = ?", (root,))}
+        stale = existing.difference(row[1] for row in rows)
+        if stale:
+            self._conn.executemany(
+                "DELETE FROM kv_children WHERE root = ? AND child = ?",
+                [(root, child) for child in stale],
+            )
+            self._conn.executemany(
+                "DELETE FROM kv_child_index WHERE root = ? AND child = ?",
+                [(root, child) for child in stale],
+            )
+        self._conn.executemany(
+            """
+            INSERT INTO kv_children (root, child, value, codec, flags, updated_at, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (root, child) DO UPDATE
+            SET value = excluded.value, updated_at = excluded.updated_at,
+                codec = excluded.codec, flags = excluded.flags, version = excluded.version
+            WHERE kv_children.value <> excluded.value
+            """,
+            rows,
+        )
+        self._write_index(root, value.items())
+
+    def _get_writer(self) -> _WriterThread:
+        with self._pending_lock:
+            if self._writer is None:
+                self._writer = _WriterThread(self._writer_queue_size)
+            return self._writer
+
+    def call_in_writer(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run `fn(*args)` on the writer thread and wait for it.
+
+        Used by synchronous callers that must be ordered after already queued writes.
+        Runs inline when the writer thread was never started or is the caller.
+        """
+        writer = self._writer
+        if writer is None or writer.is_current:
+            return fn(*args)
+        return writer.submit(fn, *args).result()
+
+    async def run_write(self, roots: Iterable[str], fn: Callable[..., Any], *args: Any) -> Any:
+        """Run the blocking write `fn(*args)` on the writer thread without blocking the loop.
+
+        Until the job completes, `run_read` calls for any of `roots` wait for it, which
+        gives coroutines read-your-writes consistency. When the writer queue is full the
+        caller waits for a free slot in an executor instead of stalling the event loop.
+        """
+        writer = self._get_writer()
+        try:
+            future = writer.submit(fn, *args, block=False)
+        except queue.Full:
+            loop = asyncio.get_running_loop()
+            future = await loop.run_in_executor(None, lambda: writer.submit(fn, *args))
+        self._track_write(roots, future)
+        return await asyncio.wrap_future(future)
+
+    def submit_write(self, roots: Iterable[str], fn: Callable[..., Any], *args: Any) -> concurrent.futures.Future:
+        """Queue `fn(*args)` on the writer thread without waiting for it (fire and forget).
+
+        Never blocks, even when the writer queue is full, so it is safe on the event loop.
+        Reads through `run_read` still observe the write. Failures are logged.
+        """
+        future = self._get_writer().submit_nowait(fn, *args)
+        self._track_write(roots, future)
+        future.add_done_callback(_log_failed_write)
+        return future
+
+    def _track_write(self, roots: Iterable[str], future: concurrent.futures.Future) -> None:
+        roots = tuple(roots)
+        with self._pending_lock:
+            for root in roots:
+                self._pending_writes.setdefault(root, set()).add(future)
+        future.add_done_callback(lambda done: self._forget_write(roots, done))
+
+    def _forget_write(self, roots: Tuple[str, ...], future: concurrent.futures.Future) -> None:
+        with self._pending_lock:
+            for root in roots:
+                pending = self._pending_writes.get(root)
+                if pending is None:
+                    continue
+                pending.discard(future)
+                if not pending:
+                    del self._pending_writes[root]
+
+    async def run_read(self, root: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run the blocking read `fn(*args)` in an executor after queued writes to `root`."""
+        with self._pending_lock:
+            pending = list(self._pending_writes.get(root, ()))
+        if pending:
+            await asyncio.wait([asyncio.wrap_future(future) for future in pending])
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, fn, *args)
+
+    def history(self, stream: str) -> "LocalHistory":
+        return LocalHistory(self, stream)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._maintenance is not None:
+            self._stop_maintenance.set()
+            self._maintenance.join()
+            self._maintenance = None
+        self.commit_pending()
+        with self._lock:
+            self._commit_group()
+            self._conn.close()
+        if self._readers is not None:
+            self._readers.close()
+
+
+def _log_failed_write(future: concurrent.futures.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Queued storage write failed", exc_info=future.exception())
+
+
+BACKUP_PAGES = 1024
+BACKUP_PAUSE = 0.005
+BACKUP_MAX_RESTARTS = 3
+
+
+def backup_database(
+    database_path: Union[str, Path],
+    directory: Union[str, Path],
+    keep: Optional[int] = 7,
+    pages: int = BACKUP_PAGES,
+    pause: float = BACKUP_PAUSE,
+    max_restarts: int = BACKUP_MAX_RESTARTS,
+) -> BackupReport:
+    """Copy a live database into `directory` with the SQLite online backup API.
+
+    The copy uses its own connection and moves `pages` pages per step, sleeping `pause`
+    seconds between steps. In WAL mode each step only holds a read snapshot, so the
+    writer keeps committing. A commit from another connection restarts a paged backup;
+    after `max_restarts` restarts the rest is copied in one step from a single snapshot.
+    The file is written under a temporary name and renamed once complete. Only the
+    newest `keep` backups of this database stay in `directory` (None keeps all).
+    """
+    database_path = Path(database_path)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    target, partial = _reserve_backup_name(directory, database_path.stem)
+
+    restarts = 0
+    total_pages = 0
+    previous: Optional[int] = None
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal restarts, total_pages, previous
+        total_pages = total
+        if previous is not None and remaining > previous:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _BackupRestarted
+        previous = remaining
+        if remaining and pause:
+            time.sleep(pause)
+
+    started = time.perf_counter()
+    source = sqlite3.connect(database_path.as_posix(), timeout=30)
+    try:
+        destination = sqlite3.connect(partial.as_posix())
+        try:
+            try:
+                source.backup(destination, pages=pages, progress=progress)
+            except _BackupRestarted:
+                source.backup(destination)
+                total_pages = destination.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            destination.close()
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    finally:
+        source.close()
+    partial.replace(target)
+    duration = time.perf_counter() - started
+
+    if keep is not None:
+        backups = list_backups(directory, database_path)
+        for stale in backups[: max(len(backups) - max(keep, 1), 0)]:
+            stale.unlink(missing_ok=True)
+    return BackupReport(target, target.stat().st_size, total_pages, duration, restarts)
+
+
+def _reserve_backup_name(directory: Path, stem: str) -> Tuple[Path, Path]:
+    """Pick an unused `<stem>-<date>-<time>-<microseconds>.sqlite3` name and create its .part file.
+
+    A taken name moves the stamp on by a microsecond, so names stay unique and sort
+    in creation order even when backups start within the same clock tick.
+    """
+    stamp = datetime.now()
+    while True:
+        target = directory / f"{stem}-{stamp:%Y%m%d-%H%M%S-%f}.sqlite3"
+        partial = target.with_name(target.name + ".part")
+        if not target.exists():
+            try:
+                partial.touch(exist_ok=False)
+                return target, partial
+            except FileExistsError:
+                pass
+        stamp += timedelta(microseconds=1)
+
+
+def list_backups(directory: Union[str, Path], database_path: Union[str, Path]) -> List[Path]:
+    """Backups of `database_path` in `directory`, oldest first."""
+    stem = Path(database_path).stem
+    return sorted(Path(directory).glob(f"{stem}-[0-9]*-[0-9]*.sqlite3"))
+
+
+def restore_backup(backup_path: Union[str, Path], database_path: Union[str, Path]) -> int:
+    """Replace the database at `database_path` with a backup; returns the copied page count.
+
+    The backup is integrity-checked first. Stop the bot before restoring: open
+    connections would keep serving the old data.
+    """
+    source = sqlite3.connect(f"file:{Path(backup_path).as_posix()}?mode=ro", uri=True)
+    try:
+        status = source.execute("PRAGMA integrity_check").fetchone()[0]
+        if status != "ok":
+            raise ValueError(f"Backup {backup_path} failed the integrity check: {status}")
+        destination = sqlite3.connect(Path(database_path).as_posix(), timeout=30)
+        try:
+            source.backup(destination)
+            return destination.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            destination.close()
+    finally:
+        source.close()
+
+
+def _index_value(value: Any) -> Any:
+    """Scalar stored in `kv_child_index` for a field value; None for missing or non-scalar."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int) and not -(2**63) <= value < 2**63:
+        # SQLite integers are 64-bit; a float keeps the ordering of huge balances.
+        return float(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    return None
+
+
+def _order_key(value: Any) -> Tuple[int, Any]:
+    """Firebase order of indexed values: missing first, then numbers, then strings."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, str):
+        return (2, value)
+    return (1, value)
+
+
+def _assign(node: Dict[str, Any], segments: Tuple[str, ...], value: Any) -> None:
+    for segment in segments[:-1]:
+        child = node.get(segment)
+        if not isinstance(child, dict):
+            child = {}
+        node[segment] = child
+        node = child
+    node[segments[-1]] = value
+
+
+def _lookup(node: Any, segments: Tuple[str, ...], default: Any) -> Any:
+    for segment in segments:
+        if not isinstance(node, dict) or segment not in node:
+            return default
+        node = node[segment]
+    return node
+
+
+def _remove(node: Any, segments: Tuple[str, ...]) -> bool:
+    for segment in segments[:-1]:
+        if not isinstance(node, dict):
+            return False
+        node = node.get(segment)
+    if not isinstance(node, dict) or segments[-1] not in node:
+        return False
+    del node[segments[-1]]
+    return True
+
+
+class LocalReference:
+    """Firebase-like reference built on top of LocalDatabase.
+
+    A reference to the database root (``db.reference('/')``) only supports `child` and
+    multi-path `update`.
+    """
+
+    def __init__(self, db: LocalDatabase, segments: Iterable[str]):
+        self._db = db
+        normalized: list[str] = []
+        for segment in segments:
+            if segment is None:
+                continue
+            cleaned = segment.strip("/")
+            if not cleaned:
+                continue
+            normalized.extend(filter(None, cleaned.split("/")))
+        self._segments: Tuple[str, ...] = tuple(normalized)
+
+    @property
+    def _root(self) -> str:
+        if not self._segments:
+            raise ValueError("This operation needs a path below the database root")
+        return self._segments[0]
+
+    def child(self, segment: str) -> "LocalReference":
+        if not segment or not segment.strip("/"):
+            raise ValueError("Child segment cannot be empty")
+        return LocalReference(self._db, self._segments + (segment,))
+
+    def get(self, default: Any = None) -> Any:
+        root_key = self._root
+        if self._db.is_split(root_key) and len(self._segments) > 1:
+            data = self._db.get_child(root_key, self._segments[1])
+            if data is None:
+                return default
+            return _lookup(data, self._segments[2:], default)
+
+        data = self._db.get(root_key)
+        if data is None:
+            return default
+        return _lookup(data, self._segments[1:], default)
+
+    def set(self, value: Any) -> None:
+        root_key = self._root
+        if len(self._segments) == 1:
+            self._db.set(root_key, value)
+            return
+
+        if self._db.is_split(root_key):
+            child_key = self._segments[1]
+            if len(self._segments) == 2:
+                self._db.set_child(root_key, child_key, value)
+                return
+            with self._db.transaction():
+                data = self._db.get_child(root_key, child_key)
+                if not isinstance(data, dict):
+                    data = {}
+                _assign(data, self._segments[2:], value)
+                self._db.set_child(root_key, child_key, data)
+            return
+
+        with self._db.transaction():
+            data = self._db.get(root_key)
+            if not isinstance(data, dict):
+                data = {}
+            _assign(data, self._segments[1:], value)
+            self._db.set(root_key, data)
+
+    def update(self, value: Dict[str, Any]) -> None:
+        """Set several paths below this reference in one transaction.
+
+        Keys are paths relative to this reference and may contain slashes, e.g.
+        ``db.reference('/').update({'users_data/1/balance': 10, 'daily_leaderboard/data/1': 5})``.
+        Only the addressed values change; a None value deletes its path. Each storage row
+        is read and written once however many keys fall into it. Keys must not overlap.
+        """
+        with self._db.transaction():
+            for (root_key, child_key), assignments in self._fan_out(value).items():
+                if len(assignments) == 1 and not assignments[0][0]:
+                    LocalReference(self._db, (root_key, child_key))._store(assignments[0][1])
+                    continue
+                data = self._db.get(root_key) if child_key is None else self._db.get_child(root_key, child_key)
+                if not isinstance(data, dict):
+                    data = {}
+                for inner, item in assignments:
+                    if item is None:
+                        _remove(data, inner)
+                    else:
+                        _assign(data, inner, item)
+                if child_key is None:
+                    self._db.set(root_key, data)
+                else:
+                    self._db.set_child(root_key, child_key, data)
+
+    def _fan_out(
+        self, value: Dict[str, Any]
+    ) -> Dict[Tuple[str, Optional[str]], List[Tuple[Tuple[str, ...], Any]]]:
+        """Group update keys by storage row as `{(root, child): [(path inside row, value)]}`."""
+        if not isinstance(value, dict):
+            raise ValueError("Value for update must be a dictionary")
+        paths = []
+        for key, item in value.items():
+            path = LocalReference(self._db, (*self._segments, str(key)))._segments
+            if len(path) == len(self._segments):
+                raise ValueError("Update keys cannot be empty")
+            paths.append((path, item))
+        ordered = sorted(path for path, _ in paths)
+        for parent, path in zip(ordered, ordered[1:]):
+            if path[: len(parent)] == parent:
+                raise ValueError(f"Update paths overlap: /{'/'.join(parent)} and /{'/'.join(path)}")
+
+        rows: Dict[Tuple[str, Optional[str]], List[Tuple[Tuple[str, ...], Any]]] = {}
+        for path, item in paths:
+            if self._db.is_split(path[0]) and len(path) > 1:
+                row, inner = (path[0], path[1]), path[2:]
+            else:
+                row, inner = (path[0], None), path[1:]
+            rows.setdefault(row, []).append((inner, item))
+        return rows
+
+    async def aget(self, default: Any = None) -> Any:
+        return await self._db.run_read(self._root, self.get, default)
+
+    async def aset(self, value: Any) -> None:
+        # The value is snapshotted here, so the caller may keep mutating it after the await starts.
+        encoded = self._db.encode(value)
+        await self._db.run_write((self._root,), self._set_encoded, encoded)
+
+    async def aupdate(self, value: Dict[str, Any]) -> None:
+        roots = {root_key for root_key, _ in self._fan_out(value)}
+        encoded = self._db.encode(value)
+        await self._db.run_write(roots, self._update_encoded, encoded)
+
+    async def adelete(self) -> None:
+        await self._db.run_write((self._root,), self.delete)
+
+    def _set_encoded(self, encoded: Tuple[Union[str, bytes], str]) -> None:
+        self.set(self._db.decode(*encoded))
+
+    def _update_encoded(self, encoded: Tuple[Union[str, bytes], str]) -> None:
+        self.update(self._db.decode(*encoded))
+
+    def listen(self, callback: Callable[[ChangeEvent], None]) -> ListenerRegistration:
+        """Call `callback(event)` after every commit touching this path, its parents or children.
+
+        Callbacks run on the committing thread once the write lock is released; their
+        exceptions are logged. Events name the changed storage row, so a listener on
+        ``users_data/1/balance`` also hears about any change to user 1.
+        """
+        return self._db.add_listener(self._segments, callback)
+
+    def set_expiry(self, expires_at: Optional[float]) -> None:
+        """Mark this path as expiring at `expires_at` (Unix time); None clears the mark.
+
+        Expiry is only recorded: `pop_expired` reports the path once the time has passed.
+        Deleting the path through this reference clears the marks at and below it.
+        """
+        self._db.set_expiry(self._segments, expires_at)
+
+    async def aset_expiry(self, expires_at: Optional[float]) -> None:
+        await self._db.run_write((self._root,), self.set_expiry, expires_at)
+
+    def pop_expired(self, now: Optional[float] = None, limit: Optional[int] = None) -> List[Tuple[str, ...]]:
+        """Remove and return due expiry marks below this path, as paths relative to it."""
+        depth = len(self._segments)
+        return [path[depth:] for path in self._db.pop_expired(self._segments, now, limit)]
+
+    async def apop_expired(
+        self, now: Optional[float] = None, limit: Optional[int] = None
+    ) -> List[Tuple[str, ...]]:
+        return await self._db.run_write(self._segments[:1], self.pop_expired, now, limit)
+
+    def order_by_child(self, field: str) -> "LocalQuery":
+        """Start an ordered query over this node's children by the value at `field`."""
+        return LocalQuery(self, field)
+
+    def transaction(self, fn: Callable[[Any], Any], max_attempts: int = TRANSACTION_MAX_ATTEMPTS) -> Any:
+        """Atomically replace the value at this path with `fn(current)` and return it.
+
+        `fn` runs on a snapshot of the storage row holding this path, without the database
+        lock. The result is committed only if the row's version has not changed since;
+        otherwise `fn` is called again with fresh data, at most `max_attempts` times, then
+        TransactionAbortedError is raised. `fn` may therefore run more than once and must
+        not have side effects. Returning None deletes the value; an exception raised by
+        `fn` aborts the transaction without writing.
+        """
+        root_key = self._root
+        if self._db.is_split(root_key) and len(self._segments) == 1:
+            # A split root spans many rows, so it is locked for the whole update instead.
+            with self._db.transaction():
+                result = fn(self.get())
+                self._store(result)
+            return result
+
+        child_key = self._segments[1] if self._db.is_split(root_key) else None
+        inner = self._segments[2:] if child_key is not None else self._segments[1:]
+        for _ in range(max_attempts):
+            data, version = self._db.read_versioned(root_key, child_key)
+            result = fn(_lookup(data, inner, None))
+            with self._db.transaction():
+                if self._db.row_version(root_key, child_key) != version:
+                    continue
+                self._store(result)
+            return result
+        raise TransactionAbortedError(
+            f"Transaction on /{'/'.join(self._segments)} aborted after {max_attempts} conflicting attempts"
+        )
+
+    async def atransaction(self, fn: Callable[[Any], Any], max_attempts: int = TRANSACTION_MAX_ATTEMPTS) -> Any:
+        return await self._db.run_write((self._root,), self.transaction, fn, max_attempts)
+
+    def _store(self, value: Any) -> None:
+        if value is None:
+            self.delete()
+        else:
+            self.set(value)
+
+    def delete(self) -> None:
+        with self._db.transaction():
+            self._db.clear_expiry(self._segments)
+            self._delete()
+
+    def _delete(self) -> None:
+        root_key = self._root
+        if len(self._segments) == 1:
+            self._db.delete(root_key)
+            return
+
+        if self._db.is_split(root_key):
+            child_key = self._segments[1]
+            if len(self._segments) == 2:
+                self._db.delete_child(root_key, child_key)
+                return
+            with self._db.transaction():
+                data = self._db.get_child(root_key, child_key)
+                if _remove(data, self._segments[2:]):
+                    self._db.set_child(root_key, child_key, data)
+            return
+
+        with self._db.transaction():
+            data = self._db.get(root_key)
+            if _remove(data, self._segments[1:]):
+                self._db.set(root_key, data)
+
+
+class LocalQuery:
+    """Ordered query over the children of a reference, as in Firebase.
+
+    Children are ordered by the value at a field path: children without a scalar value
+    first, then numbers, then strings, ties broken by key. A query on a split root with a
+    declared index on the field is served by SQLite; any other query sorts in memory.
+    """
+
+    def __init__(self, ref: LocalReference, field: str):
+        segments = tuple(filter(None, field.split("/")))
+        if not segments:
+            raise ValueError("Order field cannot be empty")
+        self._ref = ref
+        self._field = segments
+        self._start: Any = _MISSING
+        self._end: Any = _MISSING
+        self._limit: Optional[int] = None
+        self._last = False
+
+    def start_at(self, value: Any) -> "LocalQuery":
+        if value is None:
+            raise ValueError("start_at value cannot be None")
+        self._start = value
+        return self
+
+    def end_at(self, value: Any) -> "LocalQuery":
+        if value is None:
+            raise ValueError("end_at value cannot be None")
+        self._end = value
+        return self
+
+    def equal_to(self, value: Any) -> "LocalQuery":
+        return self.start_at(value).end_at(value)
+
+    def limit_to_first(self, limit: int) -> "LocalQuery":
+        return self._set_limit(limit, last=False)
+
+    def limit_to_last(self, limit: int) -> "LocalQuery":
+        return self._set_limit(limit, last=True)
+
+    def _set_limit(self, limit: int, last: bool) -> "LocalQuery":
+        if not isinstance(limit, int) or limit < 0:
+            raise ValueError("Limit must be a non-negative integer")
+        if self._limit is not None:
+            raise ValueError("Cannot set both limit_to_first and limit_to_last")
+        self._limit = limit
+        self._last = last
+        return self
+
+    def get(self) -> "OrderedDict[str, Any]":
+        """Matching children in ascending order, keyed by child name."""
+        db = self._ref._db
+        segments = self._ref._segments
+        field = "/".join(self._field)
+        if len(segments) == 1 and db.has_index(segments[0], field):
+            rows = db.query_index(segments[0], field, self._start, self._end, self._limit, self._last)
+            return OrderedDict(rows)
+
+        data = self._ref.get()
+        if not isinstance(data, dict):
+            return OrderedDict()
+        entries = []
+        for child, value in data.items():
+            key = _order_key(_index_value(_lookup(value, self._field, None)))
+            if self._start is not _MISSING and key < _order_key(_index_value(self._start)):
+                continue
+            if self._end is not _MISSING and key > _order_key(_index_value(self._end)):
+                continue
+            entries.append((key, str(child), value))
+        entries.sort(key=lambda entry: entry[:2])
+        if self._limit is not None:
+            entries = entries[len(entries) - self._limit:] if self._last else entries[: self._limit]
+        return OrderedDict((child, value) for _, child, value in entries)
+
+    async def aget(self) -> "OrderedDict[str, Any]":
+        return await self._ref._db.run_read(self._ref._root, self.get)
+
+
+class LocalHistory:
+    """Append-only per-owner log (e.g. a player's recent games) in the `history_log` table.
+
+    Appending is a single INSERT plus a delete of the owner's overflow rows, independent
+    of how many owners exist. If the database still holds a legacy `{owner: [entries]}`
+    root with the same name as the stream, it is moved into the log on first use
+    (`import_legacy=False` leaves it in place, for read-only tools).
+    """
+
+    def __init__(self, db: LocalDatabase, stream: str, import_legacy: bool = True):
+        self._db = db
+        self._stream = stream
+        if import_legacy:
+            self._import_legacy_root()
+
+    def _import_legacy_root(self) -> None:
+        with self._db.transaction():
+            legacy = self._db.get(self._stream)
+            if legacy is None:
+                return
+            if isinstance(legacy, dict):
+                for owner, entries in legacy.items():
+                    if not isinstance(entries, list):
+                        continue
+                    # The root is authoritative, so re-importing it replaces the owner's log.
+                    self._delete_owner(str(owner))
+                    for entry in entries:
+                        self._insert(str(owner), entry)
+            self._db.delete(self._stream)
+
+    def _insert(self, owner: str, entry: Any) -> None:
+        timestamp = entry.get("time", "") if isinstance(entry, dict) else ""
+        self._db._conn.execute(
+            "INSERT INTO history_log (stream, owner, time, value) VALUES (?, ?, ?, ?)",
+            (self._stream, owner, str(timestamp), json.dumps(entry, ensure_ascii=False)),
+        )
+
+    def _delete_owner(self, owner: str) -> None:
+        self._db._conn.execute(
+            "DELETE FROM history_log WHERE stream = ? AND owner = ?",
+            (self._stream, owner),
+        )
+
+    def append(self, owner: Any, entry: Any, keep: Optional[int] = None) -> None:
+        """Append `entry` for `owner`, keeping only the newest `keep` entries if given."""
+        owner = str(owner)
+        with self._db._write():
+            self._insert(owner, entry)
+            if keep is not None:
+                self._db._conn.execute(
+                    """
+                    DELETE FROM history_log WHERE id IN (
+                        SELECT id FROM history_log WHERE stream = ? AND owner = ?
+                        ORDER BY time DESC, id DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self._stream, owner, keep),
+                )
+
+    def append_nowait(self, owner: Any, entry: Any, keep: Optional[int] = None) -> concurrent.futures.Future:
+        """Queue `append` on the writer thread so the event loop does not wait for the commit."""
+        return self._db.submit_write((self._stream,), self.append, owner, _clone(entry), keep)
+
+    def recent(self, owner: Any, limit: int) -> List[Any]:
+        """Return the newest `limit` entries for `owner`, newest first."""
+        with self._db._reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT value FROM history_log WHERE stream = ? AND owner = ?
+                ORDER BY time DESC, id DESC LIMIT ?
+                """,
+                (self._stream, str(owner), limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    async def arecent(self, owner: Any, limit: int) -> List[Any]:
+        return await self._db.run_read(self._stream, self.recent, owner, limit)
+
+    def delete(self, owner: Any) -> None:
+        with self._db._write():
+            self._delete_owner(str(owner))
+
+    def owners(self) -> List[str]:
+        with self._db._reader() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT owner FROM history_log WHERE stream = ? ORDER BY owner",
+                (self._stream,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def entries(self, owner: Any) -> List[Any]:
+        """All entries for `owner` in insertion order, oldest first (the export layout)."""
+        with self._db._reader() as conn:
+            rows = conn.execute(
+                "SELECT value FROM history_log WHERE stream = ? AND owner = ? ORDER BY id",
+                (self._stream, str(owner)),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def replace(self, owner: Any, entries: Iterable[Any]) -> None:
+        """Replace the log of `owner` with `entries`, oldest first."""
+        owner = str(owner)
+        with self._db._write():
+            self._delete_owner(owner)
+            for entry in entries:
+                self._insert(owner, entry)
+
+
+class WriteBehind:
+    """Coalesces repeated saves of the same path into one write per flush.
+
+    `mark(path, source)` records that `path` is dirty; `source` is called at flush time
+    to produce the value to store (``None`` deletes the path). Marking a root makes
+    pending marks of its children redundant. Dirty paths are written by `flush()`,
+    which `run()` calls every `interval` seconds or as soon as `max_batch` paths are
+    pending, so at most one interval of changes can be lost on a crash. Pending
+    changes are also flushed at interpreter exit.
+
+    Sources are evaluated on the calling thread, so they may read data that the event
+    loop mutates. Their values are encoded on the writer thread: the codec serializes a
+    value in one C call that does not let the loop run in between, and a value that
+    still changes mid-encode fails with an error and is retried on the next flush.
+    """
+
+    def __init__(self, interval: float = 1.0, max_batch: int = 256):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._dirty: Dict[Tuple[str, ...], Callable[[], Any]] = {}
+        self._lock = threading.RLock()
+        self._wakeup: Optional[asyncio.Event] = None
+        atexit.register(self.flush)
+
+    def __len__(self) -> int:
+        return len(self._dirty)
+
+    def mark(self, path: str, source: Callable[[], Any]) -> None:
+        segments = tuple(filter(None, path.strip("/").split("/")))
+        if not segments:
+            raise ValueError("Write-behind path cannot be empty")
+        with self._lock:
+            for length in range(1, len(segments)):
+                if segments[:length] in self._dirty:
+                    # An ancestor is already dirty and will write this path too.
+                    return
+            if len(segments) == 1:
+                for pending in [key for key in self._dirty if key[0] == segments[0]]:
+                    del self._dirty[pending]
+            self._dirty[segments] = source
+            batch_full = len(self._dirty) >= self.max_batch
+        if batch_full and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _snapshot(self) -> Tuple[Dict[Tuple[str, ...], Callable[[], Any]], Dict[Tuple[str, ...], Any]]:
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        values: Dict[Tuple[str, ...], Any] = {}
+        for segments, source in list(pending.items()):
+            try:
+                values[segments] = source()
+            except Exception:
+                logger.exception("Failed to read %s", "/".join(segments))
+                self._restore({segments: source})
+                del pending[segments]
+        return pending, values
+
+    @staticmethod
+    def _store(database: LocalDatabase, values: Dict[Tuple[str, ...], Any]) -> list:
+        failed = []
+        # One commit for the whole batch; each path gets its own savepoint so a bad
+        # value only holds back that path.
+        with database.transaction():
+            for segments, value in values.items():
+                try:
+                    with database.transaction():
+                        ref = database.reference(*segments)
+                        if value is None:
+                            ref.delete()
+                        else:
+                            # Round-trip through the codec: the stored copy must not share
+                            # objects with the live data the loop keeps mutating.
+                            ref.set(database.decode(*database.encode(value)))
+                except Exception:
+                    logger.exception("Failed to flush %s", "/".join(segments))
+                    failed.append(segments)
+        return failed
+
+    def _restore(self, sources: Dict[Tuple[str, ...], Callable[[], Any]]) -> None:
+        with self._lock:
+            for segments, source in sources.items():
+                self._dirty.setdefault(segments, source)
+
+    def flush(self) -> int:
+        """Write all dirty paths now and wait for the commit."""
+        pending, values = self._snapshot()
+        if not values:
+            return 0
+        database = get_database()
+        try:
+            failed = database.call_in_writer(self._store, database, values)
+        except Exception:
+            logger.exception("Failed to flush %d paths", len(values))
+            failed = list(values)
+        self._restore({segments: pending[segments] for segments in failed})
+        return len(values) - len(failed)
+
+    async def aflush(self) -> int:
+        """Like `flush`, but the commit runs on the writer thread while the loop keeps going."""
+        pending, values = self._snapshot()
+        if not values:
+            return 0
+        database = get_database()
+        roots = {segments[0] for segments in values}
+        try:
+            failed = await database.run_write(roots, self._store, database, values)
+        except Exception:
+            logger.exception("Failed to flush %d paths", len(values))
+            failed = list(values)
+        self._restore({segments: pending[segments] for segments in failed})
+        return len(values) - len(failed)
+
+    async def run(self) -> None:
+        """Flush dirty paths periodically; must run on the loop that mutates the data."""
+        self._wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if self._dirty:
+                    await self.aflush()
+        finally:
+            self._wakeup = None
+            # Queued on the writer thread behind any in-flight batch, so order is preserved.
+            self.flush()
+
+
+class RecordMigrations:
+    """Ordered, versioned upgrade steps for one kind of stored record (e.g. user profiles).
+
+    Steps are registered in order with `step`; a record's version is the number of steps
+    already applied to it, kept in the record under `field` (records without it are at
+    version 0). A step receives the record and either mutates it in place or returns a
+    replacement, which lets a step turn a legacy scalar into a dictionary. Hot paths only
+    compare versions: ``if record.get(field) != migrations.latest``.
+    """
+
+    def __init__(self, field: str = "schema_version"):
+        self.field = field
+        self._steps: List[Callable[[Any], Any]] = []
+
+    def step(self, fn: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        """Register `fn` as the next version; usable as a decorator."""
+        self._steps.append(fn)
+        return fn
+
+    @property
+    def latest(self) -> int:
+        return len(self._steps)
+
+    def version(self, record: Any) -> int:
+        return record.get(self.field, 0) if isinstance(record, dict) else 0
+
+    def upgrade(self, record: Any) -> Any:
+        """Apply the steps `record` is missing and return it (or its replacement)."""
+        version = self.version(record)
+        if version >= self.latest:
+            return record
+        for fn in self._steps[version:]:
+            result = fn(record)
+            if result is not None:
+                record = result
+        if isinstance(record, dict):
+            record[self.field] = self.latest
+        return record
+
+    def upgrade_all(self, records: Dict[Any, Any]) -> List[Any]:
+        """Upgrade every value of `records` in place; returns the keys that changed."""
+        changed = []
+        for key, record in records.items():
+            if self.version(record) != self.latest:
+                records[key] = self.upgrade(record)
+                changed.append(key)
+        return changed
+
+
+_DEFAULT_DB_PATH = Path(__file__).with_name("storage.sqlite3")
+_db_lock = threading.RLock()
+_db_instance: Optional[LocalDatabase] = None
+
+
+def initialize(
+    database_path: Optional[Union[Path, str]] = None,
+    split_roots: Optional[Iterable[str]] = DEFAULT_SPLIT_ROOTS,
+    durability: Union[str, DurabilityProfile, None] = None,
+    indexes: Optional[Dict[str, Iterable[str]]] = DEFAULT_INDEXES,
+) -> LocalDatabase:
+    global _db_instance
+    with _db_lock:
+        path = Path(database_path) if database_path else _DEFAULT_DB_PATH
+        _db_instance = LocalDatabase(path, split_roots=split_roots, durability=durability, indexes=indexes)
+        return _db_instance
+
+
+def get_database() -> LocalDatabase:
+    global _db_instance
+    with _db_lock:
+        if _db_instance is None:
+            _db_instance = LocalDatabase(_DEFAULT_DB_PATH)
+        return _db_instance
+
+
+def reference(*segments: str) -> LocalReference:
+    return get_database().reference(*segments)
+
+
+def transaction():
+    return get_database().transaction()
+
+
+def history(stream: str) -> LocalHistory:
+    return get_database().history(stream)
+
+
+class _Facade(SimpleNamespace):
+    def reference(self, *segments: str) -> LocalReference:
+        return reference(*segments)
+
+    def transaction(self):
+        return transaction()
+
+    def history(self, stream: str) -> LocalHistory:
+        return history(stream)
+
+
+db = _Facade()
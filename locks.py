@@ -0,0 +1,178 @@
+"""Per-key asyncio locks: one user's updates run one at a time, different users in parallel.
+
+`KeyedLocks` creates a lock the first time a key is used and drops it as soon as no task
+holds or waits for it, so memory follows the number of users active right now rather
+than every user ever seen. Keys are any hashable values; the bot uses `("user", id)`
+and `("chat", id)`.
+
+Registered as an aiogram middleware, it holds the sender's user lock for the whole
+handler call. `hold(*keys)` takes further locks inside a handler, and `guard(chat_key)`
+does the same for a whole handler; a key the current task already holds is re-entered
+instead of deadlocking, and the keys of one `hold` call are taken in one global order.
+Handlers should only add non-user keys (a chat, a promo code): waiting for another
+user's lock while holding your own can deadlock. Background tasks, which hold no user
+lock, take `user_id_key(id)` before changing that user's data, one user at a time and
+without holding a chat lock.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, NamedTuple, Optional, TypeVar
+
+from metrics import LatencyHistogram
+
+Handler = TypeVar("Handler", bound=Callable[..., Awaitable[Any]])
+
+
+class LockStats(NamedTuple):
+    acquired: int
+    contended: int
+    waiting: int
+    keys: int
+    wait_total: float
+    wait_p95: float
+    wait_max: float
+
+
+class _Entry:
+    __slots__ = ("lock", "users", "owner", "depth")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.users = 0  # tasks holding or waiting for the lock
+        self.owner: Optional[asyncio.Task] = None
+        self.depth = 0
+
+
+def user_id_key(user_id: int) -> tuple:
+    return ("user", user_id)
+
+
+def user_key(event: Any) -> Optional[tuple]:
+    user = getattr(event, "from_user", None)
+    return None if user is None else user_id_key(user.id)
+
+
+def chat_key(event: Any) -> Optional[tuple]:
+    """Chat of a message, or of the message a callback button is attached to."""
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    return None if chat is None else ("chat", chat.id)
+
+
+class KeyedLocks:
+    """Locks by key with wait statistics; see the module docstring."""
+
+    def __init__(self, event_key: Callable[[Any], Optional[Hashable]] = user_key):
+        self.event_key = event_key
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._acquired = 0
+        self._contended = 0
+        self._waiting = 0
+        self._wait_total = 0.0
+        self._waits = LatencyHistogram()
+
+    def reset_stats(self) -> None:
+        self._acquired = self._contended = 0
+        self._wait_total = 0.0
+        self._waits = LatencyHistogram()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def _acquire(self, key: Hashable) -> None:
+        task = asyncio.current_task()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+        elif entry.owner is task:
+            entry.depth += 1
+            return
+        entry.users += 1
+        self._acquired += 1
+        if entry.users > 1:
+            self._contended += 1
+            self._waiting += 1
+            started = time.perf_counter()
+            try:
+                await entry.lock.acquire()
+            except BaseException:
+                entry.users -= 1
+                if not entry.users:
+                    del self._entries[key]
+                raise
+            finally:
+                waited = time.perf_counter() - started
+                self._waiting -= 1
+                self._wait_total += waited
+                self._waits.add(waited)
+        else:
+            await entry.lock.acquire()
+        entry.owner = task
+        entry.depth = 1
+
+    def _release(self, key: Hashable) -> None:
+        entry = self._entries[key]
+        entry.depth -= 1
+        if entry.depth:
+            return
+        entry.owner = None
+        entry.lock.release()
+        entry.users -= 1
+        if not entry.users:
+            del self._entries[key]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: Optional[Hashable]) -> AsyncIterator[None]:
+        """Hold the locks of all `keys` (None entries are ignored) for the block."""
+        # One global order (by repr, since keys of different types do not compare).
+        ordered = sorted({key for key in keys if key is not None}, key=repr)
+        taken: List[Hashable] = []
+        try:
+            for key in ordered:
+                await self._acquire(key)
+                taken.append(key)
+            yield
+        finally:
+            for key in reversed(taken):
+                self._release(key)
+
+    def guard(self, event_key: Callable[[Any], Optional[Hashable]]) -> Callable[[Handler], Handler]:
+        """Decorator: run a handler under the lock of `event_key(event)`, its first argument."""
+
+        def decorator(handler: Handler) -> Handler:
+            @functools.wraps(handler)
+            async def guarded(event: Any, *args: Any, **kwargs: Any) -> Any:
+                async with self.hold(event_key(event)):
+                    return await handler(event, *args, **kwargs)
+
+            return guarded  # type: ignore[return-value]
+
+        return decorator
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        """aiogram middleware: runs the handler under the lock of `event_key(event)`."""
+        key = self.event_key(event)
+        if key is None:
+            return await handler(event, data)
+        async with self.hold(key):
+            return await handler(event, data)
+
+    def stats(self) -> LockStats:
+        return LockStats(
+            self._acquired,
+            self._contended,
+            self._waiting,
+            len(self._entries),
+            self._wait_total,
+            self._waits.percentile(0.95),
+            self._waits.maximum,
+        )
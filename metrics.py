@@ -0,0 +1,269 @@
+"""Per-handler call counts, latency percentiles and errors for the bot.
+
+`HandlerMetrics` is an aiogram middleware: register it on the router's message and
+callback_query observers and it times every handler call. While a handler runs, time
+spent in tracked storage methods (`track_storage`) and in Telegram API requests
+(`api_middleware`, registered on the bot session) is added to that call, so a report
+shows how much of a slow handler is its own work and how much is waiting.
+
+Latencies go into fixed logarithmic buckets, so memory per handler is constant and
+percentiles are accurate to one bucket (about 19%).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Bucket upper bounds: 0.1 ms growing by 2 ** (1/4) per bucket, up to about 15 minutes.
+_BUCKET_FACTOR = 2 ** 0.25
+_BUCKET_BOUNDS = tuple(0.0001 * _BUCKET_FACTOR ** i for i in range(93))
+
+
+class LatencyHistogram:
+    """Counts of durations in logarithmic buckets; the last bucket is unbounded."""
+
+    __slots__ = ("counts", "total", "maximum")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.total = 0
+        self.maximum = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(_BUCKET_BOUNDS, seconds)] += 1
+        self.total += 1
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the `fraction` quantile (0 when empty)."""
+        if not self.total:
+            return 0.0
+        rank = max(1, round(fraction * self.total))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_BUCKET_BOUNDS[index], self.maximum) if index < len(_BUCKET_BOUNDS) else self.maximum
+        return self.maximum
+
+
+class HandlerStats:
+    __slots__ = ("calls", "errors", "total", "storage", "api", "api_calls", "latency")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.storage = 0.0
+        self.api = 0.0
+        self.api_calls = 0
+        self.latency = LatencyHistogram()
+
+
+class HandlerReport(NamedTuple):
+    name: str
+    calls: int
+    errors: int
+    total: float
+    p50: float
+    p95: float
+    p99: float
+    maximum: float
+    storage: float
+    api: float
+    api_calls: int
+
+
+class _Span:
+    """Storage and API time of the handler call running in the current context.
+
+    Tasks started by the handler inherit the context, and with it the span, but may run
+    concurrently or outlive the call; only the task that runs the handler is counted.
+    """
+
+    __slots__ = ("storage", "api", "api_calls", "depth", "task")
+
+    def __init__(self) -> None:
+        self.storage = 0.0
+        self.api = 0.0
+        self.api_calls = 0
+        self.depth = 0
+        self.task = _running_task()
+
+
+_current_span: contextvars.ContextVar[Optional[_Span]] = contextvars.ContextVar("handler_span", default=None)
+
+
+def _running_task() -> Optional[asyncio.Task]:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # no event loop in this thread
+        return None
+
+
+def _active_span() -> Optional[_Span]:
+    """The span to count into from here, or None when the handler call is not the caller."""
+    span = _current_span.get()
+    if span is None or span.task is not _running_task():
+        return None
+    return span
+
+
+SORT_KEYS = {
+    "total": lambda report: report.total,
+    "calls": lambda report: report.calls,
+    "p95": lambda report: report.p95,
+    "p99": lambda report: report.p99,
+    "errors": lambda report: report.errors,
+}
+
+
+class HandlerMetrics:
+    """aiogram middleware collecting `HandlerStats` per handler name.
+
+    `dispatch_keys` name handler data entries that hold the real handler when one
+    aiogram handler dispatches to many (see routing.CommandRegistry); calls are then
+    reported under the real handler's name instead of the dispatcher's.
+    """
+
+    def __init__(self, dispatch_keys: Iterable[str] = ("command_handler", "callback_handler")):
+        self.dispatch_keys = tuple(dispatch_keys)
+        self._stats: Dict[str, HandlerStats] = {}
+        self.since = time.time()
+
+    def handler_name(self, data: Dict[str, Any]) -> str:
+        for key in self.dispatch_keys:
+            handler = data.get(key)
+            if handler is not None:
+                return getattr(handler, "__name__", repr(handler))
+        handler = data.get("handler")
+        callback = getattr(handler, "callback", handler)
+        return getattr(callback, "__name__", "unknown")
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        span = _Span()
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _current_span.reset(token)
+            self.record(self.handler_name(data), time.perf_counter() - started, span, failed)
+
+    def record(self, name: str, duration: float, span: _Span, failed: bool = False) -> None:
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = self._stats[name] = HandlerStats()
+        stats.calls += 1
+        stats.errors += failed
+        stats.total += duration
+        stats.storage += span.storage
+        stats.api += span.api
+        stats.api_calls += span.api_calls
+        stats.latency.add(duration)
+
+    async def api_middleware(self, make_request: Callable[..., Awaitable[Any]], bot: Any, method: Any) -> Any:
+        """aiogram session middleware: adds each API request's time to the running handler."""
+        span = _active_span()
+        if span is None:
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            span.api += time.perf_counter() - started
+            span.api_calls += 1
+
+    def track_storage(self, target: Any, *names: str) -> None:
+        """Wrap methods `names` of the `target` instance so their time counts as storage.
+
+        Storage calls made from inside another tracked call are counted once.
+        """
+        for name in names:
+            method = getattr(target, name)
+            wrapper = _async_storage_timer(method) if inspect.iscoroutinefunction(method) else _storage_timer(method)
+            setattr(target, name, wrapper)
+
+    def reports(self, sort: str = "total") -> List[HandlerReport]:
+        reports = [
+            HandlerReport(
+                name,
+                stats.calls,
+                stats.errors,
+                stats.total,
+                stats.latency.percentile(0.50),
+                stats.latency.percentile(0.95),
+                stats.latency.percentile(0.99),
+                stats.latency.maximum,
+                stats.storage,
+                stats.api,
+                stats.api_calls,
+            )
+            for name, stats in list(self._stats.items())
+        ]
+        reports.sort(key=SORT_KEYS[sort], reverse=True)
+        return reports
+
+    def totals(self) -> Tuple[int, int, float]:
+        """(calls, errors, seconds) over all handlers."""
+        stats = list(self._stats.values())
+        return sum(s.calls for s in stats), sum(s.errors for s in stats), sum(s.total for s in stats)
+
+    def reset(self) -> None:
+        self._stats = {}
+        self.since = time.time()
+
+
+def _storage_timer(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def timed(*args: Any, **kwargs: Any) -> Any:
+        span = _active_span()
+        if span is None or span.depth:
+            return method(*args, **kwargs)
+        span.depth += 1
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            span.storage += time.perf_counter() - started
+            span.depth -= 1
+
+    return timed
+
+
+def _async_storage_timer(method: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(method)
+    async def timed(*args: Any, **kwargs: Any) -> Any:
+        span = _active_span()
+        if span is None or span.depth:
+            return await method(*args, **kwargs)
+        span.depth += 1
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            span.storage += time.perf_counter() - started
+            span.depth -= 1
+
+    return timed
+
+
+def format_ms(seconds: float) -> str:
+    milliseconds = seconds * 1000
+    return f"{milliseconds:.1f}" if milliseconds < 100 else f"{milliseconds:.0f}"
@@ -0,0 +1,114 @@
+"""Token-bucket rate limits per (user, command) with timing-wheel eviction.
+
+A bucket holds up to `capacity` calls and refills one call every `per` seconds, so
+`RateLimit(1, 2.0)` is a plain two-second cooldown and `RateLimit(3, 10.0)` allows a
+burst of three followed by one call every ten seconds.
+
+A bucket that has refilled completely behaves exactly like one that was never created,
+so it is deleted. Each bucket is filed in a timing wheel under the second at which it
+will be full; every check advances the wheel to the current second and drops the full
+buckets it passes. Memory is therefore bounded by the users active within the longest
+refill time, not by every user and command ever seen.
+"""
+
+from __future__ import annotations
+
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+
+class RateLimit(NamedTuple):
+    capacity: float
+    per: float
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "full_at", "tick")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+        self.full_at = updated
+        self.tick = 0  # wheel tick the bucket is filed under
+
+
+class RateLimiter:
+    """Token buckets keyed by `(user_id, command)`; limits are looked up by command."""
+
+    def __init__(
+        self,
+        default: RateLimit = RateLimit(1, 2.0),
+        limits: Optional[Dict[Hashable, RateLimit]] = None,
+        wheel_slots: int = 64,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.default = default
+        self.limits: Dict[Hashable, RateLimit] = dict(limits or {})
+        self.rejected: Counter = Counter()
+        self._clock = clock
+        self._buckets: Dict[Tuple[int, Hashable], _Bucket] = {}
+        self._wheel: List[Set[Tuple[int, Hashable]]] = [set() for _ in range(wheel_slots)]
+        self._tick = int(clock())
+
+    def reset_stats(self) -> None:
+        self.rejected = Counter()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def limit_for(self, command: Hashable) -> RateLimit:
+        return self.limits.get(command, self.default)
+
+    def allow(self, user_id: int, command: Hashable) -> bool:
+        """Take one call from the bucket; False (and counted as rejected) when it is empty."""
+        now = self._clock()
+        self._advance(now)
+        capacity, per = self.limits.get(command, self.default)
+        key = (user_id, command)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(capacity, now)
+        else:
+            bucket.tokens = min(capacity, bucket.tokens + (now - bucket.updated) / per)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            self.rejected[command] += 1
+            return False
+        bucket.tokens -= 1
+        bucket.full_at = now + (capacity - bucket.tokens) * per
+        tick = int(bucket.full_at) + 1
+        if tick > bucket.tick:
+            # Filed lazily: a bucket filed too early is re-filed when its slot comes up.
+            if not bucket.tick:
+                self._file(key, tick)
+            bucket.tick = tick
+        return True
+
+    def _file(self, key: Tuple[int, Hashable], tick: int) -> None:
+        # Never file into the current slot, which has already been swept.
+        self._wheel[max(tick, self._tick + 1) % len(self._wheel)].add(key)
+
+    def _advance(self, now: float) -> None:
+        target = int(now)
+        if target <= self._tick:
+            return
+        # After a full turn every slot has been swept once; skip the rest of a long idle gap.
+        start = max(self._tick + 1, target - len(self._wheel) + 1)
+        self._tick = target
+        for tick in range(start, target + 1):
+            slot = self._wheel[tick % len(self._wheel)]
+            if not slot:
+                continue
+            due = list(slot)
+            slot.clear()
+            for key in due:
+                bucket = self._buckets[key]
+                if bucket.full_at <= now:
+                    del self._buckets[key]
+                else:
+                    self._file(key, bucket.tick)
+
+    def stats(self) -> Tuple[int, int, Dict[Hashable, int]]:
+        """(live buckets, rejected calls, rejected calls per command)."""
+        return len(self._buckets), sum(self.rejected.values()), dict(self.rejected)
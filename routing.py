@@ -0,0 +1,219 @@
+"""Lookup tables for routing text commands and button callbacks to bot handlers.
+
+Handlers register their keys once at import time; each update then costs one dict
+lookup plus one walk of a prefix trie over its text or callback data, however many
+handlers exist. Candidates are tried in registration order, so overlapping keys resolve
+the same way as a chain of aiogram filters would.
+"""
+
+from __future__ import annotations
+
+import abc
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+Handler = Callable[..., Any]
+Predicate = Callable[[Any], Any]
+
+# Trie nodes map characters to child nodes; this key holds the values ending at the node.
+_VALUES = None
+
+
+class PrefixTrie:
+    """Maps string prefixes to values; `matches(text)` walks `text` once."""
+
+    def __init__(self, prefixes: Iterable[str] = ()):
+        self._root: Dict[Any, Any] = {}
+        for prefix in prefixes:
+            self.add(prefix, prefix)
+
+    def add(self, prefix: str, value: Any) -> None:
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(_VALUES, []).append(value)
+
+    def matches(self, text: str) -> Iterator[Any]:
+        """Values of every added prefix of `text`, shortest prefix first."""
+        node = self._root
+        yield from node.get(_VALUES, ())
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                return
+            yield from node.get(_VALUES, ())
+
+    def has_prefix_of(self, text: str) -> bool:
+        return next(self.matches(text), _VALUES) is not _VALUES
+
+
+class _Route(NamedTuple):
+    order: int
+    handler: Handler
+    when: Optional[Predicate]
+
+
+class _KeyedRoutes(abc.ABC):
+    """Handlers keyed by exact string or by prefix, tried in registration order.
+
+    `exact` and `prefix` are decorators that register a handler and return it unchanged.
+    `when` adds a check on the event that runs only for candidates whose key already
+    matched. `state` registers a handler chosen by its predicate alone; keep those few,
+    since they are checked for every event.
+    """
+
+    def __init__(self) -> None:
+        self._exact: Dict[str, List[_Route]] = {}
+        self._stripped: Dict[str, List[_Route]] = {}
+        self._prefixes = PrefixTrie()
+        self._states: List[_Route] = []
+        self._count = 0
+
+    def _route(self, handler: Handler, when: Optional[Predicate]) -> _Route:
+        self._count += 1
+        return _Route(self._count, handler, when)
+
+    @abc.abstractmethod
+    def _key(self, event: Any) -> Optional[str]:
+        """The string that routes are matched against, or None to match nothing."""
+
+    def exact(
+        self, *keys: str, when: Optional[Predicate] = None, strip: bool = False
+    ) -> Callable[[Handler], Handler]:
+        """Match events whose whole key (stripped if `strip`) is one of `keys`."""
+        table = self._stripped if strip else self._exact
+
+        def decorator(handler: Handler) -> Handler:
+            route = self._route(handler, when)
+            for key in keys:
+                table.setdefault(key, []).append(route)
+            return handler
+
+        return decorator
+
+    def prefix(self, *prefixes: str, when: Optional[Predicate] = None) -> Callable[[Handler], Handler]:
+        """Match events whose key starts with one of `prefixes`."""
+
+        def decorator(handler: Handler) -> Handler:
+            route = self._route(handler, when)
+            for prefix in prefixes:
+                self._prefixes.add(prefix, route)
+            return handler
+
+        return decorator
+
+    def state(self, when: Predicate) -> Callable[[Handler], Handler]:
+        """Match any event, with or without a key, for which `when(event)` is true."""
+
+        def decorator(handler: Handler) -> Handler:
+            self._states.append(self._route(handler, when))
+            return handler
+
+        return decorator
+
+    def match(self, event: Any) -> Optional[Handler]:
+        """The first registered handler that accepts `event`, or None."""
+        key = self._key(event)
+        if key:
+            candidates = list(self._exact.get(key, ()))
+            if self._stripped:
+                candidates.extend(self._stripped.get(key.strip(), ()))
+            candidates.extend(self._prefixes.matches(key))
+            candidates.extend(self._states)
+        else:
+            candidates = self._states
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            # A prefix route reached through two of its prefixes appears twice; that is harmless.
+            candidates = sorted(candidates)
+        for route in candidates:
+            if route.when is None or route.when(event):
+                return route.handler
+        return None
+
+
+class CommandRegistry(_KeyedRoutes):
+    """Text commands keyed by exact alias or by prefix, matched against the lowered text.
+
+    Aliases are used as given, so they should be lower case; one with capitals never
+    matches, exactly like a `text.lower() == alias` filter.
+    """
+
+    def _key(self, message: Any) -> Optional[str]:
+        text = message.text
+        return text.lower() if text else None
+
+    def __call__(self, message: Any) -> Any:
+        """aiogram filter: passes the matched handler to the dispatching handler as `command_handler`."""
+        handler = self.match(message)
+        return False if handler is None else {"command_handler": handler}
+
+
+# Telegram rejects inline buttons whose callback_data is longer than this many bytes.
+CALLBACK_DATA_LIMIT = 64
+
+
+def make_callback_data(game: str, action: str, *args: Any) -> str:
+    """Build structured callback data: `game:action:arg1:arg2...`."""
+    data = ":".join((game, action, *map(str, args)))
+    if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"Callback data is longer than {CALLBACK_DATA_LIMIT} bytes: {data!r}")
+    return data
+
+
+class _Action(NamedTuple):
+    handler: Handler
+    converters: Tuple[Callable[[str], Any], ...]
+
+
+class CallbackRouter(_KeyedRoutes):
+    """Inline-button callbacks: structured `game:action:args` data plus legacy string keys.
+
+    `action(game, name, *converters)` registers a handler in a table keyed by
+    (game, action); the remaining fields are converted with `converters` and passed to
+    the handler as positional arguments. Data that does not name a registered action
+    (older `prefix_args` buttons) falls back to `exact`/`prefix` routes on the raw
+    string, which are case-sensitive.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._actions: Dict[Tuple[str, str], _Action] = {}
+
+    def _key(self, callback: Any) -> Optional[str]:
+        return callback.data
+
+    def action(self, game: str, name: str, *converters: Callable[[str], Any]) -> Callable[[Handler], Handler]:
+        def decorator(handler: Handler) -> Handler:
+            if (game, name) in self._actions:
+                raise ValueError(f"Callback action {game}:{name} is already registered")
+            self._actions[(game, name)] = _Action(handler, converters)
+            return handler
+
+        return decorator
+
+    def resolve(self, callback: Any) -> Optional[Tuple[Handler, Tuple[Any, ...]]]:
+        """(handler, arguments) for a callback, or None when nothing accepts it."""
+        data = callback.data
+        if data:
+            game, _, rest = data.partition(":")
+            action_name, _, raw_args = rest.partition(":")
+            action = self._actions.get((game, action_name))
+            if action is not None:
+                fields = raw_args.split(":") if raw_args else []
+                if len(fields) != len(action.converters):
+                    return None
+                try:
+                    args = tuple(convert(field) for convert, field in zip(action.converters, fields))
+                except ValueError:
+                    return None
+                return action.handler, args
+        handler = self.match(callback)
+        return None if handler is None else (handler, ())
+
+    def __call__(self, callback: Any) -> Any:
+        """aiogram filter: passes `callback_handler` and `callback_args` to the dispatching handler."""
+        resolved = self.resolve(callback)
+        if resolved is None:
+            return False
+        return {"callback_handler": resolved[0], "callback_args": resolved[1]}